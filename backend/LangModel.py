@@ -1,102 +1,451 @@
 import multiprocessing
 import os
 import logging
+import time
 import traceback
-from queue import Empty
-from threading import Thread
+from queue import Empty, Queue
+from threading import Lock, Thread
 
 import whisper
+from whisper.audio import HOP_LENGTH, SAMPLE_RATE
 from tinydb import Query, where
 
-from transcribe import transcribe
+from audio_cache import open_audio_cache
+from audio_stream import load_audio_range, probe_num_samples
+from backends import create_backend
+from cancellation import CancellationToken, TranscriptionInterrupted
+from cascade import CascadeBounds
+from model_registry import ModelRegistry
+from parallel_transcribe import ChunkParallelTranscriber
+from result_cache import ResultCache
+from worker_pool import TranscriptionWorkerPool, autotune, benchmark_audio
 import torch
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 
+def env_decode_settings():
+    """The decode settings of the server that are the same for every job"""
+    # Windows whose first decoder step is this sure of silence are skipped without decoding;
+    # off by default, since it may also skip speech that a full decode would keep
+    no_speech_fast_threshold = os.getenv("WHISPER_NO_SPEECH_FAST_THRESHOLD", "")
+    return dict(
+        # Windows are only batched when they are decoded without the previous text as prompt
+        batch_size=int(os.getenv("WHISPER_BATCH_SIZE", "1")),
+        condition_on_previous_text=os.getenv("WHISPER_CONDITION_ON_PREVIOUS_TEXT", "1")
+        in {"1", "true", "True"},
+        # Cut long silences out of the audio before decoding
+        vad_filter=os.getenv("WHISPER_VAD_FILTER", "0") in {"1", "true", "True"},
+        # Stop decodes that loop on the same phrase early and go straight to the next temperature
+        repetition_guard=os.getenv("WHISPER_REPETITION_GUARD", "1") in {"1", "true", "True"},
+        no_speech_fast_threshold=(
+            float(no_speech_fast_threshold) if no_speech_fast_threshold else None
+        ),
+    )
+
+
 class LangModel:
     def __init__(self):
         self.model = None
+        self.backend = None
         self.index = 0
         self.q = None
+        # pytorch (openai-whisper) or ctranslate2 (faster-whisper)
+        self.backend_name = os.getenv("WHISPER_BACKEND", "pytorch").strip().lower()
         # Use environment variable for model name, fallback to tiny
         self.model_name = os.getenv("WHISPER_MODEL_NAME", "tiny")
         # self.model_name = 'large-v2'
+        decode_settings = env_decode_settings()
+        self.batch_size = decode_settings["batch_size"]
+        self.condition_on_previous_text = decode_settings["condition_on_previous_text"]
+        self.vad_filter = decode_settings["vad_filter"]
+        self.repetition_guard = decode_settings["repetition_guard"]
+        self.no_speech_fast_threshold = decode_settings["no_speech_fast_threshold"]
+        # Decode files in chunks instead of holding the whole waveform and mel in memory
+        self.streaming = os.getenv("WHISPER_STREAMING_AUDIO", "1") in {"1", "true", "True"}
+        # All jobs decode through one broker which batches their windows together; decoder passes
+        # are only shared by windows with the same prompt
+        self.broker_batch_size = int(os.getenv("WHISPER_BROKER_BATCH_SIZE", "8"))
+        self.broker_max_wait = float(os.getenv("WHISPER_BROKER_MAX_WAIT_MS", "50")) / 1000
+        # A small model (e.g. base) proposes tokens that the main model verifies in one pass
+        self.draft_model_name = os.getenv("WHISPER_DRAFT_MODEL", "").strip() or None
+        self.num_draft_tokens = int(os.getenv("WHISPER_DRAFT_TOKENS", "5"))
+        # A fast model (e.g. base) decodes every window first; only windows outside the bounds
+        # are decoded again by the main model
+        self.cascade_model_name = os.getenv("WHISPER_CASCADE_MODEL", "").strip() or None
+        self.cascade_bounds = CascadeBounds(
+            min_avg_logprob=float(os.getenv("WHISPER_CASCADE_MIN_AVG_LOGPROB", "-0.5")),
+            max_compression_ratio=float(
+                os.getenv("WHISPER_CASCADE_MAX_COMPRESSION_RATIO", "2.0")
+            ),
+            max_no_speech_prob=float(os.getenv("WHISPER_CASCADE_MAX_NO_SPEECH_PROB", "0.3")),
+        )
+        # Long files are split at pauses and transcribed by several worker processes
+        self.parallel_chunks = int(os.getenv("WHISPER_PARALLEL_CHUNKS", "1"))
+        self.parallel_min_seconds = float(os.getenv("WHISPER_PARALLEL_MIN_SECONDS", "600"))
+        # float32, int8 (dynamic quantization of the Linear layers) or bf16 (autocast)
+        self.requested_precision = os.getenv("WHISPER_PRECISION", "float32").strip().lower()
+        self.precision = None
+        # Convert the checkpoint once and memory-map the weights, so that all processes on the
+        # host share one copy of them (pytorch backend)
+        self.mmap_weights = os.getenv("WHISPER_MMAP_WEIGHTS", "1") in {"1", "true", "True"}
+        self.chunk_transcriber = None
+        self.chunk_transcriber_lock = Lock()
+        # Jobs with the default model run in this many worker processes, each pinned to its
+        # share of the cores (0 = on threads of the API process, auto = measure the best split
+        # once and remember it in the model directory)
+        self.worker_processes = os.getenv("WHISPER_WORKER_PROCESSES", "0").strip().lower()
+        self.worker_threads = int(os.getenv("WHISPER_WORKER_THREADS", "0")) or None
+        # Recording the auto split is measured on; low-level noise if empty
+        self.autotune_audio = os.getenv("WHISPER_AUTOTUNE_AUDIO", "").strip() or None
+        self.worker_pool = None
+        # The decoded PCM and mel frames of transcribed files are kept on disk up to this size
+        # (0 = off), so that files transcribed again are not decoded again
+        self.audio_cache_dir = os.getenv("WHISPER_AUDIO_CACHE_DIR") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "temp", "audio_cache"
+        )
+        self.audio_cache_bytes = int(float(os.getenv("WHISPER_AUDIO_CACHE_MB", "2048")) * 2**20)
+        self.audio_cache = (
+            open_audio_cache(self.audio_cache_dir, self.audio_cache_bytes)
+            if self.audio_cache_bytes > 0
+            else None
+        )
+        # Results are kept for this many recordings (0 = off) and returned right away when the
+        # same audio is transcribed again with the same settings
+        self.result_cache_entries = int(os.getenv("WHISPER_RESULT_CACHE_ENTRIES", "1000"))
+        self.result_cache = (
+            ResultCache(
+                os.getenv("WHISPER_RESULT_CACHE_DIR")
+                or os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp", "result_cache"),
+                self.result_cache_entries,
+            )
+            if self.result_cache_entries > 0
+            else None
+        )
+        # Jobs save their progress every N windows (0 = never) and continue from there when they
+        # are run again after a restart; shared with the workers in distributed mode
+        self.checkpoint_windows = int(os.getenv("WHISPER_CHECKPOINT_WINDOWS", "10"))
+        self.checkpoint_dir = os.getenv("WHISPER_CHECKPOINT_DIR") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "temp", "checkpoints"
+        )
+        # Use environment variable for model directory, fallback to local models dir
+        self.model_path = os.getenv("WHISPER_MODEL_DIR") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "models"
+        )
+        # Jobs may pick another model; loaded models are kept within the memory budget (0 = no
+        # limit) and the least recently used ones are unloaded first. The default stays loaded.
+        allowed_models = os.getenv("WHISPER_ALLOWED_MODELS", "").strip()
+        self.registry = ModelRegistry(
+            self.create_backend,
+            memory_budget=int(float(os.getenv("WHISPER_MODEL_MEMORY_MB", "0")) * 2 ** 20),
+            allowed_models=(
+                {name.strip() for name in allowed_models.split(",")}
+                if allowed_models
+                else set(whisper.available_models())
+            )
+            | {self.model_name},
+            pinned_models=[self.model_name],
+        )
         self.process_queues = dict()
+        # cancelled by stop_transcription; the jobs check it down to every decoder step
+        self.cancel_tokens = dict()
         self.active_threads = dict()
+        self.cuda = torch.cuda.is_available()
         self.load_lang_model()
 
+    def backend_options(self):
+        if self.backend_name != "pytorch":
+            return dict()
+        return dict(
+            streaming=self.streaming,
+            mmap_weights=self.mmap_weights,
+            broker_batch_size=self.broker_batch_size,
+            broker_max_wait=self.broker_max_wait,
+            draft_model_name=self.draft_model_name,
+            num_draft_tokens=self.num_draft_tokens,
+            cascade_model_name=self.cascade_model_name,
+            cascade_bounds=self.cascade_bounds,
+            audio_cache_dir=self.audio_cache_dir,
+            audio_cache_bytes=self.audio_cache_bytes,
+        )
+
+    def create_backend(self, model_name):
+        return create_backend(
+            self.backend_name,
+            model_name,
+            self.model_path,
+            self.requested_precision,
+            **self.backend_options(),
+        )
+
     def load_lang_model(self):
-        # Use environment variable for model directory, fallback to local models dir
-        model_path = os.getenv("WHISPER_MODEL_DIR") or os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "models"
+        model_path = self.model_path
+        print(f"Load Model: {self.model_name} ({self.backend_name}) into {model_path}")
+        self.backend = self.registry.get(self.model_name)
+        self.model = self.backend.model
+        self.precision = self.backend.precision
+        print(
+            f"finished: {self.backend_name} cuda: {self.cuda} "
+            f"precision: {self.precision}"
         )
-        print(f"Load Model: {self.model_name} into {model_path}")
-        self.model = whisper.load_model(self.model_name, download_root = model_path)
-        print(f"finished: {self.model.device} cuda: {torch.cuda.torch.cuda.is_available()}" )
-        # self.model = whisper.load_model("tiny")
+        if self.worker_pool is None and self.worker_processes not in ("", "0"):
+            self.worker_pool = self.start_worker_pool()
         print("finished")
 
-    def transcribe_text(self, audio_file, transcript_id, end_callback):
-        logger.info(f"Starting transcription for job {transcript_id}, file: {audio_file}")
+    def start_worker_pool(self):
+        if self.worker_processes != "auto":
+            n_workers, threads = int(self.worker_processes), self.worker_threads
+        else:
+            n_workers, threads = autotune(
+                self.model_name,
+                self.model_path,
+                self.requested_precision,
+                self.backend_name,
+                self.backend_options(),
+                audio=benchmark_audio(self.autotune_audio),
+                decode_options=self.decode_settings(),
+                cache_file=os.path.join(self.model_path, "worker_pool_tuning.json"),
+            )
+            logger.info(f"Autotuned worker pool: {n_workers} workers x {threads} threads")
+
+        return TranscriptionWorkerPool(
+            self.model_name,
+            self.model_path,
+            n_workers,
+            threads,
+            precision=self.requested_precision,
+            backend=self.backend_name,
+            backend_options=self.backend_options(),
+        )
+
+    def warmup(self):
+        started = time.perf_counter()
+        self.backend.warmup()
+        logger.info(f"Warmup of {self.model_name} took {time.perf_counter() - started:.1f}s")
 
+    def decode_settings(self, language="de", fp16=False):
+        """Options for `InferenceBackend.transcribe` that are the same for every job"""
+        return dict(
+            fp16=fp16,
+            language=language,
+            condition_on_previous_text=self.condition_on_previous_text,
+            batch_size=self.batch_size,
+            vad_filter=self.vad_filter,
+            no_speech_fast_threshold=self.no_speech_fast_threshold,
+            repetition_guard=self.repetition_guard,
+        )
+
+    def use_chunk_parallel(self, audio_file, model_name=None):
+        # the workers load their own copy of the default model, outside the memory budget
+        if model_name not in (None, self.model_name):
+            return False
+        if self.parallel_chunks <= 1 or not isinstance(audio_file, str):
+            return False
+        num_samples = probe_num_samples(audio_file)
+        return num_samples is not None and num_samples / SAMPLE_RATE >= self.parallel_min_seconds
+
+    def result_settings(self, model_name=None, **decode_options):
+        """Everything besides the audio that the result of a job depends on"""
+        return dict(
+            self.decode_settings(),
+            **decode_options,
+            backend=self.backend_name,
+            model=model_name or self.model_name,
+            precision=self.requested_precision,
+            cascade=(self.cascade_model_name, self.cascade_bounds),
+            parallel_chunks=self.parallel_chunks,
+            # the streamed mel is clamped per window, the in-memory one per recording; the audio
+            # cache gives the same frames as the source it stands in for
+            streamed=self.streaming,
+        )
+
+    def cached_result(self, audio_file, model_name=None, count_miss=True, **decode_options):
+        """The stored result of the same audio transcribed with the same settings, or None"""
+        if self.result_cache is None or not isinstance(audio_file, str):
+            return None
+        key = self.result_cache.key(audio_file, self.result_settings(model_name, **decode_options))
+        result = self.result_cache.get(key, count_miss=count_miss)
+        if result is not None:
+            logger.info(f"Result cache hit for {os.path.basename(audio_file)}")
+            result["stats"] = dict(result.get("stats") or {}, result_cache_hit=True)
+        return result
+
+    def store_result(self, audio_file, result, model_name=None, **decode_options):
+        if self.result_cache is None or not isinstance(audio_file, str):
+            return
+        key = self.result_cache.key(audio_file, self.result_settings(model_name, **decode_options))
+        try:
+            self.result_cache.put(key, result)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not store the result of {os.path.basename(audio_file)}: {e}")
+
+    def load_audio_range(self, audio_file, start, end):
+        """The waveform of a range of a file, from the audio cache if the file is in it"""
+        cached = self.audio_cache.peek(audio_file) if self.audio_cache is not None else None
+        if cached is not None:
+            return cached.waveform(start, end)
+        # decoding the whole file to cache it would cost more than the range
+        return load_audio_range(audio_file, start, end)
+
+    def checkpoint_path(self, transcript_id):
+        return os.path.join(self.checkpoint_dir, f"{transcript_id}.json")
+
+    def remove_checkpoint(self, transcript_id):
+        if os.path.isfile(self.checkpoint_path(transcript_id)):
+            os.remove(self.checkpoint_path(transcript_id))
+
+    def use_worker_pool(self, model_name=None):
+        # the workers only have the default model
+        return self.worker_pool is not None and model_name in (None, self.model_name)
+
+    def get_chunk_transcriber(self):
+        with self.chunk_transcriber_lock:
+            if self.chunk_transcriber is None:
+                self.chunk_transcriber = ChunkParallelTranscriber(
+                    self.model_name,
+                    self.model_path,
+                    self.parallel_chunks,
+                    precision=self.requested_precision,
+                    backend=self.backend_name,
+                    backend_options=self.backend_options(),
+                )
+            return self.chunk_transcriber
+
+    def transcribe_blocking(self, audio_file, language="de", fp16=False, model_name=None):
+        """Transcribe a file on the calling thread, sharing the backend with the running jobs"""
         if self.model is None:
             logger.info("Model not loaded, loading now...")
             self.load_lang_model()
 
-        q = multiprocessing.Queue()
-        self.process_queues[transcript_id] = q
+        if self.use_chunk_parallel(audio_file, model_name):
+            return self.get_chunk_transcriber().transcribe(
+                audio_file,
+                process_queue=Queue(),
+                **self.decode_settings(language=language, fp16=fp16),
+            )
+
+        if self.use_worker_pool(model_name):
+            return self.worker_pool.transcribe(
+                audio_file,
+                verbose=False,
+                process_queue=Queue(),
+                **self.decode_settings(language=language, fp16=fp16),
+            )
+
+        with self.registry.use(model_name or self.model_name) as backend:
+            return backend.transcribe(
+                audio_file,
+                verbose=False,
+                process_queue=Queue(),
+                **self.decode_settings(language=language, fp16=fp16),
+            )
+
+    def transcribe_job(
+        self,
+        audio_file,
+        transcript_id,
+        end_callback,
+        model_name=None,
+        resumable=False,
+        **decode_options,
+    ):
+        """
+        Transcribe a file or waveform on the calling thread. Segments, errors and the end of the
+        job are put on the job's process queue, which `empty_process_queue` reads.
+        `decode_options` (e.g. temperature or initial_prompt) override the settings of the model.
+        Only `resumable` jobs, which are run again after a restart, save checkpoints.
+        """
+        logger.info(
+            f"Starting transcription for job {transcript_id}, "
+            f"file: {audio_file if isinstance(audio_file, str) else 'waveform'}, "
+            f"model: {model_name or self.model_name}"
+        )
+
+        if self.model is None:
+            logger.info("Model not loaded, loading now...")
+            self.load_lang_model()
+
+        q = self.process_queues.get(transcript_id)
+        if q is None:
+            q = self.process_queues[transcript_id] = multiprocessing.Queue()
+        cancel_token = self.cancel_tokens.setdefault(transcript_id, CancellationToken())
 
         kwargs = dict(
-            model=self.model,
             audio=audio_file,
             verbose=True,
-            fp16=False,
-            language="de",
             process_queue=q,
             job_id=transcript_id,
+            cancel_token=cancel_token,
             end_callback=end_callback,
+            **dict(self.decode_settings(), **decode_options),
         )
 
-        # Wrapper function to catch errors
-        def transcribe_wrapper():
-            try:
-                logger.info(f"[Job {transcript_id}] Starting transcription thread")
-                transcribe(**kwargs)
-                logger.info(f"[Job {transcript_id}] Transcription completed successfully")
-            except Exception as e:
-                logger.error(f"[Job {transcript_id}] Transcription failed with error: {str(e)}")
-                logger.error(f"[Job {transcript_id}] Traceback: {traceback.format_exc()}")
-                # Send error to queue
-                q.put({
-                    "channel": "error", 
-                    "data": str(e), 
-                    "job_id": transcript_id,
-                    "traceback": traceback.format_exc()
-                })
-                # Also send end message to stop waiting
-                q.put({"channel": "message", "data": "end", "job_id": transcript_id})
-
-        p = Thread(target=transcribe_wrapper)
+        try:
+            chunk_parallel = self.use_chunk_parallel(audio_file, model_name)
+            # the chunks of a parallel job are too short to be worth checkpointing
+            if resumable and self.checkpoint_windows > 0 and not chunk_parallel:
+                kwargs.update(
+                    checkpoint=self.checkpoint_path(transcript_id),
+                    checkpoint_windows=self.checkpoint_windows,
+                )
+
+            if chunk_parallel:
+                self.get_chunk_transcriber().transcribe(**kwargs)
+            elif self.use_worker_pool(model_name):
+                self.worker_pool.transcribe(**kwargs)
+            else:
+                with self.registry.use(model_name or self.model_name) as backend:
+                    backend.transcribe(**kwargs)
+            logger.info(f"[Job {transcript_id}] Transcription completed successfully")
+        except TranscriptionInterrupted:
+            logger.warning(f"[Job {transcript_id}] Transcription interrupted by the shutdown")
+            raise
+        except Exception as e:
+            logger.error(f"[Job {transcript_id}] Transcription failed with error: {str(e)}")
+            logger.error(f"[Job {transcript_id}] Traceback: {traceback.format_exc()}")
+            # Send error to queue
+            q.put({
+                "channel": "error", 
+                "data": str(e), 
+                "job_id": transcript_id,
+                "traceback": traceback.format_exc()
+            })
+            # Also send end message to stop waiting
+            q.put({"channel": "message", "data": "end", "job_id": transcript_id})
+        finally:
+            self.cancel_tokens.pop(transcript_id, None)
+
+    def transcribe_text(self, audio_file, transcript_id, end_callback, model_name=None):
+        """Run `transcribe_job` on a new thread"""
+        # created here, so that the job can be stopped before the thread got to it
+        self.process_queues[transcript_id] = multiprocessing.Queue()
+        self.cancel_tokens[transcript_id] = CancellationToken()
+        p = Thread(
+            target=self.transcribe_job,
+            args=(audio_file, transcript_id, end_callback, model_name),
+        )
         self.active_threads[transcript_id] = p
         p.start()
         logger.info(f"[Job {transcript_id}] Transcription thread started")
 
     def stop_transcription(self, transcript_id):
         """Stop a running transcription process"""
-        if transcript_id not in self.process_queues:
+        process_queue = self.process_queues.get(transcript_id)
+        if process_queue is None:
             return False
 
-        # Signal the process to stop by putting a stop message in the queue
-        self.process_queues[transcript_id].put(
-            {"channel": "control", "data": "stop", "job_id": transcript_id}
-        )
+        # The job stops within a decoder step; its thread finishes on its own
+        cancel_token = self.cancel_tokens.get(transcript_id)
+        if cancel_token is not None:
+            cancel_token.cancel()
 
         # Put an end message to finalize the process
-        self.process_queues[transcript_id].put(
-            {"channel": "message", "data": "end", "job_id": transcript_id}
-        )
+        try:
+            process_queue.put({"channel": "message", "data": "end", "job_id": transcript_id})
+        except ValueError:
+            # the job finished and released its queue meanwhile
+            pass
 
         # Clean up references
         if transcript_id in self.active_threads:
@@ -104,10 +453,16 @@ class LangModel:
 
         return True
 
+    def release_process_queue(self, job_id):
+        """Forget the process queue of a finished job, closing its pipe and feeder thread"""
+        process_queue = self.process_queues.pop(job_id, None)
+        if hasattr(process_queue, "close"):
+            process_queue.close()
+
     def empty_process_queue(self, job_id):
         process_queue = self.process_queues.get(job_id)
         if process_queue is None:
-            yield [], False
+            return
 
         while True:
             try:
@@ -116,7 +471,7 @@ class LangModel:
                 break
 
             if data["data"] == "end":
-                yield {}, True
+                yield dict(stats=data.get("stats")), True
             elif data["channel"] == "error":
                 # Yield error information
                 yield dict(
@@ -131,6 +486,9 @@ class LangModel:
                     text=data["data"]["text"],
                     copy=data["data"]["copy"],
                 ), False
+            elif data["channel"] == "timer":
+                # seconds of the recording transcribed so far
+                yield dict(timer=data["data"]["timer"] * HOP_LENGTH / SAMPLE_RATE), False
 
 if __name__ == '__main__':
     lang_model = LangModel()
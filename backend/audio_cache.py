@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from threading import Lock, Thread
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from whisper.audio import HOP_LENGTH, N_FFT, N_FRAMES, N_MELS, SAMPLE_RATE, mel_filters
+
+from audio_stream import STFT_CONTEXT, MappedMelSource, decode_pcm_command, log10_mel
+
+logger = logging.getLogger(__name__)
+
+# mel frames computed at a time while an entry is built
+MEL_CHUNK_FRAMES = 10 * N_FRAMES
+# bytes of PCM read from ffmpeg and of the file hashed at a time
+READ_BLOCK = 2**20
+# version of the entries; version 1 stored mel frames clamped over the whole recording
+ENTRY_VERSION = 2
+
+
+_digests: Dict[tuple, str] = dict()
+
+
+def file_digest(file: str) -> str:
+    """The SHA-256 of a file's content"""
+    stat = os.stat(file)
+    # hashing a long recording takes a moment, so it is done once per version of a file
+    version = (os.path.realpath(file), stat.st_size, stat.st_mtime_ns)
+    if version not in _digests:
+        digest = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(READ_BLOCK), b""):
+                digest.update(block)
+        _digests[version] = digest.hexdigest()
+    return _digests[version]
+
+
+class CachedAudio:
+    """The decoded PCM and mel frames of one audio file, memory-mapped from the cache"""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.num_samples = meta["num_samples"]
+        self.num_frames = meta["num_frames"]
+        self.log_max = meta["log_max"]
+        self.pcm = _open_array(directory, "pcm.int16", np.int16, (self.num_samples,))
+        # copy-on-write, so that torch gets a writable array without copying it
+        self.mel = _open_array(directory, "mel.float32", np.float32, (N_MELS, self.num_frames))
+
+    def waveform(self, start: float = 0.0, end: Optional[float] = None) -> np.ndarray:
+        """The samples from `start` to `end` seconds, as whisper's float32 waveform"""
+        first = int(start * SAMPLE_RATE)
+        last = self.num_samples if end is None else int(end * SAMPLE_RATE)
+        return self.pcm[first:last].astype(np.float32) / 32768.0
+
+    def mel_source(self, streaming: bool = False) -> MappedMelSource:
+        """The mel frames as the streamed (clamped per window) or the in-memory source has them"""
+        return MappedMelSource(self.mel, log_max=None if streaming else self.log_max)
+
+
+def _open_array(directory: str, name: str, dtype, shape: Tuple[int, ...]) -> np.ndarray:
+    if 0 in shape:
+        # an empty file cannot be mapped
+        return np.zeros(shape, dtype)
+    return np.memmap(os.path.join(directory, name), dtype=dtype, mode="c", shape=shape)
+
+
+class AudioCache:
+    """
+    An on-disk cache of the 16 kHz int16 PCM and the log-mel frames of audio files, keyed by the
+    SHA-256 of the file's content, so that transcribing a file again (another range, a retry, a
+    different model) skips decoding it and computing its mel spectrogram.
+
+    The log10 mel frames are computed in chunks and stored before their dynamic range is
+    clamped. Their windows are clamped when they are read, over the whole recording like
+    `whisper.log_mel_spectrogram` or per window like the streamed source, whichever the job would
+    have used without the cache, so that the cache never changes a transcript. Entries are memory-mapped by the jobs that use them
+    and shared by all processes using the same directory. When the entries take more than
+    `max_bytes`, the least recently used ones are removed.
+
+    Jobs do not wait for an entry: the first job of a file streams it and fills the cache on a
+    background thread with `fill`, the later ones read the entry.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._locks = defaultdict(Lock)
+        self._locks_lock = Lock()
+        # keys of the entries being built by `fill`
+        self._filling = set()
+
+    def key(self, file: str) -> str:
+        # entries of older versions are never read again and evicted like unused ones
+        return f"{file_digest(file)}-v{ENTRY_VERSION}"
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def peek(self, file: str) -> Optional[CachedAudio]:
+        """The entry of a file if it is cached, without building it"""
+        directory = self._entry(self.key(file))
+        try:
+            cached = CachedAudio(directory)
+        except FileNotFoundError:
+            return None
+        self._touch(directory)
+        self.hits += 1
+        return cached
+
+    def get(self, file: str) -> CachedAudio:
+        """The entry of a file, which is built first if the file is not cached yet"""
+        key = self.key(file)
+        directory = self._entry(key)
+        with self._locks_lock:
+            lock = self._locks[key]
+        with lock:
+            try:
+                cached = CachedAudio(directory)
+                self.hits += 1
+            except FileNotFoundError:
+                self._build(file, directory)
+                self.misses += 1
+                cached = CachedAudio(directory)
+                self._evict(keep=key)
+        self._touch(directory)
+        return cached
+
+    def fill(self, file: str) -> Optional[Thread]:
+        """Build the entry of a file on a background thread, unless it is already being built"""
+        key = self.key(file)
+        with self._locks_lock:
+            if key in self._filling:
+                return None
+            self._filling.add(key)
+        thread = Thread(
+            target=self._fill, args=(file, key), name=f"audio-cache-{key[:8]}", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _fill(self, file: str, key: str):
+        try:
+            self.get(file)
+        except Exception as e:
+            logger.warning(f"[AUDIO CACHE] Could not cache {os.path.basename(file)}: {e}")
+        finally:
+            with self._locks_lock:
+                self._filling.discard(key)
+
+    def drop(self, file: str) -> bool:
+        directory = self._entry(self.key(file))
+        if not os.path.isdir(directory):
+            return False
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.info(f"[AUDIO CACHE] Dropped {os.path.basename(file)}")
+        return True
+
+    def info(self) -> dict:
+        entries = self._entries()
+        return dict(
+            directory=self.directory,
+            entries=len(entries),
+            size_mb=round(sum(size for _, _, size in entries) / 2**20, 1),
+            max_size_mb=round(self.max_bytes / 2**20, 1),
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+    @staticmethod
+    def _touch(directory: str):
+        # the modification time of the metadata is the entry's last use
+        try:
+            os.utime(os.path.join(directory, "meta.json"))
+        except FileNotFoundError:
+            pass
+
+    def _build(self, file: str, directory: str):
+        started = time.perf_counter()
+        # built next to the entry and renamed, so that other processes never see half an entry
+        building = tempfile.mkdtemp(prefix=".building-", dir=self.directory)
+        try:
+            num_samples = _decode_pcm(file, os.path.join(building, "pcm.int16"))
+            num_frames = num_samples // HOP_LENGTH
+            log_max = None
+            if num_frames:
+                log_max = _compute_mel(building, num_samples, num_frames)
+            with open(os.path.join(building, "meta.json"), "w") as f:
+                json.dump(
+                    dict(num_samples=num_samples, num_frames=num_frames, log_max=log_max), f
+                )
+            try:
+                os.rename(building, directory)
+            except OSError:
+                # another process built the same file at the same time
+                shutil.rmtree(building, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(building, ignore_errors=True)
+            raise
+        logger.info(
+            f"[AUDIO CACHE] Cached {os.path.basename(file)} ({num_samples / SAMPLE_RATE:.0f}s) "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            meta = os.path.join(self.directory, name, "meta.json")
+            if name.startswith(".") or not os.path.isfile(meta):
+                continue
+            try:
+                size = sum(
+                    entry.stat().st_size for entry in os.scandir(os.path.join(self.directory, name))
+                )
+                entries.append((os.path.getmtime(meta), name, size))
+            except FileNotFoundError:
+                pass  # removed by another process meanwhile
+        return entries
+
+    def _evict(self, keep: str):
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            # jobs that still map the files keep reading them until they finish
+            shutil.rmtree(self._entry(name), ignore_errors=True)
+            total -= size
+            logger.info(f"[AUDIO CACHE] Evicted {name}")
+
+
+_caches: Dict[str, AudioCache] = dict()
+_caches_lock = Lock()
+
+
+def open_audio_cache(directory: str, max_bytes: int) -> AudioCache:
+    """The cache in `directory`, shared by everything in this process that uses it"""
+    with _caches_lock:
+        directory = os.path.abspath(directory)
+        if directory not in _caches:
+            _caches[directory] = AudioCache(directory, max_bytes)
+        return _caches[directory]
+
+
+def _decode_pcm(file: str, path: str) -> int:
+    """Decode `file` to int16 PCM in `path` and return the number of samples"""
+    process = subprocess.Popen(
+        decode_pcm_command(file), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    size = 0
+    with open(path, "wb") as f:
+        for block in iter(lambda: process.stdout.read(READ_BLOCK), b""):
+            f.write(block)
+            size += len(block)
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"Failed to load audio: {stderr.decode()}")
+    return size // 2
+
+
+def _compute_mel(directory: str, num_samples: int, num_frames: int) -> float:
+    """Store the unclamped log10 mel frames of the PCM and return their maximum"""
+    pcm = np.memmap(os.path.join(directory, "pcm.int16"), dtype=np.int16, mode="r")
+    mel = np.memmap(
+        os.path.join(directory, "mel.float32"),
+        dtype=np.float32,
+        mode="w+",
+        shape=(N_MELS, num_frames),
+    )
+    window = torch.hann_window(N_FFT)
+    filters = mel_filters("cpu", N_MELS)
+
+    log_max = -np.inf
+    for first in range(0, num_frames, MEL_CHUNK_FRAMES):
+        last = min(first + MEL_CHUNK_FRAMES, num_frames)
+        # the samples of the frames and their context, reflected at the edges of the recording
+        # like the centered STFT of log_mel_spectrogram does it
+        first_sample = first * HOP_LENGTH - STFT_CONTEXT
+        end_sample = (last - 1) * HOP_LENGTH + STFT_CONTEXT
+        audio = pcm[max(first_sample, 0) : min(end_sample, num_samples)].astype(np.float32)
+        audio /= 32768.0
+        pad_left = max(-first_sample, 0)
+        pad_right = max(end_sample - num_samples, 0)
+        if pad_left or pad_right:
+            audio = np.pad(audio, (pad_left, pad_right), mode="reflect")
+
+        log_spec = log10_mel(torch.from_numpy(audio), window, filters)
+        mel[:, first:last] = log_spec.numpy()
+        log_max = max(log_max, log_spec.max().item())
+
+    # the frames are clamped when they are read, per window or over the recording
+    mel.flush()
+    return log_max
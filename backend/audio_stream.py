@@ -0,0 +1,260 @@
+import logging
+import subprocess
+from typing import Iterator, List, Optional, Union
+
+import numpy as np
+import torch
+from whisper.audio import (
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_MELS,
+    SAMPLE_RATE,
+    log_mel_spectrogram,
+    mel_filters,
+)
+
+logger = logging.getLogger(__name__)
+
+# samples of context needed on each side of a frame, matching the centered STFT in whisper
+STFT_CONTEXT = N_FFT // 2
+# amount of PCM read from ffmpeg per chunk
+CHUNK_SAMPLES = 30 * SAMPLE_RATE
+
+
+class InMemoryMelSource:
+    """Mel frames of a whole recording computed up front, as `whisper.transcribe` does it"""
+
+    def __init__(self, audio: Union[str, np.ndarray, torch.Tensor]):
+        if not isinstance(audio, str) and len(audio) == 0:
+            # e.g. nothing left after voice activity filtering
+            self.mel = torch.zeros((N_MELS, 0))
+        else:
+            self.mel = log_mel_spectrogram(audio)
+
+    @property
+    def num_frames(self) -> int:
+        return self.mel.shape[-1]
+
+    def window(self, seek: int, length: int = N_FRAMES) -> torch.Tensor:
+        return self.mel[:, seek : seek + length]
+
+    def close(self):
+        pass
+
+
+class MappedMelSource:
+    """
+    Log10 mel frames of a whole recording in a memory-mapped array, before their dynamic range
+    is clamped. Windows are clamped over the recording's maximum `log_max` like
+    `log_mel_spectrogram` does it, or per window like `StreamingMelSource` if it is None, so that
+    they equal the frames of the source they stand in for.
+    """
+
+    def __init__(self, log_mel: np.ndarray, log_max: Optional[float] = None):
+        self.log_mel = log_mel
+        self.log_max = log_max
+
+    @property
+    def num_frames(self) -> int:
+        return self.log_mel.shape[-1]
+
+    def window(self, seek: int, length: int = N_FRAMES) -> torch.Tensor:
+        log_spec = torch.from_numpy(self.log_mel[:, seek : seek + length])
+        if log_spec.shape[-1] == 0:
+            return log_spec
+        if self.log_max is None:
+            log_max = log_spec.max()
+        else:
+            log_max = torch.tensor(self.log_max, dtype=log_spec.dtype)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def close(self):
+        pass
+
+
+class StreamingMelSource:
+    """
+    Mel frames computed on demand from a stream of 16 kHz mono PCM chunks.
+
+    Only the samples from the start of the last requested window onwards are kept, so memory
+    stays bounded by the window length plus one read chunk no matter how long the recording is.
+    Windows must therefore be requested with non-decreasing `seek`. Unlike
+    `log_mel_spectrogram`, the dynamic range of the log-mel values is clamped per window instead
+    of over the whole recording.
+    """
+
+    def __init__(self, chunks: Iterator[np.ndarray], total_samples: Optional[int] = None):
+        self._chunks = chunks
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_start = 0  # index of the first buffered sample in the whole recording
+        self._eof = False
+        self._total_samples = total_samples
+        self._window = torch.hann_window(N_FFT)
+        self._filters = mel_filters("cpu", N_MELS)
+
+    @classmethod
+    def from_file(cls, file: str) -> "StreamingMelSource":
+        process = subprocess.Popen(
+            decode_pcm_command(file), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+        def read_chunks():
+            try:
+                while True:
+                    data = process.stdout.read(CHUNK_SAMPLES * 2)
+                    if not data:
+                        break
+                    if len(data) % 2:
+                        data += process.stdout.read(1)
+                    yield np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+            finally:
+                process.stdout.close()
+                process.kill()
+                process.wait()
+
+        return cls(read_chunks(), total_samples=probe_num_samples(file))
+
+    @property
+    def num_frames(self) -> int:
+        """Exact once the stream is exhausted, estimated from the container duration before"""
+        if self._eof:
+            return self._total_samples // HOP_LENGTH
+
+        # the stream continues past the buffered samples even if the estimate says otherwise
+        buffered_end = self._buffer_start + len(self._buffer)
+        return max(self._total_samples or 0, buffered_end + HOP_LENGTH) // HOP_LENGTH
+
+    def window(self, seek: int, length: int = N_FRAMES) -> torch.Tensor:
+        first_sample = seek * HOP_LENGTH - STFT_CONTEXT
+        end_sample = (seek + length - 1) * HOP_LENGTH + STFT_CONTEXT
+
+        self._fill_until(end_sample, keep_from=max(first_sample, 0))
+
+        if self._eof:
+            length = min(length, self.num_frames - seek)
+        if length <= 0:
+            return torch.zeros((N_MELS, 0))
+        end_sample = (seek + length - 1) * HOP_LENGTH + STFT_CONTEXT
+
+        audio = self._buffer[
+            max(first_sample, 0) - self._buffer_start : end_sample - self._buffer_start
+        ]
+        # reflect at the edges of the recording, like the centered STFT does
+        pad_left = max(-first_sample, 0)
+        pad_right = max(end_sample - self._buffer_start - len(self._buffer), 0)
+        if pad_left or pad_right:
+            audio = np.pad(audio, (pad_left, pad_right), mode="reflect")
+
+        return self._log_mel(torch.from_numpy(audio))
+
+    def close(self):
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+        self._buffer = np.zeros(0, dtype=np.float32)
+
+    def _log_mel(self, audio: torch.Tensor) -> torch.Tensor:
+        log_spec = log10_mel(audio, self._window, self._filters)
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec
+
+    def _drop_before(self, sample: int):
+        drop = min(sample - self._buffer_start, len(self._buffer))
+        if drop > 0:
+            # copy, so that the dropped samples are actually freed
+            self._buffer = self._buffer[drop:].copy()
+            self._buffer_start += drop
+
+    def _fill_until(self, sample: int, keep_from: int):
+        self._drop_before(keep_from)
+        while self._buffer_start + len(self._buffer) < sample and not self._eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                self._total_samples = self._buffer_start + len(self._buffer)
+                break
+            self._buffer = np.concatenate([self._buffer, chunk])
+            self._drop_before(keep_from)
+
+
+def log10_mel(audio: torch.Tensor, window: torch.Tensor, filters: torch.Tensor) -> torch.Tensor:
+    """
+    The log10 mel frames of `audio`, which has to include the STFT_CONTEXT samples around them,
+    before the dynamic range is clamped and the values are scaled
+    """
+    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+    magnitudes = stft.abs() ** 2
+
+    mel_spec = filters @ magnitudes
+
+    return torch.clamp(mel_spec, min=1e-10).log10()
+
+
+def decode_pcm_command(file: str, *input_options: str) -> List[str]:
+    """ffmpeg arguments that decode `file` to 16 kHz mono s16le PCM on stdout"""
+    return [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        *input_options,
+        "-i",
+        file,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(SAMPLE_RATE),
+        "-",
+    ]
+
+
+def probe_num_samples(file: str) -> Optional[int]:
+    """Estimate the number of 16 kHz samples of a file from its container duration"""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                file,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return int(float(result.stdout.strip()) * SAMPLE_RATE)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Could not probe duration of {file}: {e}")
+        return None
+
+
+def load_audio_range(file: str, start: float, end: float) -> np.ndarray:
+    """
+    The 16 kHz mono waveform of `file` from `start` to `end` seconds. ffmpeg seeks to the start
+    in the container, so only the range is decoded, not the recording up to it.
+    """
+    cmd = decode_pcm_command(file, "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}")
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def open_mel_source(
+    audio: Union[str, np.ndarray, torch.Tensor], streaming: bool = False
+) -> Union[InMemoryMelSource, StreamingMelSource]:
+    if streaming and isinstance(audio, str):
+        return StreamingMelSource.from_file(audio)
+    return InMemoryMelSource(audio)
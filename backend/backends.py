@@ -0,0 +1,363 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from queue import Queue
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from whisper.audio import HOP_LENGTH, SAMPLE_RATE
+
+from audio_cache import open_audio_cache
+from cancellation import CancellationToken
+from cascade import CascadeBounds, ModelCascade
+from inference_broker import InferenceBroker
+from precision import apply_precision
+from speculative import SpeculativeDecoder
+from transcribe import stop_requested, transcribe
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("pytorch", "ctranslate2")
+
+
+def state_dict_bytes(module: torch.nn.Module) -> int:
+    """Memory held by the weights of a module, including packed quantized weights"""
+
+    def tensor_bytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(item) for item in value)
+        return 0
+
+    return sum(tensor_bytes(value) for value in module.state_dict().values())
+
+
+class InferenceBackend(ABC):
+    """
+    Runs a Whisper model behind `LangModel`. `transcribe` has the contract of
+    `transcribe.transcribe`: it puts the segment, timer and end messages of the job on
+    `process_queue`, calls `end_callback` and returns a dict with "text", "segments", "language"
+    and "stats". The job stops early when its `cancel_token` is cancelled.
+    """
+
+    name: str
+
+    def __init__(self, model_name: str, model_dir: str, precision: str = "float32"):
+        self.model_name = model_name
+        self.model_dir = model_dir
+        self.requested_precision = precision
+        # the precision the model actually runs in, once it is loaded
+        self.precision = None
+        self.model = None
+
+    @abstractmethod
+    def load(self):
+        """Load the model; called once before the first job"""
+
+    @abstractmethod
+    def transcribe(
+        self,
+        audio,
+        *,
+        process_queue,
+        job_id=None,
+        end_callback: Optional[Callable[[dict], None]] = None,
+        verbose: Optional[bool] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        **options,
+    ) -> dict:
+        """Transcribe a file or waveform; see the class docstring"""
+
+    def warmup(self):
+        """Decode a second of synthetic audio, so that the first job does not pay for the lazy
+        initialisation of the runtime (kernel selection, allocator pools, tokenizer)"""
+        audio = 0.01 * np.random.default_rng(0).standard_normal(SAMPLE_RATE)
+        self.transcribe(
+            audio.astype(np.float32),
+            process_queue=Queue(),
+            language=None,
+            temperature=0.0,
+            sample_len=8,
+        )
+
+    def stats(self) -> Optional[dict]:
+        return None
+
+    def memory_bytes(self) -> int:
+        """Memory held by the loaded models, or 0 if the backend cannot tell"""
+        return 0
+
+    def close(self):
+        pass
+
+
+class PyTorchBackend(InferenceBackend):
+    """The openai-whisper model, decoded by `transcribe()` through the shared inference broker"""
+
+    name = "pytorch"
+
+    def __init__(
+        self,
+        model_name: str,
+        model_dir: str,
+        precision: str = "float32",
+        *,
+        streaming: bool = True,
+        mmap_weights: bool = False,
+        use_broker: bool = True,
+        broker_batch_size: int = 8,
+        broker_max_wait: float = 0.05,
+        draft_model_name: Optional[str] = None,
+        num_draft_tokens: int = 5,
+        cascade_model_name: Optional[str] = None,
+        cascade_bounds: CascadeBounds = CascadeBounds(),
+        audio_cache_dir: Optional[str] = None,
+        audio_cache_bytes: int = 0,
+    ):
+        super().__init__(model_name, model_dir, precision)
+        self.streaming = streaming
+        self.audio_cache = (
+            open_audio_cache(audio_cache_dir, audio_cache_bytes)
+            if audio_cache_dir and audio_cache_bytes > 0
+            else None
+        )
+        self.mmap_weights = mmap_weights
+        self.use_broker = use_broker
+        self.broker_batch_size = broker_batch_size
+        self.broker_max_wait = broker_max_wait
+        self.draft_model_name = draft_model_name
+        self.num_draft_tokens = num_draft_tokens
+        self.cascade_model_name = cascade_model_name
+        self.cascade_bounds = cascade_bounds
+        self.broker = None
+        self.speculative = None
+        self.cascade = None
+
+    def _load_model(self, model_name: str):
+        if self.mmap_weights:
+            import mmap_weights as loader
+        else:
+            import whisper as loader
+
+        return apply_precision(
+            loader.load_model(model_name, download_root=self.model_dir),
+            self.requested_precision,
+        )
+
+    def load(self):
+        self.model, self.precision = self._load_model(self.model_name)
+        if self.draft_model_name:
+            draft_model, _ = self._load_model(self.draft_model_name)
+            self.speculative = SpeculativeDecoder(
+                self.model, draft_model, num_draft_tokens=self.num_draft_tokens
+            )
+        if self.cascade_model_name:
+            cascade_model, _ = self._load_model(self.cascade_model_name)
+            if cascade_model.dims.n_vocab != self.model.dims.n_vocab:
+                raise ValueError(
+                    f"The cascade model {self.cascade_model_name} does not share the tokenizer "
+                    f"of {self.model_name}"
+                )
+            self.cascade = ModelCascade(
+                cascade_model, self.cascade_model_name, self.model_name, self.cascade_bounds
+            )
+        if self.broker is not None:
+            self.broker.close()
+            self.broker = None
+        if self.use_broker:
+            self.broker = InferenceBroker(
+                self.model,
+                max_batch_size=self.broker_batch_size,
+                max_wait=self.broker_max_wait,
+            )
+
+    def transcribe(self, audio, *, process_queue, **options) -> dict:
+        if self.broker is None:
+            return self._transcribe(audio, process_queue, options)
+        with self.broker.job():
+            return self._transcribe(audio, process_queue, options)
+
+    def _transcribe(self, audio, process_queue, options: dict) -> dict:
+        return transcribe(
+            model=self.model,
+            audio=audio,
+            streaming=self.streaming,
+            broker=self.broker,
+            speculative=self.speculative,
+            cascade=self.cascade,
+            audio_cache=self.audio_cache,
+            process_queue=process_queue,
+            **options,
+        )
+
+    def stats(self) -> Optional[dict]:
+        return self.broker.stats() if self.broker is not None else None
+
+    def memory_bytes(self) -> int:
+        models = [self.model]
+        if self.speculative is not None:
+            models.append(self.speculative.draft_model)
+        if self.cascade is not None:
+            models.append(self.cascade.model)
+        return sum(state_dict_bytes(model) for model in models if model is not None)
+
+    def close(self):
+        if self.broker is not None:
+            self.broker.close()
+            self.broker = None
+        self.model = self.speculative = self.cascade = None
+
+
+class CTranslate2Backend(InferenceBackend):
+    """
+    The model converted for CTranslate2, run by faster-whisper (`pip install faster-whisper`).
+
+    faster-whisper runs its own decoding loop, so the options that tune `transcribe()`
+    (batch_size, no_speech_fast_threshold, repetition_guard) have no effect here, and a
+    cancelled job only stops after the segment being decoded.
+    """
+
+    name = "ctranslate2"
+
+    compute_types = dict(float32="float32", int8="int8", bf16="bfloat16")
+
+    def __init__(
+        self,
+        model_name: str,
+        model_dir: str,
+        precision: str = "float32",
+        *,
+        cpu_threads: int = 0,
+        num_workers: int = 1,
+    ):
+        super().__init__(model_name, model_dir, precision)
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+
+    def load(self):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError(
+                "WHISPER_BACKEND=ctranslate2 requires faster-whisper: pip install faster-whisper"
+            ) from e
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = WhisperModel(
+            self.model_name,
+            device=device,
+            compute_type=self.compute_types[self.requested_precision],
+            cpu_threads=self.cpu_threads,
+            num_workers=self.num_workers,
+            download_root=self.model_dir,
+        )
+        self.precision = self.requested_precision
+
+    def transcribe(
+        self,
+        audio,
+        *,
+        process_queue,
+        job_id=None,
+        end_callback=None,
+        verbose=None,
+        language=None,
+        condition_on_previous_text=True,
+        vad_filter=False,
+        temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+        compression_ratio_threshold=2.4,
+        logprob_threshold=-1.0,
+        no_speech_threshold=0.6,
+        initial_prompt=None,
+        cancel_token=None,
+        **ignored_options,
+    ) -> dict:
+        if isinstance(audio, np.ndarray):
+            audio = audio.astype(np.float32)
+
+        start_time = time.perf_counter()
+        segments, info = self.model.transcribe(
+            audio,
+            language=language,
+            task="transcribe",
+            temperature=(
+                list(temperature) if isinstance(temperature, (list, tuple)) else temperature
+            ),
+            compression_ratio_threshold=compression_ratio_threshold,
+            log_prob_threshold=logprob_threshold,
+            no_speech_threshold=no_speech_threshold,
+            condition_on_previous_text=condition_on_previous_text,
+            initial_prompt=initial_prompt,
+            vad_filter=vad_filter,
+        )
+
+        all_segments = []
+        # segments are decoded lazily while iterating, so stopping here stops the decoding
+        for segment in segments:
+            if (
+                cancel_token.is_cancelled()
+                if cancel_token is not None
+                else stop_requested(process_queue, job_id)
+            ):
+                break
+
+            text = segment.text
+            all_segments.append(
+                {
+                    "id": len(all_segments),
+                    "seek": segment.seek,
+                    "start": segment.start,
+                    "end": segment.end,
+                    "text": text,
+                    "tokens": list(segment.tokens),
+                    "temperature": segment.temperature,
+                    "avg_logprob": segment.avg_logprob,
+                    "compression_ratio": segment.compression_ratio,
+                    "no_speech_prob": segment.no_speech_prob,
+                }
+            )
+            if verbose:
+                process_queue.put(
+                    dict(
+                        channel="message",
+                        data=dict(start=segment.start, end=segment.end, text=text, copy=True),
+                        job_id=job_id,
+                    )
+                )
+            process_queue.put(
+                dict(
+                    channel="timer",
+                    data=dict(timer=int(segment.end * SAMPLE_RATE / HOP_LENGTH)),
+                    job_id=job_id,
+                )
+            )
+
+        stats = dict(
+            segments=len(all_segments), decode_seconds=time.perf_counter() - start_time
+        )
+        print(f"Transcription stats for job {job_id}: {stats}")
+
+        process_queue.put(dict(channel="message", job_id=job_id, data="end", stats=stats))
+        end_data = dict(
+            text="".join(segment["text"] for segment in all_segments),
+            segments=all_segments,
+            language=info.language,
+            stats=stats,
+        )
+        if end_callback:
+            end_callback(end_data)
+
+        return end_data
+
+
+def create_backend(
+    name: str, model_name: str, model_dir: str, precision: str = "float32", **kwargs
+):
+    """Instantiate the backend selected by `name`, e.g. from the WHISPER_BACKEND variable"""
+    if name == "pytorch":
+        return PyTorchBackend(model_name, model_dir, precision, **kwargs)
+    if name == "ctranslate2":
+        return CTranslate2Backend(model_name, model_dir, precision, **kwargs)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of {BACKENDS}")
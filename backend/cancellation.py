@@ -0,0 +1,64 @@
+import time
+from threading import Event, Lock
+from typing import Callable, List, Optional
+
+
+class TranscriptionCancelled(Exception):
+    """Raised inside a decode whose job was cancelled, to abandon the window being decoded"""
+
+
+class TranscriptionInterrupted(Exception):
+    """Raised when a job could not finish because the server is shutting down; it is resumed later"""
+
+
+class CancellationToken:
+    """
+    Tells a running job to stop. `transcribe()` checks the token before every window, before
+    every temperature fallback and before every decoder step, so a job stops within one decoder
+    step (or one encoder pass) of `cancel()`.
+
+    `event` may be any object with `set` and `is_set`, e.g. a `multiprocessing.Manager().Event()`
+    to cancel work running in another process.
+    """
+
+    def __init__(self, event=None):
+        self.event = event if event is not None else Event()
+        # time.monotonic() of the first cancel() on this token
+        self.cancelled_at: Optional[float] = None
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled_at is None:
+                self.cancelled_at = time.monotonic()
+            self.event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise TranscriptionCancelled()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """Call `callback` on cancel(), or right away if the token is already cancelled"""
+        with self._lock:
+            if not self.event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def latency(self) -> Optional[float]:
+        """Seconds since the token was cancelled in this process, if it was"""
+        if self.cancelled_at is None:
+            return None
+        return time.monotonic() - self.cancelled_at
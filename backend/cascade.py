@@ -0,0 +1,74 @@
+from dataclasses import dataclass, replace
+from threading import Lock
+from typing import List, Optional, TYPE_CHECKING
+
+import torch
+from whisper.decoding import DecodingOptions
+
+from cancellation import CancellationToken
+from window_decoding import WindowResult, decode_windows
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+
+
+@dataclass
+class CascadeBounds:
+    """A result of the fast model is kept if it is within all of these bounds"""
+
+    min_avg_logprob: Optional[float] = -0.5
+    max_compression_ratio: Optional[float] = 2.0
+    max_no_speech_prob: Optional[float] = 0.3
+
+
+class ModelCascade:
+    """
+    Decodes windows with a fast model first. Only the windows whose result is not confident
+    enough are decoded again by the main model, which `transcribe()` takes care of.
+
+    The fast model must share the tokenizer of the main model, since its tokens are used as
+    the prompt of the following windows. It is shared by all jobs, so its decodes are serialised.
+    """
+
+    def __init__(
+        self,
+        model: "Whisper",
+        model_name: str,
+        main_model_name: str,
+        bounds: CascadeBounds = CascadeBounds(),
+    ):
+        self.model = model
+        self.model_name = model_name
+        self.main_model_name = main_model_name
+        self.bounds = bounds
+        self._lock = Lock()
+
+    def decode(
+        self,
+        mel: torch.Tensor,
+        options: DecodingOptions,
+        repetition_guard: bool = False,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> List[WindowResult]:
+        """Decode a batch of mel windows with the fast model"""
+        with self._lock:
+            results = decode_windows(self.model, mel, options, repetition_guard, cancel_token)
+        return [replace(result, model=self.model_name) for result in results]
+
+    def accepts(self, result: WindowResult) -> bool:
+        bounds = self.bounds
+        if result.repetition_aborted:
+            return False
+        if bounds.min_avg_logprob is not None and result.avg_logprob < bounds.min_avg_logprob:
+            return False
+        if (
+            bounds.max_compression_ratio is not None
+            and result.compression_ratio > bounds.max_compression_ratio
+        ):
+            return False
+        if (
+            bounds.max_no_speech_prob is not None
+            and result.no_speech_prob > bounds.max_no_speech_prob
+        ):
+            return False
+        return True
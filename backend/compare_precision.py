@@ -0,0 +1,101 @@
+"""
+Compare the speed and accuracy of the precision modes on one recording.
+
+    python compare_precision.py recording.mp3 --model large-v2 --reference recording.txt
+
+Every mode transcribes the file with the server's decode settings, read from the same WHISPER_*
+variables as the server. The word error rate is measured against the reference transcript if one
+is given, otherwise against the float32 output.
+
+The speedups depend on the CPU (bf16 only pays off with AVX512-BF16 or AMX) and the accuracy on
+the model and the language, so run it with the served model on the host that serves it.
+"""
+import argparse
+import os
+import time
+from queue import Queue
+
+import torch
+import whisper
+from whisper.audio import SAMPLE_RATE, load_audio
+
+from LangModel import env_decode_settings
+from precision import PRECISION_MODES, apply_precision
+from transcribe import transcribe
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    reference_words = reference.lower().split()
+    hypothesis_words = hypothesis.lower().split()
+    if not reference_words:
+        return float(bool(hypothesis_words))
+
+    # word-level edit distance, one row at a time
+    previous = list(range(len(hypothesis_words) + 1))
+    for i, reference_word in enumerate(reference_words, 1):
+        current = [i]
+        for j, hypothesis_word in enumerate(hypothesis_words, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (reference_word != hypothesis_word),
+                )
+            )
+        previous = current
+
+    return previous[-1] / len(reference_words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("audio")
+    parser.add_argument("--model", default=os.getenv("WHISPER_MODEL_NAME", "tiny"))
+    parser.add_argument("--model-dir", default=os.getenv("WHISPER_MODEL_DIR"))
+    parser.add_argument("--language", default="de")
+    parser.add_argument("--modes", nargs="+", default=list(PRECISION_MODES), choices=PRECISION_MODES)
+    parser.add_argument("--reference", help="text file with the reference transcript")
+    args = parser.parse_args()
+
+    audio = load_audio(args.audio)
+    duration = len(audio) / SAMPLE_RATE
+    reference = None
+    if args.reference:
+        with open(args.reference, encoding="utf-8") as f:
+            reference = f.read()
+
+    rows = []
+    for mode in args.modes:
+        model, active = apply_precision(
+            whisper.load_model(args.model, device="cpu", download_root=args.model_dir), mode
+        )
+        start = time.perf_counter()
+        result = transcribe(
+            model,
+            audio,
+            verbose=None,
+            fp16=False,
+            language=args.language,
+            process_queue=Queue(),
+            **env_decode_settings(),
+        )
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = result["text"]
+        rows.append((mode, active, seconds, word_error_rate(reference, result["text"])))
+        del model
+
+    baseline = next((seconds for mode, _, seconds, _ in rows if mode == "float32"), None)
+    print(f"{args.model} on {duration:.0f} s of audio, {torch.get_num_threads()} threads")
+    print("| mode | runs as | seconds | realtime factor | speedup | WER |")
+    print("|---|---|---|---|---|---|")
+    for mode, active, seconds, wer in rows:
+        speedup = f"{baseline / seconds:.2f}x" if baseline else "-"
+        print(
+            f"| {mode} | {active} | {seconds:.1f} | {seconds / duration:.3f} | {speedup} "
+            f"| {wer:.2%} |"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Iterator, List, Optional, Union, TYPE_CHECKING
+
+import torch
+from whisper.audio import N_FRAMES
+from whisper.decoding import DecodingOptions, DecodingResult
+
+from cancellation import CancellationToken, TranscriptionCancelled
+from window_decoding import decode_windows
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingDecode:
+    """A batch of windows submitted by one job, waiting for the broker to encode or decode it."""
+
+    segments: Optional[torch.Tensor]  # None for a function call
+    options: Optional[DecodingOptions]  # None to only run the encoder
+    repetition_guard: bool = False
+    function: Optional[Callable[[], Any]] = None  # run on its own instead of batched
+    cancel_token: Optional[CancellationToken] = None  # of the job that submitted the windows
+    done: Event = field(default_factory=Event)
+    results: Optional[Union[List[DecodingResult], torch.Tensor, Any]] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def n_windows(self) -> int:
+        return self.segments.shape[0] if self.segments is not None else 0
+
+
+class InferenceBroker:
+    """
+    Owns the Whisper model and runs all decoding of all jobs on a single thread.
+
+    Windows submitted by concurrent jobs within `max_wait` seconds of each other are collected
+    into one batch: the encoder runs once over every mel window in the batch, and the decoder
+    runs once per group of windows that share the same `DecodingOptions`. Each job gets back
+    exactly the `DecodingResult`s of the windows it submitted.
+
+    The prompt is part of the options, so windows conditioned on the previous text of their job
+    are decoded one job at a time: Whisper's decoder has no padding mask, and prompts of
+    different lengths cannot share a pass without changing the results. Decoder passes are
+    shared when the windows are not conditioned on their previous text.
+
+    Jobs register with `job()` while they run. A single job has nobody to share a batch with,
+    so its windows are run right away instead of waiting `max_wait` for other jobs.
+    """
+
+    def __init__(self, model: "Whisper", max_batch_size: int = 8, max_wait: float = 0.05):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_count = 0
+        self.window_count = 0
+        self._requests: Queue = Queue()
+        self._stats_lock = Lock()
+        self._jobs = 0
+        self._jobs_lock = Lock()
+        self._thread = Thread(target=self._run, name="inference-broker", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def job(self) -> Iterator[None]:
+        """Register a job that submits windows while the block runs"""
+        with self._jobs_lock:
+            self._jobs += 1
+        try:
+            yield
+        finally:
+            with self._jobs_lock:
+                self._jobs -= 1
+
+    def decode(
+        self,
+        segments: torch.Tensor,
+        options: DecodingOptions,
+        repetition_guard: bool = False,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Union[DecodingResult, List[DecodingResult]]:
+        """
+        Drop-in replacement for `decode_windows` that blocks until the shared batch is done. A
+        cancelled job gets `TranscriptionCancelled` right away, and its windows are ended in the
+        batch while the windows of the other jobs decode on.
+        """
+        single = segments.ndim == 2
+        if single:
+            segments = segments.unsqueeze(0)
+
+        results = self._submit(
+            PendingDecode(
+                segments=segments,
+                options=options,
+                repetition_guard=repetition_guard,
+                cancel_token=cancel_token,
+            )
+        )
+        return results[0] if single else results
+
+    def encode(
+        self, segments: torch.Tensor, cancel_token: Optional[CancellationToken] = None
+    ) -> torch.Tensor:
+        """Encoder features of a batch of mel windows, computed together with the other jobs"""
+        return self._submit(
+            PendingDecode(segments=segments, options=None, cancel_token=cancel_token)
+        )
+
+    def run_exclusive(self, function: Callable[[], Any]) -> Any:
+        """
+        Call `function` on the broker thread between two batches and return its result. For
+        work that uses the model in a way that cannot be batched with the other jobs.
+        """
+        return self._submit(PendingDecode(segments=None, options=None, function=function))
+
+    def _submit(self, request: PendingDecode):
+        token = request.cancel_token
+        if token is not None:
+            token.raise_if_cancelled()
+            # stop waiting for the batch as soon as the job is cancelled
+            token.add_callback(request.done.set)
+        self._requests.put(request)
+        try:
+            request.done.wait()
+        finally:
+            if token is not None:
+                token.remove_callback(request.done.set)
+
+        if token is not None:
+            token.raise_if_cancelled()
+        if request.error is not None:
+            raise request.error
+
+        return request.results
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(
+                batches=self.batch_count,
+                windows=self.window_count,
+                avg_batch_size=self.window_count / self.batch_count
+                if self.batch_count
+                else 0.0,
+            )
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _collect(self, first: PendingDecode) -> List[PendingDecode]:
+        pending = [first]
+        n_windows = first.n_windows
+        # with fewer than two jobs there is nothing to wait for
+        deadline = time.monotonic() + (self.max_wait if self._jobs > 1 else 0.0)
+
+        while n_windows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except Empty:
+                break
+            if request is None:
+                # shutdown requested; finish this batch first
+                self._requests.put(None)
+                break
+            pending.append(request)
+            n_windows += request.n_windows
+
+        return pending
+
+    def _run(self):
+        while True:
+            first = self._requests.get()
+            if first is None:
+                break
+
+            pending = self._collect(first)
+            try:
+                self._run_batch(pending)
+            except BaseException as e:
+                logger.error(f"[BROKER] Batch of {len(pending)} requests failed: {e}")
+                for request in pending:
+                    if not request.done.is_set():
+                        request.error = e
+                        request.done.set()
+
+    @torch.no_grad()
+    def _encode(self, pending: List[PendingDecode]) -> List[torch.Tensor]:
+        """Run the encoder once over all mel windows, passing already encoded features through"""
+        features: List[Optional[torch.Tensor]] = [None] * len(pending)
+        mel_requests = [
+            i
+            for i, request in enumerate(pending)
+            if request.segments.shape[-1] == N_FRAMES
+        ]
+
+        for i, request in enumerate(pending):
+            if i not in mel_requests:
+                features[i] = request.segments
+
+        if mel_requests:
+            mel = torch.cat([pending[i].segments for i in mel_requests])
+            encoded = self.model.encoder(mel)
+            sizes = [pending[i].segments.shape[0] for i in mel_requests]
+            for i, chunk in zip(mel_requests, encoded.split(sizes)):
+                features[i] = chunk
+
+        return features
+
+    def _run_batch(self, pending: List[PendingDecode]):
+        for request in pending:
+            if request.function is not None:
+                try:
+                    request.results = request.function()
+                except Exception as e:
+                    request.error = e
+                finally:
+                    request.done.set()
+
+        pending = [request for request in pending if request.function is None]
+        for request in pending:
+            if request.cancel_token is not None and request.cancel_token.is_cancelled():
+                request.error = TranscriptionCancelled()
+                request.done.set()
+        pending = [request for request in pending if not request.done.is_set()]
+        if not pending:
+            return
+
+        features = self._encode(pending)
+        for i, request in enumerate(pending):
+            if request.options is None:
+                request.results = features[i]
+                request.done.set()
+
+        # DecodingOptions hold lists (e.g. the prompt), so group by equality instead of hashing
+        groups: List[List[int]] = []
+        for i, request in enumerate(pending):
+            if request.options is None:
+                continue
+            for group in groups:
+                first = pending[group[0]]
+                if (first.options, first.repetition_guard) == (
+                    request.options,
+                    request.repetition_guard,
+                ):
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+
+        for group in groups:
+            try:
+                batch = torch.cat([features[i] for i in group])
+                first = pending[group[0]]
+                results = decode_windows(
+                    self.model,
+                    batch,
+                    first.options,
+                    first.repetition_guard,
+                    cancel_token=[
+                        pending[i].cancel_token
+                        for i in group
+                        for _ in range(pending[i].segments.shape[0])
+                    ],
+                )
+
+                offset = 0
+                for i in group:
+                    n = pending[i].segments.shape[0]
+                    pending[i].results = results[offset : offset + n]
+                    offset += n
+            except Exception as e:
+                for i in group:
+                    pending[i].error = e
+            finally:
+                for i in group:
+                    pending[i].done.set()
+
+        with self._stats_lock:
+            self.batch_count += 1
+            self.window_count += sum(request.n_windows for request in pending)
@@ -0,0 +1,57 @@
+import json
+import uuid
+from threading import Lock
+from typing import List, Optional, Tuple
+
+# states after which a job has no more events
+FINAL_STATES = ("completed", "failed", "stopped")
+
+
+class JobEventLog:
+    """
+    The progress events of one run of a job, in the order they happened: "state" changes,
+    decoded "segment"s and "timer" ticks. Every event has the id "<log id>:<sequence number>",
+    so that a client that lost its connection continues after the last event it received, and
+    notices when the job was started over under a new log (e.g. after a restart of the server).
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self._events: List[dict] = []
+        self._lock = Lock()
+
+    def append(self, event: str, **data) -> int:
+        with self._lock:
+            seq = len(self._events) + 1
+            self._events.append(dict(id=f"{self.id}:{seq}", event=event, data=data))
+            return seq
+
+    def since(self, seq: int) -> List[dict]:
+        with self._lock:
+            return self._events[seq:]
+
+    @property
+    def finished(self) -> bool:
+        with self._lock:
+            return any(
+                event["event"] == "state" and event["data"]["state"] in FINAL_STATES
+                for event in self._events[-1:]
+            )
+
+    def resume_from(self, last_event_id: Optional[str]) -> Tuple[int, bool]:
+        """
+        The sequence number to continue after for the id of the last event a client received,
+        and whether the client has to reset, because its events came from another log
+        """
+        if not last_event_id:
+            return 0, False
+        log_id, _, seq = last_event_id.partition(":")
+        if log_id != self.id or not seq.isdigit():
+            return 0, True
+        with self._lock:
+            return min(int(seq), len(self._events)), False
+
+
+def format_event(event: dict) -> str:
+    """An event in the text/event-stream format"""
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
@@ -0,0 +1,375 @@
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+JOB_QUEUE_BACKENDS = ("sqlite",)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+@dataclass
+class QueuedJob:
+    id: str
+    payload: dict
+    priority: int = 0
+    state: str = QUEUED
+    attempts: int = 0
+    worker: Optional[str] = None
+    lease_until: Optional[float] = None
+    cancel_requested: bool = False
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    @property
+    def kind(self) -> Optional[str]:
+        return self.payload.get("kind")
+
+    def info(self) -> dict:
+        return dict(
+            id=self.id,
+            kind=self.kind,
+            state=self.state,
+            priority=self.priority,
+            model=self.payload.get("model_name"),
+            file_name=self.payload.get("file_name"),
+            worker=self.worker,
+            attempts=self.attempts,
+            submitted_at=self.created_at,
+        )
+
+
+class JobQueue(ABC):
+    """
+    A queue of transcription jobs shared by the API and any number of worker processes, on this
+    or other hosts. A worker claims a job with a lease, which it renews with heartbeats while the
+    job runs. When a worker dies, its lease runs out and the job is delivered to the next worker
+    that claims one, up to `max_attempts` times.
+
+    Workers append the segments of a running job as they are decoded, for the API to read, and
+    write the result back when the job finished.
+    """
+
+    def __init__(self, max_attempts: int = 3):
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def enqueue(self, job_id: str, payload: dict, priority: int = 0) -> QueuedJob:
+        """Queue a job; jobs with a lower `priority` are claimed first"""
+
+    @abstractmethod
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[QueuedJob]:
+        """The next job to run, or None if no job is waiting"""
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float) -> bool:
+        """Renew the lease; False if the worker lost the job or the job should be cancelled"""
+
+    @abstractmethod
+    def stop_requested(self, job_id: str, worker_id: str) -> bool:
+        """Like `heartbeat`, but only looks whether the job was lost or cancelled"""
+
+    @abstractmethod
+    def append_messages(self, job_id: str, worker_id: str, messages: List[dict]):
+        """Add segments the worker decoded to those of the job"""
+
+    @abstractmethod
+    def messages(self, job_id: str, after: int = 0) -> List[dict]:
+        """The segments of a running job from index `after` on"""
+
+    @abstractmethod
+    def delete_messages(self, job_id: str):
+        """Forget the segments of a job whose result was collected"""
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        """Store the result of a job; False if the worker lost the job"""
+
+    @abstractmethod
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """Mark a job as failed; False if the worker lost the job"""
+
+    @abstractmethod
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a waiting job, or ask the worker of a running one to stop"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[QueuedJob]:
+        """The job, or None if the queue does not know it"""
+
+    @abstractmethod
+    def jobs(self, states=(QUEUED, RUNNING)) -> List[QueuedJob]:
+        """Jobs in the given states, in the order they run"""
+
+    @abstractmethod
+    def take_results(self) -> List[QueuedJob]:
+        """Finished jobs that were not taken yet; each finished job is returned once"""
+
+    def position(self, job_id: str) -> Optional[int]:
+        for position, job in enumerate(self.jobs(states=(QUEUED,))):
+            if job.id == job_id:
+                return position
+        return None
+
+    def close(self):
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    The job queue in a SQLite database, for a single host or hosts sharing the file over a
+    file system with working locks. Every call uses its own connection, so the queue can be used
+    from any thread and process.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        super().__init__(max_attempts)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT UNIQUE NOT NULL,
+                    payload TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_until REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    taken INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (state, priority, seq);
+                CREATE TABLE IF NOT EXISTS messages (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction, which holds the database lock from the start"""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> QueuedJob:
+        return QueuedJob(
+            id=row["id"],
+            payload=json.loads(row["payload"]),
+            priority=row["priority"],
+            state=row["state"],
+            attempts=row["attempts"],
+            worker=row["worker"],
+            lease_until=row["lease_until"],
+            cancel_requested=bool(row["cancel_requested"]),
+            result=json.loads(row["result"]) if row["result"] else None,
+            error=row["error"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+        )
+
+    def enqueue(self, job_id: str, payload: dict, priority: int = 0) -> QueuedJob:
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs (id, payload, priority, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), priority, QUEUED, now, now),
+            )
+        return QueuedJob(job_id, payload, priority, created_at=now, updated_at=now)
+
+    def _expire_leases(self, db: sqlite3.Connection, now: float):
+        """Requeue the running jobs of workers that stopped sending heartbeats"""
+        db.execute(
+            "UPDATE jobs SET state = ?, error = ?, updated_at = ? "
+            "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+            (FAILED, "The job's worker stopped responding", now, RUNNING, now, self.max_attempts),
+        )
+        db.execute(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE state = ? AND lease_until < ?",
+            (QUEUED, now, RUNNING, now),
+        )
+        # jobs that were cancelled while their worker was gone
+        db.execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ? AND cancel_requested = 1",
+            (CANCELLED, now, QUEUED),
+        )
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[QueuedJob]:
+        now = time.time()
+        with self._transaction() as db:
+            self._expire_leases(db, now)
+            row = db.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY priority, seq LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                (RUNNING, worker_id, now + lease_seconds, now, row["id"]),
+            )
+            # a redelivered job starts its messages over
+            db.execute("DELETE FROM messages WHERE job_id = ?", (row["id"],))
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._job(row)
+
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND state = ? AND cancel_requested = 0",
+                (now + lease_seconds, now, job_id, worker_id, RUNNING),
+            ).rowcount
+        return updated == 1
+
+    def stop_requested(self, job_id: str, worker_id: str) -> bool:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT 1 FROM jobs "
+                "WHERE id = ? AND worker = ? AND state = ? AND cancel_requested = 0",
+                (job_id, worker_id, RUNNING),
+            ).fetchone()
+        return row is None
+
+    def append_messages(self, job_id: str, worker_id: str, messages: List[dict]):
+        if not messages:
+            return
+        with self._transaction() as db:
+            start = db.execute(
+                "SELECT COUNT(*) FROM messages WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            db.executemany(
+                "INSERT INTO messages (job_id, idx, data) VALUES (?, ?, ?)",
+                [(job_id, start + i, json.dumps(data)) for i, data in enumerate(messages)],
+            )
+
+    def messages(self, job_id: str, after: int = 0) -> List[dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT data FROM messages WHERE job_id = ? AND idx >= ? ORDER BY idx",
+                (job_id, after),
+            ).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def delete_messages(self, job_id: str):
+        with self._transaction() as db:
+            db.execute("DELETE FROM messages WHERE job_id = ?", (job_id,))
+
+    def _finish(self, job_id: str, worker_id: str, state: str, result=None, error=None) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            # a job that was asked to stop keeps what it transcribed until then
+            updated = db.execute(
+                "UPDATE jobs SET state = CASE WHEN cancel_requested = 1 THEN ? ELSE ? END, "
+                "result = ?, error = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                (
+                    CANCELLED,
+                    state,
+                    json.dumps(result) if result is not None else None,
+                    error,
+                    now,
+                    job_id,
+                    worker_id,
+                    RUNNING,
+                ),
+            ).rowcount
+        return updated == 1
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        return self._finish(job_id, worker_id, COMPLETED, result=result)
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, FAILED, error=error)
+
+    def cancel(self, job_id: str) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            cancelled = db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state = ?",
+                (CANCELLED, now, job_id, QUEUED),
+            ).rowcount
+            cancelled += db.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND state = ?",
+                (now, job_id, RUNNING),
+            ).rowcount
+        return cancelled == 1
+
+    def get(self, job_id: str) -> Optional[QueuedJob]:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def jobs(self, states=(QUEUED, RUNNING)) -> List[QueuedJob]:
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT * FROM jobs WHERE state IN ({', '.join('?' * len(states))}) "
+                "ORDER BY priority, seq",
+                tuple(states),
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def take_results(self) -> List[QueuedJob]:
+        with self._transaction() as db:
+            rows = db.execute(
+                f"SELECT * FROM jobs WHERE taken = 0 AND state IN "
+                f"({', '.join('?' * len(FINISHED_STATES))}) ORDER BY seq",
+                FINISHED_STATES,
+            ).fetchall()
+            db.executemany("UPDATE jobs SET taken = 1 WHERE id = ?", [(row["id"],) for row in rows])
+        return [self._job(row) for row in rows]
+
+
+def create_job_queue(url: str, max_attempts: int = 3) -> JobQueue:
+    """
+    The job queue at `url` (from the JOB_QUEUE_URL variable): sqlite:///jobs.db for a path
+    relative to the working directory, sqlite:////shared/jobs.db for an absolute one
+    """
+    scheme, _, location = url.partition("://")
+    if scheme == "sqlite" and location.startswith("/") and len(location) > 1:
+        return SQLiteJobQueue(location[1:], max_attempts=max_attempts)
+    raise ValueError(f"Unsupported job queue {url!r}, expected one of {JOB_QUEUE_BACKENDS}")
@@ -0,0 +1,195 @@
+import heapq
+import itertools
+import logging
+import time
+import traceback
+from dataclasses import dataclass, field
+from threading import Condition, Event, Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+from job_events import JobEventLog
+
+logger = logging.getLogger(__name__)
+
+# lower runs first; interactive uploads go before webhook and batch jobs
+PRIORITIES = dict(interactive=0, batch=10)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+STOPPED = "stopped"
+
+
+@dataclass
+class Job:
+    """The state of one transcription job, from submission until it finished"""
+
+    id: str
+    run: Callable[["Job"], None]
+    priority: int = PRIORITIES["interactive"]
+    kind: str = "upload"
+    file_name: str = ""
+    model_name: Optional[str] = None
+    # the transcript a retranscribe job changes
+    transcript_id: Optional[str] = None
+    state: str = QUEUED
+    text: str = ""
+    chunks: List[dict] = field(default_factory=list)
+    stats: Optional[dict] = None
+    error: Optional[str] = None
+    traceback: Optional[str] = None
+    stop_requested: bool = False
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # held while the job's messages are collected into text and chunks
+    lock: Lock = field(default_factory=Lock, repr=False)
+    done: Event = field(default_factory=Event, repr=False)
+    # state changes, and the segments of the job as they are collected, for streaming clients
+    events: JobEventLog = field(default_factory=JobEventLog, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.done.is_set()
+
+    def info(self) -> dict:
+        return dict(
+            id=self.id,
+            kind=self.kind,
+            state=self.state,
+            priority=self.priority,
+            model=self.model_name,
+            file_name=self.file_name,
+            submitted_at=self.submitted_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+        )
+
+
+class JobScheduler:
+    """
+    Runs submitted jobs on `concurrency` worker threads, highest priority first and in
+    submission order within a priority. Finished jobs are kept for `keep_finished` more jobs, so
+    that clients polling a job still see how it ended.
+    """
+
+    def __init__(self, concurrency: int = 1, keep_finished: int = 100):
+        self.concurrency = max(1, concurrency)
+        self.keep_finished = keep_finished
+        self._jobs: Dict[str, Job] = dict()
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._closed = False
+        self._workers = [
+            Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, job: Job) -> Job:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The job scheduler is closed")
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (job.priority, next(self._counter), job))
+            job.events.append("state", state=QUEUED)
+            self._changed.notify()
+        logger.info(
+            f"[SCHEDULER] Queued job {job.id} ({job.kind}, priority {job.priority}), "
+            f"queue depth {self.depth()}"
+        )
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job_id: str) -> Optional[int]:
+        """0 for the job that runs next, None if the job is not waiting"""
+        with self._lock:
+            for position, (_, _, job) in enumerate(sorted(self._queue)):
+                if job.id == job_id:
+                    return position
+        return None
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def running(self) -> List[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.state == RUNNING]
+
+    def queued(self) -> List[Job]:
+        with self._lock:
+            return [job for _, _, job in sorted(self._queue)]
+
+    def cancel(self, job_id: str) -> bool:
+        """Take a waiting job out of the queue; running jobs have to be stopped by their runner"""
+        with self._lock:
+            for i, (_, _, job) in enumerate(self._queue):
+                if job.id == job_id:
+                    del self._queue[i]
+                    heapq.heapify(self._queue)
+                    break
+            else:
+                return False
+            job.stop_requested = True
+            self._finish(job, STOPPED)
+        return True
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for _, _, job in self._queue:
+                self._finish(job, STOPPED)
+            self._queue.clear()
+            self._changed.notify_all()
+
+    def _finish(self, job: Job, state: str):
+        """Mark a job as finished and forget the oldest finished jobs; the lock must be held"""
+        job.state = state
+        job.finished_at = time.time()
+        if state == FAILED:
+            job.events.append("state", state=state, error=job.error)
+        else:
+            job.events.append("state", state=state)
+        job.done.set()
+
+        finished = [other for other in self._jobs.values() if other.finished]
+        for other in finished[: max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[other.id]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+                _, _, job = heapq.heappop(self._queue)
+                job.state = RUNNING
+                job.started_at = time.time()
+                job.events.append("state", state=RUNNING)
+
+            logger.info(f"[SCHEDULER] Starting job {job.id}, {self.depth()} waiting")
+            try:
+                job.run(job)
+            except Exception as e:
+                logger.error(f"[SCHEDULER] Job {job.id} failed: {e}")
+                job.error = job.error or str(e)
+                job.traceback = job.traceback or traceback.format_exc()
+
+            with self._lock:
+                if job.error:
+                    state = FAILED
+                elif job.stop_requested:
+                    state = STOPPED
+                else:
+                    state = COMPLETED
+                self._finish(job, state)
+            logger.info(f"[SCHEDULER] Job {job.id} {state}")
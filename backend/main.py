@@ -1,9 +1,12 @@
+import asyncio
 import os
 import re
 import ssl
 import smtplib
 import subprocess
 import tempfile
+import threading
+import time
 import traceback
 import uuid
 import logging
@@ -11,12 +14,11 @@ from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta
 from email.message import EmailMessage
 from pathlib import Path
-from typing import Optional, Any, Dict, Tuple, List
+from typing import Optional, Any, Dict, Tuple, List, TYPE_CHECKING
 
 import bcrypt
 import jwt
 import requests
-import torch
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import (
@@ -33,11 +35,26 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field
 from starlette import status
-from starlette.responses import FileResponse, Response
+from starlette.responses import FileResponse, Response, StreamingResponse
 from tinydb import Query
 from tinydb import TinyDB
 
-from LangModel import LangModel
+from cancellation import TranscriptionInterrupted
+from job_events import FINAL_STATES, JobEventLog, format_event
+from job_queue import CANCELLED, create_job_queue
+from job_scheduler import (
+    COMPLETED,
+    FAILED,
+    PRIORITIES,
+    QUEUED,
+    RUNNING,
+    STOPPED,
+    Job,
+    JobScheduler,
+)
+
+if TYPE_CHECKING:
+    from LangModel import LangModel
 
 load_dotenv()
 
@@ -105,25 +122,115 @@ WHISPER_DOWNLOAD_DIR = os.getenv("WHISPER_MODEL_DIR")  # optional cache dir
 WHISPER_LANGUAGE = os.getenv("WHISPER_LANGUAGE", "").strip()
 # On Jetson you may prefer fp16=False for stability; set to "1" to force fp16 when CUDA is available
 WHISPER_FP16 = os.getenv("WHISPER_FP16", "0") in {"1", "true", "True"}
+# Model for webhook jobs that do not pass ?model=...; empty uses WHISPER_MODEL_NAME
+WEBHOOK_WHISPER_MODEL = os.getenv("WEBHOOK_WHISPER_MODEL", "").strip() or None
+# Number of jobs transcribed at the same time; further jobs wait in a priority queue
+WHISPER_JOB_CONCURRENCY = int(os.getenv("WHISPER_JOB_CONCURRENCY", "1"))
+# Distributed mode: this app only queues the jobs in the shared queue (e.g.
+# sqlite:////shared/jobs.db) and queue_worker.py processes on any host transcribe them
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "").strip()
+# Jobs whose worker stopped responding are handed to another worker up to this many times
+JOB_QUEUE_MAX_ATTEMPTS = int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", "3"))
+JOB_QUEUE_POLL_SECONDS = 2.0
+# How often the progress event streams look for new events of their job
+EVENT_STREAM_POLL_SECONDS = float(os.getenv("EVENT_STREAM_POLL_SECONDS", "0.25"))
+EVENT_STREAM_KEEPALIVE_SECONDS = 15.0
+# The cache of decoded audio the workers fill in distributed mode, to drop the entries of
+# deleted transcripts from it
+WHISPER_AUDIO_CACHE_DIR = os.getenv("WHISPER_AUDIO_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "temp", "audio_cache"
+)
+WHISPER_AUDIO_CACHE_MB = float(os.getenv("WHISPER_AUDIO_CACHE_MB", "2048"))
 
 # ----------------------------
 # App state
 # ----------------------------
-lang_model: Optional[LangModel] = None
+lang_model: Optional["LangModel"] = None
 http_session = requests.Session()
 
+# Set WHISPER_WARMUP=0 to skip the warmup decode after the model is loaded
+WHISPER_WARMUP = os.getenv("WHISPER_WARMUP", "1") in {"1", "true", "True"}
+
+# The model is loaded once in the background, so the server answers while it loads
+model_ready = threading.Event()
+# set when loading finished, also if it failed
+startup_finished = threading.Event()
+startup_state = dict(
+    stage="starting",
+    started_at=time.time(),
+    # seconds spent in each finished stage
+    stages={},
+    error=None,
+)
+_stage_started = time.perf_counter()
+
+
+def set_startup_stage(stage: str):
+    global _stage_started
+    now = time.perf_counter()
+    startup_state["stages"][startup_state["stage"]] = round(now - _stage_started, 2)
+    startup_state["stage"] = stage
+    _stage_started = now
+    logger.info(f"[startup] Stage: {stage}")
+
+
+def load_model_in_background():
+    global lang_model
+    try:
+        set_startup_stage("importing")
+        # torch and whisper are only imported here, so that the server starts right away
+        from LangModel import LangModel
+
+        set_startup_stage("loading_model")
+        model = LangModel()
+        logger.info(f"[startup] LangModel loaded with model: {model.model_name}, cuda: {model.cuda}")
+
+        if WHISPER_WARMUP:
+            set_startup_stage("warming_up")
+            model.warmup()
+
+        lang_model = model
+        set_startup_stage("ready")
+        model_ready.set()
+        try:
+            resume_pending_jobs()
+        except Exception as e:
+            logger.error(f"[startup] Resuming the pending jobs failed: {e}")
+    except Exception as e:
+        logger.error(f"[startup] Loading the model failed: {e}")
+        logger.error(traceback.format_exc())
+        startup_state["error"] = str(e)
+        set_startup_stage("failed")
+    finally:
+        startup_finished.set()
+
+
+def require_model_ready():
+    if not model_ready.is_set():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Model not ready: {startup_state['stage']}",
+        )
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load the language model
-    global lang_model
-    print("[startup] Initializing LangModel...")
-    lang_model = LangModel()
-    print(f"[startup] LangModel loaded with model: {lang_model.model_name}")
-    print(f"[startup] torch.cuda.is_available()={torch.cuda.is_available()}")
+    if job_queue is not None:
+        # the workers load the model, the app only needs the queue
+        logger.info(f"[startup] Distributed mode, queueing jobs in {JOB_QUEUE_URL}")
+        set_startup_stage("ready")
+        model_ready.set()
+        startup_finished.set()
+        threading.Thread(target=collect_queue_results_loop, name="queue-results", daemon=True).start()
+    else:
+        threading.Thread(target=load_model_in_background, name="model-loader", daemon=True).start()
 
     yield
 
+    results_collector_stop.set()
+    scheduler.close()
+    if lang_model is not None and lang_model.worker_pool is not None:
+        lang_model.worker_pool.close()
     http_session.close()
 
 
@@ -170,6 +277,17 @@ transcript_model = Query()
 transcripts = db.table("transcribes")
 job_db = db.table("jobs")
 
+scheduler = JobScheduler(concurrency=WHISPER_JOB_CONCURRENCY)
+job_queue = (
+    create_job_queue(JOB_QUEUE_URL, max_attempts=JOB_QUEUE_MAX_ATTEMPTS) if JOB_QUEUE_URL else None
+)
+results_collector_stop = threading.Event()
+# held while a transcript is read and written back with a re-transcribed range
+transcript_lock = threading.Lock()
+# progress events of the jobs on the distributed workers, read from the job queue
+queued_job_events: Dict[str, dict] = dict()
+queued_job_events_lock = threading.Lock()
+
 
 def hash_password(pw):
     pwhash = bcrypt.hashpw(pw.encode("utf8"), bcrypt.gensalt())
@@ -190,18 +308,6 @@ headers = {
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 last_request: datetime.date = None
 
-import torch
-print(f"cuda: {torch.cuda.torch.cuda.is_available()}" )
-
-lang_model = LangModel()
-
-transcription_in_progress = False
-transcription_text = ""
-transcription_chunks = []
-transcription_file_name = ""
-transcription_error = None
-transcription_error_traceback = None
-
 
 class Token(BaseModel):
     access_token: str
@@ -436,58 +542,135 @@ def stream_download(url: str, suffix: str = ".mp4") -> str:
         return temp_path
 
 
-def transcribe_with_whisper(video_path: str) -> str:
+def transcribe_with_whisper(video_path: str, model_name: Optional[str] = None) -> str:
     """Transcribe using openai-whisper through the LangModel."""
     logger.info(f"[TRANSCRIBE] Starting transcription of file: {video_path}")
 
+    if job_queue is not None:
+        result = transcribe_on_queue_workers(video_path, model_name)
+    else:
+        result = transcribe_in_process(video_path, model_name)
+
+    text = (result.get("text") or "").strip()
+    if text:
+        logger.info(f"[TRANSCRIBE] Extracted text: {len(text)} characters")
+        logger.debug(f"[TRANSCRIBE] Text preview: {text[:200]}...")
+        return text
+
+    # Very rare: rebuild from segments
+    logger.warning("[TRANSCRIBE] No text found, attempting to rebuild from segments")
+    segs = result.get("segments") or []
+    logger.info(f"[TRANSCRIBE] Found {len(segs)} segments")
+
+    rebuilt_text = "\n".join(s.get("text", "").strip() for s in segs if s.get("text"))
+    logger.info(f"[TRANSCRIBE] Rebuilt text: {len(rebuilt_text)} characters")
+
+    return rebuilt_text
+
+
+def transcribe_on_queue_workers(video_path: str, model_name: Optional[str] = None) -> dict:
+    """Queue the file for the distributed workers and wait for their result"""
+    job_id = str(uuid.uuid4())
+    job_queue.enqueue(
+        job_id,
+        dict(
+            kind="webhook",
+            audio_file=os.path.abspath(video_path),
+            file_name=os.path.basename(video_path),
+            model_name=model_name,
+        ),
+        # webhook jobs wait behind interactive uploads
+        priority=PRIORITIES["batch"],
+    )
+    logger.info(f"[TRANSCRIBE] Queued as job {job_id} at position {job_queue.position(job_id)}")
+
+    job = job_queue.get(job_id)
+    while not job.finished:
+        time.sleep(JOB_QUEUE_POLL_SECONDS)
+        job = job_queue.get(job_id)
+
+    if job.state != "completed":
+        logger.error(f"[TRANSCRIBE] Job {job_id} {job.state}: {job.error}")
+        raise RuntimeError(f"Transcription job {job_id} {job.state}: {job.error}")
+    logger.info(f"[TRANSCRIBE] Job {job_id} completed by worker {job.worker}")
+    logger.info(f"[TRANSCRIBE] Job stats: {job.result.get('stats')}")
+    return job.result
+
+
+def transcribe_in_process(video_path: str, model_name: Optional[str] = None) -> dict:
+    # webhooks are accepted while the model is still loading
+    startup_finished.wait()
     if lang_model is None or lang_model.model is None:
         logger.error("[TRANSCRIBE] LangModel not loaded")
         raise RuntimeError("LangModel not loaded")
 
-    logger.info(
-        f"[TRANSCRIBE] Using model: {lang_model.model_name if hasattr(lang_model, 'model_name') else 'unknown'}"
-    )
+    logger.info(f"[TRANSCRIBE] Using model: {model_name or lang_model.model_name}")
 
     force_lang = (
         WHISPER_LANGUAGE
         if WHISPER_LANGUAGE and WHISPER_LANGUAGE.lower() != "auto"
         else None
     )
-    fp16_ok = WHISPER_FP16 and torch.cuda.is_available()
+    fp16_ok = WHISPER_FP16 and lang_model.cuda
 
     logger.info(f"[TRANSCRIBE] Language setting: {force_lang or 'auto-detect'}")
     logger.info(f"[TRANSCRIBE] FP16 enabled: {fp16_ok}")
-    logger.info(f"[TRANSCRIBE] CUDA available: {torch.cuda.is_available()}")
+    logger.info(f"[TRANSCRIBE] CUDA available: {lang_model.cuda}")
+
+    # webhooks often fire more than once for the same recording
+    cached = lang_model.cached_result(video_path, model_name, language="de", fp16=fp16_ok)
+    if cached is not None:
+        logger.info("[TRANSCRIBE] Answered from the result cache")
+        return cached
+
+    result = dict()
+
+    def run(job: Job):
+        # a duplicate that was queued behind the first one finds its result here
+        cached = lang_model.cached_result(
+            video_path, model_name, count_miss=False, language="de", fp16=fp16_ok
+        )
+        if cached is not None:
+            result.update(cached)
+            return
+        result.update(
+            lang_model.transcribe_blocking(
+                video_path,
+                language="de",  # None → autodetect
+                fp16=fp16_ok,
+                model_name=model_name,
+            )
+        )
+        lang_model.store_result(
+            video_path, result, model_name=model_name, language="de", fp16=fp16_ok
+        )
 
     try:
-        logger.info("[TRANSCRIBE] Starting Whisper transcription...")
-        result = lang_model.model.transcribe(
-            audio=video_path,
-            language="de",  # None → autodetect
-            verbose=False,
-            fp16=fp16_ok,
+        # webhook jobs wait behind interactive uploads
+        job = scheduler.submit(
+            Job(
+                id=str(uuid.uuid4()),
+                run=run,
+                priority=PRIORITIES["batch"],
+                kind="webhook",
+                file_name=os.path.basename(video_path),
+                model_name=model_name,
+            )
+        )
+        logger.info(
+            f"[TRANSCRIBE] Queued as job {job.id} at position {scheduler.position(job.id)}"
         )
+        job.done.wait()
+        if job.state != COMPLETED:
+            raise RuntimeError(f"Transcription job {job.id} {job.state}: {job.error}")
         logger.info("[TRANSCRIBE] Whisper transcription completed")
+        logger.info(f"[TRANSCRIBE] Job stats: {result.get('stats')}")
 
     except Exception as e:
         logger.error(f"[TRANSCRIBE] Whisper transcription failed: {e}")
         raise
 
-    text = (result.get("text") or "").strip()
-    if text:
-        logger.info(f"[TRANSCRIBE] Extracted text: {len(text)} characters")
-        logger.debug(f"[TRANSCRIBE] Text preview: {text[:200]}...")
-        return text
-
-    # Very rare: rebuild from segments
-    logger.warning("[TRANSCRIBE] No text found, attempting to rebuild from segments")
-    segs = result.get("segments") or []
-    logger.info(f"[TRANSCRIBE] Found {len(segs)} segments")
-
-    rebuilt_text = "\n".join(s.get("text", "").strip() for s in segs if s.get("text"))
-    logger.info(f"[TRANSCRIBE] Rebuilt text: {len(rebuilt_text)} characters")
-
-    return rebuilt_text
+    return result
 
 
 def send_email_with_attachment(
@@ -650,17 +833,62 @@ def health():
         "status": "ok",
         "model": model_name,
         "model_loaded": model_loaded,
-        "cuda": torch.cuda.is_available(),
+        "cuda": lang_model.cuda if lang_model else None,
+        "startup_stage": startup_state["stage"],
+        "backend": lang_model.backend_name if lang_model else None,
+        "precision": lang_model.precision if model_loaded else None,
+        "broker": lang_model.backend.stats() if model_loaded else None,
+        "worker_pool": lang_model.worker_pool.info()
+        if model_loaded and lang_model.worker_pool
+        else None,
+        "models": lang_model.registry.resident() if lang_model else [],
+        "model_memory_mb": round(lang_model.registry.memory_bytes() / 2**20, 1)
+        if lang_model
+        else 0,
+        "model_memory_budget_mb": round(lang_model.registry.memory_budget / 2**20, 1)
+        if lang_model
+        else 0,
+        "result_cache": lang_model.result_cache.info()
+        if lang_model is not None and lang_model.result_cache is not None
+        else None,
+        "audio_cache": lang_model.audio_cache.info()
+        if lang_model is not None and lang_model.audio_cache is not None
+        else None,
+        "job_queue": dict(url=JOB_QUEUE_URL, depth=len(job_queue.jobs(states=(QUEUED,))))
+        if job_queue is not None
+        else None,
         "language": (WHISPER_LANGUAGE or "auto"),
         "email_to": EMAIL_TO,
     }
 
     logger.info(
-        f"[HEALTH] Health check requested - Model: {model_name}, CUDA: {torch.cuda.is_available()}"
+        f"[HEALTH] Health check requested - Model: {model_name}, CUDA: {health_info['cuda']}"
     )
     return health_info
 
 
+@app.get("/health/live")
+def liveness():
+    """The server process is up, whether or not the model is loaded"""
+    return {"status": "ok", "uptime": round(time.time() - startup_state["started_at"], 1)}
+
+
+@app.get("/health/ready")
+def readiness(response: Response):
+    """200 once the model is loaded and warmed up, 503 with the load progress before that"""
+    stages = dict(startup_state["stages"])
+    if not model_ready.is_set():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        stages[startup_state["stage"]] = round(time.perf_counter() - _stage_started, 2)
+
+    return {
+        "status": "ready" if model_ready.is_set() else startup_state["stage"],
+        "model": lang_model.model_name if lang_model else None,
+        "stages": stages,
+        "error": startup_state["error"],
+    }
+
+
 @app.post("/webhook/wowza")
 async def wowza_webhook(request: Request, background: BackgroundTasks):
     logger.info("[WEBHOOK] Received Wowza webhook request")
@@ -697,14 +925,21 @@ async def wowza_webhook(request: Request, background: BackgroundTasks):
         logger.error(f"[WEBHOOK] Failed to validate payload: {e}")
         raise HTTPException(status_code=400, detail=f"Invalid payload: {e}")
 
+    # The model can be chosen per webhook with ?model=..., e.g. large-v2 for archive recordings
+    model_name = request.query_params.get("model") or WEBHOOK_WHISPER_MODEL
+    # before the model is loaded, the model is checked when the job starts
+    if model_name and lang_model and not lang_model.registry.is_allowed(model_name):
+        logger.error(f"[WEBHOOK] Model not allowed: {model_name}")
+        raise HTTPException(status_code=400, detail=f"Model not allowed: {model_name}")
+
     # Process in background, ACK fast
     logger.info(f"[WEBHOOK] Adding webhook processing task to background queue")
-    background.add_task(process_webhook, webhook.model_dump())
+    background.add_task(process_webhook, webhook.model_dump(), model_name)
     logger.info(f"[WEBHOOK] Webhook acknowledged and queued for processing")
     return {"received": True}
 
 
-def process_webhook(webhook_dict: Dict[str, Any]):
+def process_webhook(webhook_dict: Dict[str, Any], model_name: Optional[str] = None):
     logger.info("[PROCESS] Starting webhook processing in background task")
     webhook = WowzaWebhook(**webhook_dict)
     event_type = webhook.event_type or ""
@@ -750,7 +985,7 @@ def process_webhook(webhook_dict: Dict[str, Any]):
         logger.info(f"[PROCESS] Video downloaded to temporary file: {temp_path}")
 
         logger.info("[PROCESS] Starting transcription")
-        transcript = transcribe_with_whisper(temp_path)
+        transcript = transcribe_with_whisper(temp_path, model_name)
         logger.info(f"[PROCESS] Transcription completed - {len(transcript)} characters")
         logger.debug(f"[PROCESS] Transcript preview: {transcript[:200]}...")
 
@@ -793,105 +1028,271 @@ def process_webhook(webhook_dict: Dict[str, Any]):
                 )
 
 
+def jobs_source():
+    """The distributed job queue in distributed mode, the local scheduler otherwise"""
+    return job_queue if job_queue is not None else scheduler
+
+
+def list_jobs() -> Tuple[list, list]:
+    """The running and the waiting jobs"""
+    if job_queue is not None:
+        jobs = job_queue.jobs()
+        return (
+            [job for job in jobs if job.state == RUNNING],
+            [job for job in jobs if job.state == QUEUED],
+        )
+    return scheduler.running(), scheduler.queued()
+
+
+def current_upload_job():
+    """The running upload job, or the next one to run, for clients that follow a single job"""
+    running, queued = list_jobs()
+    for job in running + queued:
+        if job.kind == "upload":
+            return job
+    return None
+
+
 @app.get("/status", dependencies=[Depends(get_current_user)])
-async def get_status():
-    global transcription_in_progress
+async def get_status(transcript_id: Optional[str] = None):
+    current = current_upload_job()
+    running, queued = list_jobs()
+    status_info = {
+        "status": "ok",
+        "transcription_in_progress": current.id if current else False,
+        "running": [job.info() for job in running],
+        "queue_depth": len(queued),
+        "queue": [dict(job.info(), position=i) for i, job in enumerate(queued)],
+        "concurrency": scheduler.concurrency if job_queue is None else None,
+        "distributed": job_queue is not None,
+    }
 
-    return {"status": "ok", "transcription_in_progress": transcription_in_progress}
+    if transcript_id:
+        job = jobs_source().get(transcript_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        status_info["job"] = dict(
+            job.info(), queue_position=jobs_source().position(transcript_id)
+        )
 
+    return status_info
 
-def start_transcription_process(transcript_id, audio_file_path):
-    global transcription_in_progress
-    global transcription_text
-    global transcription_chunks
-    global transcription_error
-    global transcription_error_traceback
-    
-    logger.info(f"[TRANSCRIBE] Starting transcription process for job {transcript_id}")
+
+def start_transcription_process(
+    transcript_id,
+    audio_file_path,
+    file_name="",
+    model_name=None,
+    priority=PRIORITIES["interactive"],
+):
+    logger.info(f"[TRANSCRIBE] Queueing transcription job {transcript_id}")
     logger.info(f"[TRANSCRIBE] Audio file: {audio_file_path}")
-    
-    transcription_in_progress = transcript_id
-    transcription_error = None
-    transcription_error_traceback = None
 
-    def end_callback(end_data):
-        process_queue(transcript_id)
+    if job_queue is not None:
+        return job_queue.enqueue(
+            transcript_id,
+            dict(
+                kind="upload",
+                audio_file=os.path.abspath(audio_file_path),
+                file_name=file_name,
+                model_name=model_name,
+            ),
+            priority=priority,
+        )
 
-    transcription_text = ""
-    transcription_chunks = []
+    def run(job: Job):
+        result = dict()
 
-    lang_model.transcribe_text(audio_file_path, transcript_id, end_callback)
+        def end_callback(end_data):
+            result.update(end_data)
+            process_queue(job)
 
+        interrupted = False
+        try:
+            if job.stop_requested:
+                return
+            # the same recording may have been transcribed while the job was waiting
+            cached = lang_model.cached_result(audio_file_path, job.model_name, count_miss=False)
+            if cached is not None:
+                store_cached_result(job.id, job.file_name, cached)
+                return
 
-def process_queue(transcript_id):
-    global transcription_in_progress
-    global transcription_text
-    global transcription_chunks
-    global transcription_file_name
-    global transcription_error
-    global transcription_error_traceback
-    global lang_model
+            lang_model.transcribe_job(
+                audio_file_path, job.id, end_callback, model_name=job.model_name, resumable=True
+            )
+            # errors are only on the queue
+            process_queue(job)
+            if result and not job.error and not job.stop_requested:
+                lang_model.store_result(audio_file_path, result, model_name=job.model_name)
+        except TranscriptionInterrupted:
+            # kept, so that the job continues from its checkpoint when the server is back
+            interrupted = True
+            raise
+        finally:
+            lang_model.release_process_queue(job.id)
+            if not interrupted:
+                # nothing retries a failed job, so its checkpoint goes with the record
+                job_db.remove(transcript_model.id == job.id)
+                lang_model.remove_checkpoint(job.id)
+
+    # kept until the job finished, so that it is queued again when the server restarts
+    if not job_db.contains(transcript_model.id == transcript_id):
+        job_db.insert(
+            dict(
+                id=transcript_id,
+                audio_file=audio_file_path,
+                file_name=file_name,
+                model_name=model_name,
+                priority=priority,
+            )
+        )
 
-    for data, fished in lang_model.empty_process_queue(transcript_id):
-        if fished:
-            # Check if this is an error
-            if data.get("is_error"):
-                logger.error(f"[TRANSCRIBE] Job {transcript_id} failed with error: {data.get('error')}")
-                logger.error(f"[TRANSCRIBE] Traceback:\n{data.get('traceback')}")
-                transcription_error = data.get("error")
-                transcription_error_traceback = data.get("traceback")
-                transcription_in_progress = None
-                # Don't store the transcription in the database if it failed
-                return
-            
-            # Success case
-            data = {
-                "id": transcript_id,
-                "text": transcription_text.strip() if transcription_text else "",
-                "chunks": transcription_chunks,
-                "file_name": transcription_file_name,
-                "transcription_name": f'{transcription_file_name} - {datetime.now().strftime("%d.%m.%Y %H:%M:%S")}',
-                "created_at": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
-            }
-
-            if not transcripts.contains(transcript_model.id == transcript_id):
-                # store transcript in 'transcripts' under name uuid
-                transcripts.insert(data)
-                logger.info(f"[TRANSCRIBE] Job {transcript_id} completed successfully and saved to database")
+    return scheduler.submit(
+        Job(
+            id=transcript_id,
+            run=run,
+            priority=priority,
+            file_name=file_name,
+            model_name=model_name,
+        )
+    )
+
+
+def store_cached_result(transcript_id, file_name, result):
+    chunks = [
+        dict(start=segment["start"], end=segment["end"], text=segment["text"].strip())
+        for segment in result["segments"]
+    ]
+    text = " ".join(chunk["text"] for chunk in chunks)
+    store_transcript(transcript_id, file_name, text, chunks, result.get("stats"))
+
+
+def answer_from_result_cache(transcript_id, audio_file_path, file_name, model_name=None) -> bool:
+    """Store the transcript right away if the same audio was transcribed before"""
+    # in distributed mode the workers look the results up
+    if lang_model is None:
+        return False
+    cached = lang_model.cached_result(audio_file_path, model_name)
+    if cached is None:
+        return False
+    store_cached_result(transcript_id, file_name, cached)
+    return True
+
+
+def resume_pending_jobs():
+    """Queue the upload jobs again that were waiting or running when the server stopped"""
+    for record in job_db.all():
+        if not os.path.isfile(record["audio_file"]):
+            logger.warning(f"[startup] Dropping job {record['id']}, its audio file is gone")
+            job_db.remove(transcript_model.id == record["id"])
+            lang_model.remove_checkpoint(record["id"])
+            continue
+
+        # a job that was running continues from its last checkpoint
+        logger.info(f"[startup] Resuming job {record['id']}")
+        start_transcription_process(
+            record["id"],
+            record["audio_file"],
+            file_name=record["file_name"],
+            model_name=record["model_name"],
+            priority=record["priority"],
+        )
+
+
+def store_transcript(transcript_id, file_name, text, chunks, stats):
+    data = {
+        "id": transcript_id,
+        "text": text.strip(),
+        "chunks": chunks,
+        "file_name": file_name,
+        "transcription_name": f'{file_name} - {datetime.now().strftime("%d.%m.%Y %H:%M:%S")}',
+        "created_at": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+        "stats": stats,
+    }
+
+    if not transcripts.contains(transcript_model.id == transcript_id):
+        # store transcript in 'transcripts' under name uuid
+        transcripts.insert(data)
+        logger.info(f"[TRANSCRIBE] Job {transcript_id} completed successfully and saved to database")
+    else:
+        transcripts.update(data, transcript_model.id == transcript_id)
+        logger.info(f"[TRANSCRIBE] Job {transcript_id} completed successfully and updated in database")
+
+
+def collect_queue_results():
+    """Store the transcripts of the upload jobs the distributed workers finished"""
+    for job in job_queue.take_results():
+        if job.kind == "retranscribe" and job.state == COMPLETED:
+            splice_transcript(
+                job.payload["transcript_id"], *job.payload["range"], job.result["segments"]
+            )
+        if job.kind == "upload" and job.result is not None:
+            store_transcript(
+                job.id,
+                job.payload.get("file_name", ""),
+                job.result["text"],
+                job.result["chunks"],
+                job.result.get("stats"),
+            )
+        if job.result is not None:
+            # the result holds the segments; those of failed jobs are kept, they are all there is
+            job_queue.delete_messages(job.id)
+
+
+def collect_queue_results_loop():
+    while not results_collector_stop.wait(JOB_QUEUE_POLL_SECONDS):
+        try:
+            collect_queue_results()
+        except Exception as e:
+            logger.error(f"[QUEUE] Collecting job results failed: {e}")
+
+
+def process_queue(job: Job):
+    """Collect the segments of a running job and store the transcript once it ended"""
+    with job.lock:
+        for data, fished in lang_model.empty_process_queue(job.id):
+            if fished:
+                # Check if this is an error
+                if data.get("is_error"):
+                    logger.error(f"[TRANSCRIBE] Job {job.id} failed with error: {data.get('error')}")
+                    logger.error(f"[TRANSCRIBE] Traceback:\n{data.get('traceback')}")
+                    job.error = data.get("error")
+                    job.traceback = data.get("traceback")
+                    # Don't store the transcription in the database if it failed
+                    return
+
+                # Success case
+                job.stats = data.get("stats") or job.stats
+                store_transcript(job.id, job.file_name, job.text, job.chunks, job.stats)
+            elif "timer" in data:
+                job.events.append("timer", seconds=data["timer"])
             else:
-                transcripts.update(data, transcript_model.id == transcript_id)
-                logger.info(f"[TRANSCRIBE] Job {transcript_id} completed successfully and updated in database")
-
-            transcription_in_progress = None
-        else:
-            new_text = data["text"].strip() if data["text"] else ""
-            transcription_text = transcription_text + " " + new_text
-            transcription_chunks.append(
-                dict(
-                    start=data["start"],
-                    end=data["end"],
-                    text=new_text,
+                new_text = data["text"].strip() if data["text"] else ""
+                job.text = job.text + " " + new_text
+                job.chunks.append(
+                    dict(
+                        start=data["start"],
+                        end=data["end"],
+                        text=new_text,
+                    )
                 )
-            )
+                job.events.append("segment", **job.chunks[-1])
 
 
 # @dataclass
 # class TranscribeRequest:
 
 
-def cut_audio(input_file, start_time, duration, output_file):
-    logger.info(f"[AUDIO] Cutting audio file: {input_file}")
-    logger.info(f"[AUDIO] Start time: {start_time}, Duration: {duration}")
-
-    path_path = Path(output_file)
-    # change to append cut_ on filename
-    new_output_file = path_path.parent / f"cut_{path_path.name}"
+def copy_audio_range(input_file, start_time, end_time, output_file):
+    """Copy the range of a file into a new one without decoding it"""
+    # with -ss before -i ffmpeg seeks in the container instead of reading up to the start
+    cmd_cut = [
+        "ffmpeg", "-y", "-ss", str(start_time), "-to", str(end_time),
+        "-i", str(input_file), "-acodec", "copy", str(output_file),
+    ]
 
-    # Command to cut the audio
-    cmd_cut = f'ffmpeg -i "{input_file}" -ss {start_time} -to {duration} -acodec copy "{new_output_file}"'
-    
     try:
-        result = subprocess.run(cmd_cut, shell=True, capture_output=True, text=True)
+        result = subprocess.run(cmd_cut, capture_output=True, text=True)
         if result.returncode != 0:
             logger.error(f"[AUDIO] FFmpeg error: {result.stderr}")
             raise Exception(f"Failed to cut audio: {result.stderr}")
@@ -900,6 +1301,17 @@ def cut_audio(input_file, start_time, duration, output_file):
         logger.error(f"[AUDIO] Failed to cut audio: {str(e)}")
         raise
 
+
+def cut_audio(input_file, start_time, duration, output_file):
+    logger.info(f"[AUDIO] Cutting audio file: {input_file}")
+    logger.info(f"[AUDIO] Start time: {start_time}, Duration: {duration}")
+
+    path_path = Path(output_file)
+    # change to append cut_ on filename
+    new_output_file = path_path.parent / f"cut_{path_path.name}"
+
+    copy_audio_range(input_file, start_time, duration, new_output_file)
+
     # remove old file
     os.remove(input_file)
     # rename new file
@@ -907,29 +1319,38 @@ def cut_audio(input_file, start_time, duration, output_file):
     logger.info(f"[AUDIO] Audio file saved to: {output_file}")
 
 
-@app.post("/transcribe", dependencies=[Depends(get_current_user)])
+@app.post(
+    "/transcribe", dependencies=[Depends(get_current_user), Depends(require_model_ready)]
+)
 async def upload_audio_file(
     files=File(description="Multiple files as UploadFile"),
     start=Form(),
     end=Form(),
+    model: Optional[str] = Form(None),
+    priority: str = Form("interactive"),
 ):
     logger.info(f"[API] Received transcription request for file: {files.filename}")
-    logger.info(f"[API] Start: {start}, End: {end}")
+    logger.info(
+        f"[API] Start: {start}, End: {end}, Model: {model or 'default'}, Priority: {priority}"
+    )
+
+    # in distributed mode the workers check the model
+    if model and lang_model is not None and not lang_model.registry.is_allowed(model):
+        logger.warning(f"[API] Model not allowed: {model}")
+        raise HTTPException(status_code=400, detail=f"Model not allowed: {model}")
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown priority {priority}, expected one of {list(PRIORITIES)}"
+        )
     
     # Rest of the code...
     audio_bytes = await files.read()
     logger.info(f"[API] File size: {len(audio_bytes)} bytes")
 
-    if transcription_in_progress:
-        logger.warning(f"[API] Transcription already in progress: {transcription_in_progress}")
-        raise HTTPException(status_code=400, detail="Transcription already in progress")
-
     transcript_id = str(uuid.uuid4())
     logger.info(f"[API] Generated transcript ID: {transcript_id}")
 
     file_type = files.filename.split(".")[-1]
-    global transcription_file_name
-    transcription_file_name = files.filename
 
     audio_file_path = os.path.join(
         file_path, "audio_files", transcript_id + "." + file_type
@@ -942,10 +1363,21 @@ async def upload_audio_file(
 
         cut_audio(audio_file_path, start, end, audio_file_path)
 
-        start_transcription_process(transcript_id, audio_file_path)
-        
-        logger.info(f"[API] Transcription process started successfully for {transcript_id}")
-        return {"transcription_id": transcript_id}
+        if answer_from_result_cache(transcript_id, audio_file_path, files.filename, model):
+            logger.info(f"[API] Transcription {transcript_id} answered from the result cache")
+            return {"transcription_id": transcript_id, "queue_position": None, "cached": True}
+
+        start_transcription_process(
+            transcript_id,
+            audio_file_path,
+            file_name=files.filename,
+            model_name=model,
+            priority=PRIORITIES[priority],
+        )
+        queue_position = jobs_source().position(transcript_id)
+
+        logger.info(f"[API] Transcription job {transcript_id} queued at position {queue_position}")
+        return {"transcription_id": transcript_id, "queue_position": queue_position}
     except Exception as e:
         logger.error(f"[API] Failed to process audio file: {str(e)}")
         logger.error(f"[API] Traceback: {traceback.format_exc()}")
@@ -959,6 +1391,71 @@ async def upload_audio_file(
         raise HTTPException(status_code=500, detail=f"Failed to process audio file: {str(e)}")
 
 
+@app.post(
+    "/transcriptions/{transcript_id}/range",
+    dependencies=[Depends(get_current_user), Depends(require_model_ready)],
+)
+async def transcribe_stored_range(
+    transcript_id: str,
+    start: float = Form(...),
+    end: float = Form(...),
+    model: Optional[str] = Form(None),
+    priority: str = Form("interactive"),
+):
+    """
+    Start a new transcription of the range from start to end of an uploaded file, without
+    uploading it again. Only the range is copied and decoded.
+    """
+    logger.info(
+        f"[API] New transcription of {start}-{end} of {transcript_id}, model: {model or 'default'}"
+    )
+    source_file = find_audio_file(transcript_id)
+    if source_file is None:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    if not 0 <= start < end:
+        raise HTTPException(status_code=400, detail="Expected 0 <= start < end")
+    if model and lang_model is not None and not lang_model.registry.is_allowed(model):
+        logger.warning(f"[API] Model not allowed: {model}")
+        raise HTTPException(status_code=400, detail=f"Model not allowed: {model}")
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown priority {priority}, expected one of {list(PRIORITIES)}"
+        )
+
+    source = transcripts.get(transcript_model.id == transcript_id) or {}
+    new_transcript_id = str(uuid.uuid4())
+    audio_file_path = os.path.join(
+        file_path, "audio_files", new_transcript_id + source_file.suffix
+    )
+
+    try:
+        copy_audio_range(source_file, start, end, audio_file_path)
+
+        file_name = source.get("file_name", source_file.name)
+        if answer_from_result_cache(new_transcript_id, audio_file_path, file_name, model):
+            logger.info(f"[API] Transcription {new_transcript_id} answered from the result cache")
+            return {"transcription_id": new_transcript_id, "queue_position": None, "cached": True}
+
+        start_transcription_process(
+            new_transcript_id,
+            audio_file_path,
+            file_name=file_name,
+            model_name=model,
+            priority=PRIORITIES[priority],
+        )
+        queue_position = jobs_source().position(new_transcript_id)
+
+        logger.info(
+            f"[API] Transcription job {new_transcript_id} queued at position {queue_position}"
+        )
+        return {"transcription_id": new_transcript_id, "queue_position": queue_position}
+    except Exception as e:
+        logger.error(f"[API] Failed to start transcription of the range: {str(e)}")
+        if os.path.exists(audio_file_path):
+            os.remove(audio_file_path)
+        raise HTTPException(status_code=500, detail=f"Failed to process audio file: {str(e)}")
+
+
 @app.get("/transcriptions", dependencies=[Depends(get_current_user)])
 async def get_transcriptions():
     return transcripts.all()
@@ -966,34 +1463,41 @@ async def get_transcriptions():
 
 @app.get("/transcriptions/{transcript_id}", dependencies=[Depends(get_current_user)])
 async def get_transcription(transcript_id: str, response: Response):
-    global transcription_in_progress
-    global transcription_text
-    global transcription_chunks
-    global transcription_file_name
-    global transcription_error
-    global transcription_error_traceback
-    global lang_model
+    if job_queue is not None:
+        return get_queued_transcription(transcript_id, response)
+
+    job = scheduler.get(transcript_id)
+
+    if job is not None and job.state == QUEUED:
+        response.status_code = status.HTTP_202_ACCEPTED
+        return dict(
+            status="queued",
+            queue_position=scheduler.position(transcript_id),
+            text="",
+            chunks=[],
+        )
 
-    if transcription_in_progress == transcript_id:
-        process_queue(transcript_id)
+    if job is not None and job.state in (RUNNING, FAILED):
+        if job.state == RUNNING:
+            process_queue(job)
 
         # Check if there was an error
-        if transcription_error:
+        if job.error:
             logger.error(f"[API] Returning error status for job {transcript_id}")
             response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
             return dict(
                 status="error",
-                error=transcription_error,
-                traceback=transcription_error_traceback,
-                text=transcription_text,
-                chunks=transcription_chunks
+                error=job.error,
+                traceback=job.traceback,
+                text=job.text,
+                chunks=job.chunks
             )
 
         response.status_code = status.HTTP_202_ACCEPTED
         return dict(
             status="in_progress",
-            text=transcription_text, 
-            chunks=transcription_chunks
+            text=job.text, 
+            chunks=job.chunks
         )
 
     # check if transcript exists
@@ -1003,25 +1507,417 @@ async def get_transcription(transcript_id: str, response: Response):
     return transcripts.get(transcript_model.id == transcript_id)
 
 
-@app.get("/audio/{transcript_id}", dependencies=[Depends(get_current_user)])
-async def get_audio_file(transcript_id: str):
-    # check if transcript exists
+def queued_job_event_log(transcript_id: str) -> Optional[JobEventLog]:
+    """The event log of a job on the distributed workers, brought up to date with the queue"""
+    job = job_queue.get(transcript_id)
+    with queued_job_events_lock:
+        entry = queued_job_events.get(transcript_id)
+        if job is None:
+            return entry["log"] if entry is not None else None
+
+        # a redelivered job starts its messages over
+        if entry is None or (entry["attempts"] != job.attempts and entry["messages"] > 0):
+            entry = queued_job_events[transcript_id] = dict(
+                log=JobEventLog(), attempts=job.attempts, messages=0, state=None
+            )
+            finished = [
+                job_id for job_id, other in queued_job_events.items() if other["log"].finished
+            ]
+            for job_id in finished[: max(len(finished) - 100, 0)]:
+                del queued_job_events[job_id]
+        entry["attempts"] = job.attempts
+
+        state = STOPPED if job.state == CANCELLED else job.state
+        changed = state != entry["state"]
+        entry["state"] = state
+        if changed and state not in FINAL_STATES:
+            entry["log"].append("state", state=state)
+        # the state is read first, a finished job has all its messages in the queue
+        for message in job_queue.messages(transcript_id, after=entry["messages"]):
+            entry["log"].append("segment", **message)
+            entry["messages"] += 1
+        if changed and state in FINAL_STATES:
+            if state == FAILED:
+                entry["log"].append("state", state=state, error=job.error)
+            else:
+                entry["log"].append("state", state=state)
+        return entry["log"]
+
+
+def job_event_log(transcript_id: str) -> Optional[JobEventLog]:
+    """The event log of a job, with the segments the job decoded since the last call"""
+    if job_queue is not None:
+        return queued_job_event_log(transcript_id)
+
+    job = scheduler.get(transcript_id)
+    if job is None:
+        return None
+    if job.kind == "upload" and job.state == RUNNING:
+        process_queue(job)
+    return job.events
+
+
+@app.get("/transcriptions/{transcript_id}/events", dependencies=[Depends(get_current_user)])
+async def stream_transcription_events(
+    transcript_id: str, request: Request, after: Optional[str] = None
+):
+    """
+    Server-sent events with the progress of a transcription, each sent once: "state" changes
+    (the stream ends with "completed", "failed" or "stopped"), decoded "segment"s and "timer"
+    ticks with the seconds transcribed so far. A client that reconnects passes the id of the
+    last event it received as Last-Event-ID header (or `after`) and continues after it; a
+    "reset" event tells it to drop what it received, because the job started over.
+    """
+    log = job_event_log(transcript_id)
+    if log is None and not transcripts.contains(transcript_model.id == transcript_id):
+        raise HTTPException(status_code=404, detail="Transcription not found")
+    last_event_id = request.headers.get("last-event-id") or after
+
+    def final_event() -> str:
+        # the job is gone, it finished before or the server restarted
+        stored = transcripts.contains(transcript_model.id == transcript_id)
+        return format_event(
+            dict(
+                id=f"{transcript_id}:final",
+                event="state",
+                data=dict(state=COMPLETED if stored else STOPPED),
+            )
+        )
+
+    async def events():
+        nonlocal log
+        if log is None:
+            yield final_event()
+            return
+        seq, reset = log.resume_from(last_event_id)
+        if reset:
+            yield format_event(dict(id=f"{log.id}:0", event="reset", data=dict()))
+        elif log.finished and not log.since(seq):
+            # the client already received the final state
+            return
+
+        idle_since = time.monotonic()
+        while True:
+            new_events = log.since(seq)
+            seq += len(new_events)
+            for event in new_events:
+                yield format_event(event)
+            if any(
+                event["event"] == "state" and event["data"]["state"] in FINAL_STATES
+                for event in new_events
+            ):
+                return
+
+            if new_events:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= EVENT_STREAM_KEEPALIVE_SECONDS:
+                # keeps proxies from closing the idle connection
+                yield ": keep-alive\n\n"
+                idle_since = time.monotonic()
+
+            await asyncio.sleep(EVENT_STREAM_POLL_SECONDS)
+            if await request.is_disconnected():
+                return
+            current = job_event_log(transcript_id)
+            if current is None:
+                yield final_event()
+                return
+            if current is not log:
+                log, seq = current, 0
+                yield format_event(dict(id=f"{log.id}:0", event="reset", data=dict()))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def get_queued_transcription(transcript_id: str, response: Response):
+    """get_transcription for jobs that run on the distributed workers"""
+    job = job_queue.get(transcript_id)
+
+    if job is not None and job.state == QUEUED:
+        response.status_code = status.HTTP_202_ACCEPTED
+        return dict(
+            status="queued",
+            queue_position=job_queue.position(transcript_id),
+            text="",
+            chunks=[],
+        )
+
+    if job is not None and job.state == RUNNING:
+        chunks = job_queue.messages(transcript_id)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return dict(
+            status="in_progress",
+            text=" ".join(chunk["text"] for chunk in chunks).strip(),
+            chunks=chunks,
+            worker=job.worker,
+        )
+
+    if job is not None and job.state == FAILED:
+        logger.error(f"[API] Returning error status for job {transcript_id}")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        chunks = job_queue.messages(transcript_id)
+        return dict(
+            status="error",
+            error=job.error,
+            traceback=None,
+            text=" ".join(chunk["text"] for chunk in chunks).strip(),
+            chunks=chunks,
+        )
+
+    if job is not None and job.state in (COMPLETED, CANCELLED):
+        # the result may not have been collected yet
+        collect_queue_results()
+
     if not transcripts.contains(transcript_model.id == transcript_id):
         raise HTTPException(status_code=404, detail="Transcription not found")
 
-    transcript_data = transcripts.get(transcript_model.id == transcript_id)
+    return transcripts.get(transcript_model.id == transcript_id)
+
 
+def find_audio_file(transcript_id: str) -> Optional[Path]:
     # get file with Path(file_path, 'audio_files', transcript_id . * )
     possible_files = list(
         Path(os.path.join(file_path, "audio_files")).glob(f"{transcript_id}*")
     )
+    return possible_files[0] if possible_files else None
+
+
+def get_audio_cache():
+    if lang_model is not None:
+        return lang_model.audio_cache
+    if job_queue is None or WHISPER_AUDIO_CACHE_MB <= 0:
+        return None
+    # imported here, it pulls in torch
+    from audio_cache import open_audio_cache
+
+    return open_audio_cache(WHISPER_AUDIO_CACHE_DIR, int(WHISPER_AUDIO_CACHE_MB * 2**20))
+
+
+def retranscription_range(chunks: List[dict], start: float, end: float) -> Tuple[float, float, str]:
+    """
+    The range to transcribe again, widened to the chunks it cuts into so that no chunk is
+    half replaced, and the text before it to prompt the model with
+    """
+    overlapping = [chunk for chunk in chunks if chunk["start"] < end and chunk["end"] > start]
+    start = min([start] + [chunk["start"] for chunk in overlapping])
+    end = max([end] + [chunk["end"] for chunk in overlapping])
+    preceding = " ".join(chunk["text"] for chunk in chunks if chunk["end"] <= start).strip()
+    # the model only looks at the last 223 tokens of the prompt
+    return start, end, preceding[-1000:]
+
+
+def splice_transcript(transcript_id: str, start: float, end: float, segments: List[dict]):
+    """Replace the chunks of a stored transcript from start to end with re-transcribed segments"""
+    new_chunks = [
+        dict(
+            start=start + segment["start"],
+            end=min(start + segment["end"], end),
+            text=segment["text"].strip(),
+        )
+        for segment in segments
+        if segment["text"].strip()
+    ]
+    with transcript_lock:
+        record = transcripts.get(transcript_model.id == transcript_id)
+        if record is None:
+            logger.warning(f"[RETRANSCRIBE] Transcript {transcript_id} was deleted, dropping the range")
+            return
+
+        # the range was widened to the chunks of the transcript when the job was queued; chunks
+        # that reach past it now are kept, and the new chunks they overlap give way to them
+        widened_start, widened_end, _ = retranscription_range(record["chunks"], start, end)
+        chunks = [
+            chunk for chunk in record["chunks"] if chunk["start"] < start or chunk["end"] > end
+        ]
+        if (widened_start, widened_end) != (start, end):
+            logger.warning(
+                f"[RETRANSCRIBE] {transcript_id} changed meanwhile, keeping its chunks from "
+                f"{widened_start:.1f}s to {widened_end:.1f}s that reach past the range"
+            )
+            new_chunks = [
+                new
+                for new in new_chunks
+                if all(
+                    new["end"] <= chunk["start"] or new["start"] >= chunk["end"] for chunk in chunks
+                )
+            ]
+        chunks += new_chunks
+        chunks.sort(key=lambda chunk: chunk["start"])
+        transcripts.update(
+            dict(chunks=chunks, text=" ".join(chunk["text"] for chunk in chunks).strip()),
+            transcript_model.id == transcript_id,
+        )
+    logger.info(
+        f"[RETRANSCRIBE] Replaced {start:.1f}s-{end:.1f}s of {transcript_id} "
+        f"with {len(new_chunks)} chunks"
+    )
+
+
+def start_retranscription(
+    job_id: str,
+    transcript_id: str,
+    audio_file: str,
+    start: float,
+    end: float,
+    file_name: str = "",
+    model_name: Optional[str] = None,
+    decode_options: Optional[dict] = None,
+    priority=PRIORITIES["interactive"],
+):
+    decode_options = decode_options or {}
+    if job_queue is not None:
+        return job_queue.enqueue(
+            job_id,
+            dict(
+                kind="retranscribe",
+                audio_file=os.path.abspath(audio_file),
+                transcript_id=transcript_id,
+                range=[start, end],
+                file_name=file_name,
+                model_name=model_name,
+                decode_options=decode_options,
+            ),
+            priority=priority,
+        )
+
+    def run(job: Job):
+        end_data = dict()
+        try:
+            lang_model.transcribe_job(
+                lang_model.load_audio_range(audio_file, start, end),
+                job.id,
+                end_data.update,
+                model_name=model_name,
+                **decode_options,
+            )
+            for data, finished in lang_model.empty_process_queue(job.id):
+                if data.get("is_error"):
+                    job.error = data["error"]
+                    job.traceback = data["traceback"]
+        finally:
+            lang_model.release_process_queue(job.id)
+
+        # a stopped job leaves the transcript as it was
+        if not job.error and not job.stop_requested:
+            splice_transcript(transcript_id, start, end, end_data["segments"])
+
+    return scheduler.submit(
+        Job(
+            id=job_id,
+            run=run,
+            priority=priority,
+            kind="retranscribe",
+            file_name=file_name,
+            model_name=model_name,
+            transcript_id=transcript_id,
+        )
+    )
+
+
+def retranscription_pending(transcript_id: str) -> bool:
+    """Whether a job re-transcribing a range of the transcript is waiting or running"""
+    if job_queue is not None:
+        return any(
+            job.kind == "retranscribe" and job.payload.get("transcript_id") == transcript_id
+            for job in job_queue.jobs()
+        )
+    return any(
+        job.kind == "retranscribe" and job.transcript_id == transcript_id
+        for job in scheduler.queued() + scheduler.running()
+    )
+
+
+@app.post(
+    "/transcriptions/{transcript_id}/retranscribe",
+    dependencies=[Depends(get_current_user), Depends(require_model_ready)],
+)
+async def retranscribe_range(
+    transcript_id: str,
+    start: float = Form(),
+    end: float = Form(),
+    model: Optional[str] = Form(None),
+    temperature: Optional[float] = Form(None),
+    prompt: Optional[str] = Form(None),
+    priority: str = Form("interactive"),
+):
+    """
+    Transcribe the range from start to end seconds of a stored transcript again, from its stored
+    audio and prompted with the text before it, and replace the chunks of the range with the
+    result. The range is widened to whole chunks. Poll /status?transcript_id=<job_id>. One range
+    of a transcript is re-transcribed at a time.
+    """
+    logger.info(
+        f"[API] Re-transcribing {start}s-{end}s of {transcript_id}, model: {model or 'default'}"
+    )
+    record = transcripts.get(transcript_model.id == transcript_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Transcription not found")
+    audio_file = find_audio_file(transcript_id)
+    if audio_file is None:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    if not 0 <= start < end:
+        raise HTTPException(status_code=400, detail="Expected 0 <= start < end")
+    if model and lang_model is not None and not lang_model.registry.is_allowed(model):
+        raise HTTPException(status_code=400, detail=f"Model not allowed: {model}")
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown priority {priority}, expected one of {list(PRIORITIES)}"
+        )
+    job = jobs_source().get(transcript_id)
+    if job is not None and not job.finished:
+        raise HTTPException(status_code=409, detail="The transcription is still running")
+    # both jobs would splice their range into the same transcript
+    if retranscription_pending(transcript_id):
+        raise HTTPException(
+            status_code=409, detail="A range of the transcription is already re-transcribed"
+        )
+
+    start, end, preceding = retranscription_range(record["chunks"], start, end)
+    decode_options = dict(initial_prompt=prompt or preceding or None)
+    if temperature is not None:
+        decode_options["temperature"] = temperature
+
+    job_id = str(uuid.uuid4())
+    start_retranscription(
+        job_id,
+        transcript_id,
+        str(audio_file),
+        start,
+        end,
+        file_name=record.get("file_name", ""),
+        model_name=model,
+        decode_options=decode_options,
+        priority=PRIORITIES[priority],
+    )
+    return {
+        "job_id": job_id,
+        "transcription_id": transcript_id,
+        "start": start,
+        "end": end,
+        "queue_position": jobs_source().position(job_id),
+    }
+
+
+@app.get("/audio/{transcript_id}", dependencies=[Depends(get_current_user)])
+async def get_audio_file(transcript_id: str):
+    # check if transcript exists
+    if not transcripts.contains(transcript_model.id == transcript_id):
+        raise HTTPException(status_code=404, detail="Transcription not found")
+
+    transcript_data = transcripts.get(transcript_model.id == transcript_id)
+
+    audio_file = find_audio_file(transcript_id)
 
     # check if audio file exists
-    if len(possible_files) == 0:
+    if audio_file is None:
         raise HTTPException(status_code=404, detail="Audio file not found")
 
     return FileResponse(
-        possible_files[0],
+        audio_file,
         media_type="audio/mpeg",
         filename=transcript_data["file_name"],
     )
@@ -1034,12 +1930,14 @@ async def delete_transcriptions(transcript_id: str):
     if not transcripts.contains(transcript_model.id == transcript_id):
         raise HTTPException(status_code=404, detail="Transcription not found")
 
-    possible_files = list(
-        Path(os.path.join(file_path, "audio_files")).glob(f"{transcript_id}*")
-    )
+    audio_file = find_audio_file(transcript_id)
+    if audio_file is not None:
+        audio_cache = get_audio_cache()
+        if audio_cache is not None:
+            audio_cache.drop(str(audio_file))
 
-    # delete audio file from 'audio_files'
-    os.remove(possible_files[0])
+        # delete audio file from 'audio_files'
+        os.remove(audio_file)
 
     # delete transcript
     transcripts.remove(transcript_model.id == transcript_id)
@@ -1048,22 +1946,28 @@ async def delete_transcriptions(transcript_id: str):
 
 
 @app.post("/stop-transcription", dependencies=[Depends(get_current_user)])
-async def stop_transcription():
-    global transcription_in_progress
-    global lang_model
-
-    if not transcription_in_progress:
+async def stop_transcription(transcript_id: Optional[str] = None):
+    job = jobs_source().get(transcript_id) if transcript_id else current_upload_job()
+    if job is None or job.finished:
         raise HTTPException(status_code=400, detail="No transcription in progress")
 
-    transcript_id = transcription_in_progress
-    # Stop the transcription process
-    lang_model.stop_transcription(transcript_id)
+    transcript_id = job.id
+    # Queued jobs are dropped, running ones are told to stop
+    if job_queue is not None:
+        # the worker sees the request within a second and stops the job
+        job_queue.cancel(transcript_id)
+    elif not scheduler.cancel(transcript_id):
+        job.stop_requested = True
+        lang_model.stop_transcription(transcript_id)
+    else:
+        # the job never ran, but may have been interrupted before a restart
+        job_db.remove(transcript_model.id == transcript_id)
+        lang_model.remove_checkpoint(transcript_id)
 
     # Update the transcription status
     if transcripts.contains(transcript_model.id == transcript_id):
         transcripts.update({"completed": True}, transcript_model.id == transcript_id)
 
-    transcription_in_progress = False
     return {"status": "stopped", "transcription_id": transcript_id}
 
 
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+import numpy as np
+import torch
+import whisper
+from whisper.model import AudioEncoder, ModelDimensions, TextDecoder, Whisper
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+WEIGHTS_FILE = "weights.bin"
+# offsets of the tensors in the weights file are aligned for vectorised loads
+ALIGNMENT = 64
+
+
+def default_download_root() -> str:
+    default = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+
+
+def convert_checkpoint(checkpoint_path: str, target_dir: str):
+    """
+    Write the weights of a Whisper checkpoint as float32 into one flat file, with an index of the
+    tensor offsets. The conversion is written next to `target_dir` and renamed into place, so
+    processes converting the same checkpoint at once do not see partial files.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    parent = os.path.dirname(os.path.abspath(target_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".mmap-")
+
+    tensors = dict()
+    offset = 0
+    try:
+        with open(os.path.join(tmp_dir, WEIGHTS_FILE), "wb") as weights:
+            for name, tensor in checkpoint["model_state_dict"].items():
+                data = tensor.detach().to(torch.float32).contiguous().numpy()
+                padding = -offset % ALIGNMENT
+                weights.write(b"\0" * padding)
+                offset += padding
+                tensors[name] = dict(shape=list(data.shape), offset=offset)
+                weights.write(data.tobytes())
+                offset += data.nbytes
+
+        with open(os.path.join(tmp_dir, INDEX_FILE), "w") as index:
+            json.dump(dict(dims=checkpoint["dims"], dtype="float32", tensors=tensors), index)
+
+        os.rename(tmp_dir, target_dir)
+    except OSError:
+        # another process finished converting first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isfile(os.path.join(target_dir, INDEX_FILE)):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def empty_model(dims: ModelDimensions) -> Whisper:
+    """`Whisper(dims)` without allocating and initialising the weights, which are assigned later"""
+    model = Whisper.__new__(Whisper)
+    torch.nn.Module.__init__(model)
+    model.dims = dims
+    with torch.device("meta"):
+        model.encoder = AudioEncoder(
+            dims.n_mels, dims.n_audio_ctx, dims.n_audio_state, dims.n_audio_head, dims.n_audio_layer
+        )
+        model.decoder = TextDecoder(
+            dims.n_vocab, dims.n_text_ctx, dims.n_text_state, dims.n_text_head, dims.n_text_layer
+        )
+
+    # the buffers that are not part of the checkpoint, as set up by Whisper.__init__
+    mask = torch.empty(dims.n_text_ctx, dims.n_text_ctx).fill_(-np.inf).triu_(1)
+    model.decoder.register_buffer("mask", mask, persistent=False)
+    all_heads = torch.zeros(dims.n_text_layer, dims.n_text_head, dtype=torch.bool)
+    all_heads[dims.n_text_layer // 2 :] = True
+    model.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
+    return model
+
+
+def load_converted(converted_dir: str) -> Whisper:
+    """Load a converted checkpoint with all weights backed by the memory-mapped weights file"""
+    with open(os.path.join(converted_dir, INDEX_FILE)) as index_file:
+        index = json.load(index_file)
+
+    # copy-on-write: pages are shared through the page cache and never written back
+    weights = np.memmap(os.path.join(converted_dir, WEIGHTS_FILE), dtype=np.uint8, mode="c")
+    model = empty_model(ModelDimensions(**index["dims"]))
+
+    for name, entry in index["tensors"].items():
+        shape = entry["shape"]
+        n_bytes = int(np.prod(shape, dtype=np.int64)) * 4
+        array = weights[entry["offset"] : entry["offset"] + n_bytes].view(np.float32)
+        tensor = torch.from_numpy(array.reshape(shape))
+
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attribute in module._parameters:
+            module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attribute] = tensor
+
+    missing = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f"{converted_dir} has no weights for {missing}")
+    return model
+
+
+def load_model(
+    name: str, download_root: Optional[str] = None, device: Optional[str] = None
+) -> Whisper:
+    """
+    `whisper.load_model` with memory-mapped weights. The checkpoint is converted once into
+    `<download_root>/<name>.mmap`; every process loading the model afterwards maps the same file,
+    so the weights are held in memory once per host and loading does not read them up front.
+
+    Only float32 inference uses the mapped weights directly; int8 quantization and moving the
+    model to a GPU copy them.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    download_root = download_root or default_download_root()
+
+    if name in whisper._MODELS:
+        converted_dir = os.path.join(download_root, f"{name}.mmap")
+        alignment_heads = whisper._ALIGNMENT_HEADS[name]
+    elif os.path.isfile(name):
+        converted_dir = f"{os.path.splitext(name)[0]}.mmap"
+        alignment_heads = None
+    else:
+        raise RuntimeError(
+            f"Model {name} not found; available models = {whisper.available_models()}"
+        )
+
+    if not os.path.isfile(os.path.join(converted_dir, INDEX_FILE)):
+        checkpoint_path = (
+            whisper._download(whisper._MODELS[name], download_root, False)
+            if name in whisper._MODELS
+            else name
+        )
+        logger.info(f"Converting {checkpoint_path} for memory mapping into {converted_dir}")
+        convert_checkpoint(checkpoint_path, converted_dir)
+
+    model = load_converted(converted_dir)
+    if alignment_heads is not None:
+        model.set_alignment_heads(alignment_heads)
+    return model.to(device)
@@ -0,0 +1,166 @@
+import logging
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Condition, Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from backends import InferenceBackend
+
+logger = logging.getLogger(__name__)
+
+
+def resident_memory_bytes() -> int:
+    """Resident set size of this process, or 0 where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+@dataclass
+class ResidentModel:
+    backend: InferenceBackend
+    memory_bytes: int
+    in_use: int = 0
+
+
+class ModelRegistry:
+    """
+    Loads inference backends by model name on demand and keeps them loaded while they fit into
+    `memory_budget` bytes. When a newly loaded model exceeds the budget, the least recently used
+    models that no job is running on are unloaded. Pinned models are never unloaded.
+    """
+
+    def __init__(
+        self,
+        create_backend: Callable[[str], InferenceBackend],
+        memory_budget: int = 0,
+        allowed_models: Optional[Iterable[str]] = None,
+        pinned_models: Iterable[str] = (),
+    ):
+        self.create_backend = create_backend
+        self.memory_budget = memory_budget  # 0 for no limit
+        self.allowed_models = set(allowed_models) if allowed_models is not None else None
+        self.pinned_models = set(pinned_models)
+        self._models: "OrderedDict[str, ResidentModel]" = OrderedDict()
+        self._lock = Lock()
+        # notified whenever a model finished loading or a job released a model
+        self._changed = Condition(self._lock)
+        self._loading = set()
+
+    def is_allowed(self, model_name: str) -> bool:
+        return self.allowed_models is None or model_name in self.allowed_models
+
+    @contextmanager
+    def use(self, model_name: str) -> Iterator[InferenceBackend]:
+        """Backend of the model, loaded if needed, which is kept loaded until the block exits"""
+        resident = self._acquire(model_name)
+        try:
+            yield resident.backend
+        finally:
+            with self._lock:
+                resident.in_use -= 1
+                # models kept over the budget while jobs ran on them can go now
+                evicted = self._evict()
+                self._changed.notify_all()
+            self._close(evicted)
+
+    def get(self, model_name: str) -> InferenceBackend:
+        """Backend of the model, without keeping it from being unloaded"""
+        with self.use(model_name) as backend:
+            return backend
+
+    def _acquire(self, model_name: str) -> ResidentModel:
+        if not self.is_allowed(model_name):
+            raise ValueError(f"Model {model_name!r} is not allowed")
+
+        with self._lock:
+            # another job may be loading the same model
+            while model_name in self._loading:
+                self._changed.wait()
+
+            resident = self._models.get(model_name)
+            if resident is not None:
+                self._models.move_to_end(model_name)
+                resident.in_use += 1
+                return resident
+
+            self._loading.add(model_name)
+
+        try:
+            memory_before = resident_memory_bytes()
+            backend = self.create_backend(model_name)
+            backend.load()
+            memory_bytes = backend.memory_bytes() or max(
+                resident_memory_bytes() - memory_before, 0
+            )
+        except BaseException:
+            with self._lock:
+                self._loading.discard(model_name)
+                self._changed.notify_all()
+            raise
+
+        logger.info(f"[MODELS] Loaded {model_name} ({memory_bytes / 2 ** 20:.0f} MB)")
+        with self._lock:
+            resident = ResidentModel(backend, memory_bytes, in_use=1)
+            self._models[model_name] = resident
+            self._loading.discard(model_name)
+            evicted = self._evict()
+            self._changed.notify_all()
+
+        self._close(evicted)
+        return resident
+
+    @staticmethod
+    def _close(evicted: List[tuple]):
+        for name, backend in evicted:
+            logger.info(f"[MODELS] Unloading {name} to stay within the memory budget")
+            backend.close()
+
+    def _evict(self) -> List[tuple]:
+        """Remove least recently used models until the budget is met; the lock must be held"""
+        if not self.memory_budget:
+            return []
+
+        evicted = []
+        total = sum(resident.memory_bytes for resident in self._models.values())
+        for name in list(self._models):
+            if total <= self.memory_budget:
+                break
+            resident = self._models[name]
+            if resident.in_use or name in self.pinned_models:
+                continue
+            del self._models[name]
+            total -= resident.memory_bytes
+            evicted.append((name, resident.backend))
+
+        return evicted
+
+    def resident(self) -> List[Dict]:
+        """The loaded models, least recently used first"""
+        with self._lock:
+            return [
+                dict(
+                    name=name,
+                    backend=resident.backend.name,
+                    precision=resident.backend.precision,
+                    memory_mb=round(resident.memory_bytes / 2 ** 20, 1),
+                    jobs=resident.in_use,
+                    pinned=name in self.pinned_models,
+                )
+                for name, resident in self._models.items()
+            ]
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(resident.memory_bytes for resident in self._models.values())
+
+    def close(self):
+        with self._lock:
+            models = list(self._models.values())
+            self._models.clear()
+        for resident in models:
+            resident.backend.close()
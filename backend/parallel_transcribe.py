@@ -0,0 +1,256 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from queue import Queue
+from threading import Lock
+from typing import List, Optional
+
+import numpy as np
+from whisper.audio import HOP_LENGTH, SAMPLE_RATE, load_audio
+
+from cancellation import CancellationToken
+from transcribe import DERIVED_STATS, summarize_stats
+from vad import detect_speech
+
+logger = logging.getLogger(__name__)
+
+# inference backend of the worker process, loaded once by the pool initializer
+_worker_backend = None
+
+
+def worker_backend_options(backend: str, backend_options: dict, num_threads: int) -> dict:
+    """Backend options for a worker process, which runs one transcription at a time"""
+    if backend == "pytorch":
+        # there is nothing to batch
+        return dict(backend_options, use_broker=False)
+    return dict(backend_options, cpu_threads=num_threads)
+
+
+def _init_worker(
+    backend: str,
+    model_name: str,
+    model_dir: str,
+    num_threads: int,
+    precision: str,
+    backend_options: dict,
+):
+    global _worker_backend
+    import torch
+
+    from backends import create_backend
+
+    torch.set_num_threads(num_threads)
+    _worker_backend = create_backend(
+        backend,
+        model_name,
+        model_dir,
+        precision,
+        **worker_backend_options(backend, backend_options, num_threads),
+    )
+    _worker_backend.load()
+
+
+def _transcribe_chunk(audio: np.ndarray, options: dict, cancel_event=None) -> dict:
+    cancel_token = CancellationToken(cancel_event) if cancel_event is not None else None
+    return _worker_backend.transcribe(
+        audio, process_queue=Queue(), cancel_token=cancel_token, **options
+    )
+
+
+def find_chunk_boundaries(
+    audio: np.ndarray, n_chunks: int, min_chunk_duration: float = 60.0
+) -> List[int]:
+    """
+    Split points (in samples, including 0 and the end) dividing the audio into up to `n_chunks`
+    chunks of roughly equal length. Every split is moved to the middle of the nearest pause, so
+    no chunk starts or ends in the middle of a word.
+    """
+    n_chunks = max(1, min(n_chunks, int(len(audio) / SAMPLE_RATE / min_chunk_duration)))
+    if n_chunks == 1:
+        return [0, len(audio)]
+
+    regions = detect_speech(audio, min_silence_duration=0.5, speech_pad=0.1)
+    pauses = (regions[:-1, 1] + regions[1:, 0]) // 2 if len(regions) > 1 else np.zeros(0)
+    max_shift = len(audio) / n_chunks / 2
+
+    boundaries = [0]
+    for k in range(1, n_chunks):
+        target = k * len(audio) // n_chunks
+        if len(pauses) > 0:
+            nearest = int(pauses[np.argmin(np.abs(pauses - target))])
+            if abs(nearest - target) <= max_shift:
+                target = nearest
+        if target > boundaries[-1]:
+            boundaries.append(target)
+    boundaries.append(len(audio))
+
+    return boundaries
+
+
+def merge_stats(all_stats: List[dict]) -> dict:
+    merged = {}
+    for stats in all_stats:
+        for key, value in (stats or {}).items():
+            if key not in DERIVED_STATS:
+                merged[key] = merged.get(key, 0) + value
+    return summarize_stats(merged)
+
+
+class ChunkParallelTranscriber:
+    """
+    Transcribes long recordings by splitting them at pauses into chunks, which are transcribed
+    by the inference backend in separate worker processes. Each worker loads its own copy of the
+    model and uses its share of the CPU cores. A cancelled job also stops the chunks that are
+    already running, through an event shared by a manager process.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        model_dir: str,
+        n_workers: int,
+        threads_per_worker: Optional[int] = None,
+        precision: str = "float32",
+        backend: str = "pytorch",
+        backend_options: Optional[dict] = None,
+    ):
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker or max(
+            1, (os.cpu_count() or 1) // n_workers
+        )
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                backend,
+                model_name,
+                model_dir,
+                self.threads_per_worker,
+                precision,
+                backend_options or {},
+            ),
+        )
+        self._manager = None
+        self._manager_lock = Lock()
+
+    def cancel_event(self):
+        """An event the chunk workers can check; the manager process is started on first use"""
+        with self._manager_lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context("spawn").Manager()
+            return self._manager.Event()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+    def transcribe(
+        self,
+        audio,
+        *,
+        process_queue,
+        job_id=None,
+        end_callback=None,
+        should_stop=None,
+        cancel_token: Optional[CancellationToken] = None,
+        verbose=None,
+        **options,
+    ) -> dict:
+        """Same contract as `transcribe()`; the segments are emitted in order as chunks finish"""
+        if isinstance(audio, str):
+            audio = load_audio(audio)
+
+        cancel_event = None
+        if cancel_token is not None:
+            cancel_event = self.cancel_event()
+            cancel_token.add_callback(cancel_event.set)
+
+        boundaries = find_chunk_boundaries(audio, self.n_workers)
+        logger.info(
+            f"[Job {job_id}] Transcribing {len(boundaries) - 1} chunks on {self.n_workers} "
+            f"workers with {self.threads_per_worker} threads each"
+        )
+
+        futures = [
+            self.executor.submit(_transcribe_chunk, audio[start:end], options, cancel_event)
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+        del audio
+
+        results: List[Optional[dict]] = [None] * len(futures)
+        all_segments = []
+        emitted = 0
+        stopped = False
+
+        while emitted < len(futures):
+            done, _ = wait([futures[emitted]], timeout=1.0, return_when=FIRST_COMPLETED)
+            if (should_stop is not None and should_stop()) or (
+                cancel_token is not None and cancel_token.is_cancelled()
+            ):
+                stopped = True
+                # running chunks stop at their next decoder step
+                for future in futures:
+                    future.cancel()
+                break
+            if not done:
+                continue
+
+            # emit every chunk that is finished and has all its predecessors emitted
+            while emitted < len(futures) and futures[emitted].done():
+                result = results[emitted] = futures[emitted].result()
+                offset = boundaries[emitted]
+
+                for segment in result["segments"]:
+                    segment = {
+                        **segment,
+                        "id": len(all_segments),
+                        "seek": segment["seek"] + offset // HOP_LENGTH,
+                        "start": segment["start"] + offset / SAMPLE_RATE,
+                        "end": segment["end"] + offset / SAMPLE_RATE,
+                    }
+                    all_segments.append(segment)
+                    process_queue.put(
+                        dict(
+                            channel="message",
+                            data=dict(
+                                start=segment["start"],
+                                end=segment["end"],
+                                text=segment["text"],
+                                copy=True,
+                            ),
+                            job_id=job_id,
+                        )
+                    )
+
+                emitted += 1
+                process_queue.put(
+                    dict(
+                        channel="timer",
+                        data=dict(timer=boundaries[emitted] // HOP_LENGTH),
+                        job_id=job_id,
+                    )
+                )
+
+        if cancel_token is not None:
+            cancel_token.remove_callback(cancel_event.set)
+        if stopped:
+            print(f"Stopping transcription for job {job_id}")
+
+        finished = [result for result in results if result is not None]
+        stats = merge_stats([result.get("stats") for result in finished])
+        stats["chunks"] = len(futures)
+
+        process_queue.put(dict(channel="message", job_id=job_id, data="end", stats=stats))
+        end_data = dict(
+            text="".join(result["text"] for result in finished),
+            segments=all_segments,
+            language=finished[0]["language"] if finished else options.get("language"),
+            stats=stats,
+        )
+        if end_callback:
+            end_callback(end_data)
+
+        return end_data
@@ -0,0 +1,99 @@
+import logging
+import warnings
+from contextlib import nullcontext
+from typing import Tuple, TYPE_CHECKING
+
+import torch
+from torch import nn
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+
+logger = logging.getLogger(__name__)
+
+PRECISION_MODES = ("float32", "int8", "bf16")
+
+
+def has_native_bf16() -> bool:
+    """True if the CPU has bf16 instructions; emulated bf16 is slower than float32"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        pass
+
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def quantize_int8(model: "Whisper") -> "Whisper":
+    """Dynamic int8 quantization of all Linear layers, for CPU inference"""
+    # Whisper uses its own Linear subclass, which only casts the weight to the input dtype;
+    # quantize_dynamic only converts exact nn.Linear modules
+    for module in model.modules():
+        if isinstance(module, nn.Linear):
+            module.__class__ = nn.Linear
+
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def inference_context(model: "Whisper"):
+    """The autocast context of a model prepared by `apply_precision`, for code calling its layers"""
+    autocast_dtype = getattr(model, "autocast_dtype", None)
+    if autocast_dtype is None:
+        return nullcontext()
+    return torch.autocast(model.device.type, dtype=autocast_dtype)
+
+
+def autocast_bf16(model: "Whisper") -> "Whisper":
+    """Run the encoder and decoder under bf16 autocast, on whichever thread calls them"""
+    model.autocast_dtype = torch.bfloat16
+
+    encoder_forward = model.encoder.forward
+    decoder_forward = model.decoder.forward
+
+    def encoder_forward_bf16(mel: torch.Tensor):
+        with inference_context(model):
+            audio_features = encoder_forward(mel)
+        # the decoding task checks that the audio features have the dtype of the mel
+        return audio_features.to(mel.dtype)
+
+    def decoder_forward_bf16(*args, **kwargs):
+        with inference_context(model):
+            return decoder_forward(*args, **kwargs)
+
+    model.encoder.forward = encoder_forward_bf16
+    model.decoder.forward = decoder_forward_bf16
+    return model
+
+
+def apply_precision(model: "Whisper", mode: str) -> Tuple["Whisper", str]:
+    """
+    Prepare a float32 model for inference in the given precision mode.
+
+    Returns the model and the mode it actually runs in, which is float32 if the requested mode
+    is not supported on the model's device.
+    """
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode {mode!r}, expected one of {PRECISION_MODES}")
+
+    if mode == "int8":
+        if model.device.type != "cpu":
+            warnings.warn("int8 quantization is only supported on CPU; using float32 instead")
+            return model, "float32"
+        return quantize_int8(model), mode
+
+    if mode == "bf16":
+        if model.device.type == "cuda":
+            supported = torch.cuda.is_bf16_supported()
+        else:
+            supported = has_native_bf16()
+        if not supported:
+            warnings.warn("bf16 is not supported on this device; using float32 instead")
+            return model, "float32"
+        return autocast_bf16(model), mode
+
+    return model, mode
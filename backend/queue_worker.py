@@ -0,0 +1,222 @@
+"""
+Transcription worker for the distributed mode: claims jobs from the job queue the API puts them
+in, transcribes them with the model configured by the WHISPER_* variables and writes the results
+back to the queue.
+
+    JOB_QUEUE_URL=sqlite:////shared/jobs.db python queue_worker.py --jobs 2
+
+The audio is read from the path the API stored it at, so backend/audio_files and backend/temp
+have to be shared with the API host at the same paths.
+"""
+import argparse
+import logging
+import os
+import socket
+import time
+import traceback
+from threading import Event, Thread
+
+from dotenv import load_dotenv
+
+from job_queue import COMPLETED, JobQueue, QueuedJob, create_job_queue
+
+logger = logging.getLogger(__name__)
+
+
+class QueueWorker:
+    """Runs the jobs it claims one at a time, holding the lease of each while it runs"""
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        lang_model,
+        worker_id: str,
+        lease_seconds: float = 60.0,
+        poll_interval: float = 2.0,
+    ):
+        self.job_queue = job_queue
+        self.lang_model = lang_model
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.stopped = Event()
+
+    def forward_messages(self, job: QueuedJob):
+        """Pass the segments of the job on to the queue; returns the job's error, if any"""
+        messages, error = [], None
+        for data, finished in self.lang_model.empty_process_queue(job.id):
+            if data.get("is_error"):
+                error = data
+            elif not finished and "timer" not in data:
+                text = data["text"].strip() if data["text"] else ""
+                messages.append(dict(start=data["start"], end=data["end"], text=text))
+        self.job_queue.append_messages(job.id, self.worker_id, messages)
+        return error
+
+    def run_job(self, job: QueuedJob):
+        payload = job.payload
+        logger.info(
+            f"[WORKER {self.worker_id}] Running {payload.get('kind')} job {job.id} "
+            f"(attempt {job.attempts})"
+        )
+        end_data = dict()
+        errors = []
+        finished = Event()
+        cancelled = Event()
+
+        def keep_alive():
+            last_heartbeat = time.monotonic()
+            while not finished.wait(1.0):
+                if time.monotonic() - last_heartbeat >= self.lease_seconds / 3:
+                    last_heartbeat = time.monotonic()
+                    lost = not self.job_queue.heartbeat(job.id, self.worker_id, self.lease_seconds)
+                else:
+                    # a stop reaches the job within a second, not only with the next renewal
+                    lost = self.job_queue.stop_requested(job.id, self.worker_id)
+                if lost:
+                    logger.info(f"[WORKER {self.worker_id}] Job {job.id} cancelled or lost")
+                    cancelled.set()
+                    self.lang_model.stop_transcription(job.id)
+                    # the segments of a cancelled job are not wanted anymore
+                    return
+                errors.append(self.forward_messages(job))
+
+        # re-transcribed ranges are prompted with their context, so they are never taken from the
+        # result cache
+        if not payload.get("range"):
+            cached = self.lang_model.cached_result(
+                payload["audio_file"], model_name=payload.get("model_name")
+            )
+            if cached is not None:
+                self.complete(job, cached)
+                return
+
+        audio = payload["audio_file"]
+        if payload.get("range"):
+            # only a range of the recording is transcribed again
+            audio = self.lang_model.load_audio_range(audio, *payload["range"])
+
+        heartbeat = Thread(target=keep_alive, name=f"heartbeat-{job.id}", daemon=True)
+        heartbeat.start()
+        try:
+            self.lang_model.transcribe_job(
+                audio,
+                job.id,
+                end_data.update,
+                model_name=payload.get("model_name"),
+                # a redelivered upload job continues from its checkpoint
+                resumable=not payload.get("range"),
+                **payload.get("decode_options", {}),
+            )
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        if not cancelled.is_set():
+            errors.append(self.forward_messages(job))
+        self.lang_model.release_process_queue(job.id)
+
+        error = next((error for error in errors if error), None)
+        if error is not None:
+            # failed jobs are not delivered again
+            self.lang_model.remove_checkpoint(job.id)
+            self.job_queue.fail(job.id, self.worker_id, error["error"])
+            logger.error(f"[WORKER {self.worker_id}] Job {job.id} failed: {error['error']}")
+            return
+
+        if self.complete(job, end_data) and not payload.get("range"):
+            if self.job_queue.get(job.id).state == COMPLETED:
+                self.lang_model.store_result(
+                    payload["audio_file"], end_data, model_name=payload.get("model_name")
+                )
+
+    def complete(self, job: QueuedJob, end_data: dict) -> bool:
+        segments = end_data.get("segments") or []
+        chunks = [
+            dict(start=segment["start"], end=segment["end"], text=segment["text"].strip())
+            for segment in segments
+        ]
+        result = dict(
+            text=" ".join(chunk["text"] for chunk in chunks).strip(),
+            chunks=chunks,
+            segments=segments,
+            language=end_data.get("language"),
+            stats=end_data.get("stats"),
+        )
+        if self.job_queue.complete(job.id, self.worker_id, result):
+            logger.info(f"[WORKER {self.worker_id}] Job {job.id} finished")
+            return True
+        logger.warning(f"[WORKER {self.worker_id}] Job {job.id} was taken over, result dropped")
+        return False
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.job_queue.claim(self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"[WORKER {self.worker_id}] Claiming a job failed: {e}")
+                job = None
+            if job is None:
+                self.stopped.wait(self.poll_interval)
+                continue
+
+            try:
+                self.run_job(job)
+            except Exception as e:
+                logger.error(f"[WORKER {self.worker_id}] Job {job.id} failed: {e}")
+                logger.error(traceback.format_exc())
+                self.lang_model.remove_checkpoint(job.id)
+                self.job_queue.fail(job.id, self.worker_id, str(e))
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queue-url", default=os.getenv("JOB_QUEUE_URL"))
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--jobs", type=int, default=1, help="jobs run at the same time")
+    parser.add_argument(
+        "--lease", type=float, default=float(os.getenv("JOB_QUEUE_LEASE_SECONDS", "60"))
+    )
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    args = parser.parse_args()
+    if not args.queue_url:
+        parser.error("set JOB_QUEUE_URL or pass --queue-url")
+
+    from LangModel import LangModel
+
+    job_queue = create_job_queue(
+        args.queue_url, max_attempts=int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", "3"))
+    )
+    lang_model = LangModel()
+    if os.getenv("WHISPER_WARMUP", "1") in {"1", "true", "True"}:
+        lang_model.warmup()
+
+    workers = [
+        QueueWorker(
+            job_queue,
+            lang_model,
+            f"{args.worker_id}-{i}" if args.jobs > 1 else args.worker_id,
+            lease_seconds=args.lease,
+            poll_interval=args.poll_interval,
+        )
+        for i in range(args.jobs)
+    ]
+    threads = [Thread(target=worker.run, name=worker.worker_id) for worker in workers]
+    logger.info(f"Claiming jobs from {args.queue_url} with {len(workers)} workers")
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.stopped.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+from typing import Optional
+
+from audio_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Transcription results on disk, keyed by the content of the audio file and the settings it
+    was transcribed with, so that a recording that arrives again (a duplicate upload, a webhook
+    fired twice) is answered without transcribing it. At most `max_entries` results are kept;
+    the least recently used ones are removed first.
+    """
+
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def key(audio_file: str, settings: dict) -> str:
+        key = dict(audio=file_digest(audio_file), settings=settings)
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True, default=repr).encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str, count_miss: bool = True) -> Optional[dict]:
+        """
+        The stored result, or None. Lookups that are repeated for the same job (e.g. once when
+        it is submitted and again when it runs) pass `count_miss=False` the second time.
+        """
+        try:
+            with open(self._path(key)) as f:
+                result = json.load(f)
+            # the modification time is the entry's last use
+            os.utime(self._path(key))
+        except (FileNotFoundError, ValueError):
+            if count_miss:
+                with self._lock:
+                    self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict):
+        # written next to the entry and renamed, so that readers never see half a result
+        temp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(temp_path, self._path(key))
+        self._evict()
+
+    def info(self) -> dict:
+        return dict(
+            directory=self.directory,
+            entries=len(self._entries()),
+            max_entries=self.max_entries,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+            except FileNotFoundError:
+                pass  # removed by another process meanwhile
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        for _, name in entries[: max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
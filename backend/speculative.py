@@ -0,0 +1,241 @@
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from whisper.decoding import DecodingOptions, DecodingTask, LogitFilter
+from whisper.utils import compression_ratio
+
+from cancellation import CancellationToken
+from precision import inference_context
+from window_decoding import CancellationCheck, RepetitionGuard, WindowResult
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+
+
+def cache_length(kv_cache: dict) -> int:
+    # the first entry is always the self-attention key of the first block
+    return next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+
+
+class CausalMask:
+    """
+    Stands in for the decoder's causal mask when several tokens are fed after cached ones.
+    Whisper slices the mask as `mask[:n_ctx, :n_ctx]` for `n_ctx` new tokens, which is only
+    right when there are no cached tokens before them.
+    """
+
+    def __init__(self, mask: torch.Tensor, offset: int):
+        self.mask = mask
+        self.offset = offset
+
+    def __getitem__(self, index):
+        n_ctx = index[0].stop
+        return self.mask[self.offset : self.offset + n_ctx, : self.offset + n_ctx]
+
+
+def decoder_logits(
+    model: "Whisper", tokens: torch.Tensor, audio_features: torch.Tensor, kv_cache: dict
+) -> torch.Tensor:
+    """`TextDecoder.forward`, for any number of new tokens after the cached ones"""
+    decoder = model.decoder
+    offset = cache_length(kv_cache)
+
+    with inference_context(model):
+        x = (
+            decoder.token_embedding(tokens)
+            + decoder.positional_embedding[offset : offset + tokens.shape[-1]]
+        )
+        x = x.to(audio_features.dtype)
+
+        mask = CausalMask(decoder.mask, offset)
+        for block in decoder.blocks:
+            x = block(x, audio_features, mask=mask, kv_cache=kv_cache)
+
+        x = decoder.ln(x)
+        return (x @ torch.transpose(decoder.token_embedding.weight.to(x.dtype), 0, 1)).float()
+
+
+class SpeculativeDecoder:
+    """
+    Greedy decoding of one window, where a small draft model proposes `num_draft_tokens` tokens
+    at a time and the main model checks all of them in a single forward pass. The main model
+    keeps every proposed token it would have picked itself and replaces the first one it
+    disagrees with, so the output is the same as greedy decoding with the main model alone.
+
+    Both models must share the tokenizer, e.g. a multilingual tiny or base draft for large-v2.
+    """
+
+    def __init__(self, model: "Whisper", draft_model: "Whisper", num_draft_tokens: int = 5):
+        if model.dims.n_vocab != draft_model.dims.n_vocab:
+            raise ValueError(
+                "The draft model must have the vocabulary of the main model "
+                f"({draft_model.dims.n_vocab} != {model.dims.n_vocab} tokens)"
+            )
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+
+    @staticmethod
+    def _truncate(model: "Whisper", kv_cache: dict, length: int):
+        """Drop the self-attention cache entries of tokens that were not committed"""
+        for block in model.decoder.blocks:
+            for module in (block.attn.key, block.attn.value):
+                if module in kv_cache:
+                    kv_cache[module] = kv_cache[module][:, :length]
+
+    def _propose(
+        self,
+        tokens: torch.Tensor,
+        draft_features: torch.Tensor,
+        kv_cache: dict,
+        logit_filters: List[LogitFilter],
+        n_tokens: int,
+        eot: int,
+    ) -> torch.Tensor:
+        proposal = tokens
+        for _ in range(n_tokens):
+            offset = cache_length(kv_cache)
+            logits = decoder_logits(
+                self.draft_model, proposal[:, offset:], draft_features, kv_cache
+            )[:, -1]
+            for logit_filter in logit_filters:
+                logit_filter.apply(logits, proposal)
+            next_token = logits.argmax(dim=-1)
+            proposal = torch.cat([proposal, next_token[:, None]], dim=-1)
+            if next_token.item() == eot:
+                break
+
+        return proposal[:, tokens.shape[-1] :]
+
+    @torch.no_grad()
+    def decode(
+        self,
+        audio_features: torch.Tensor,
+        mel: torch.Tensor,
+        options: DecodingOptions,
+        repetition_guard: bool = False,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Tuple[WindowResult, Dict[str, int]]:
+        """
+        Decode the window with the encoder features `audio_features` of the main model and the
+        mel segment `mel` for the draft model, at temperature 0 without beam search. Returns the
+        result and the number of generated tokens, proposed and accepted draft tokens and main
+        model passes. A cancelled `cancel_token` aborts the decode between two steps of either
+        model with `TranscriptionCancelled`.
+        """
+        task = DecodingTask(self.model, options)
+        tokenizer = task.tokenizer
+        logit_filters = list(task.logit_filters)
+        guard = None
+        if repetition_guard:
+            guard = RepetitionGuard(tokenizer.eot, task.sample_begin, tokenizer.timestamp_begin)
+            logit_filters.append(guard)
+        if cancel_token is not None:
+            logit_filters.append(
+                CancellationCheck(tokenizer.eot, task.sample_begin, [cancel_token], 1)
+            )
+
+        if audio_features.ndim == 2:
+            audio_features = audio_features.unsqueeze(0)
+        if mel.ndim == 2:
+            mel = mel.unsqueeze(0)
+        draft_features = self.draft_model.embed_audio(mel)
+
+        n_ctx = self.model.dims.n_text_ctx
+        tokens = torch.tensor([task.initial_tokens], device=audio_features.device)
+        sum_logprob = 0.0
+        no_speech_prob = np.nan
+        counters = dict(proposed=0, accepted=0, target_passes=0)
+
+        kv_cache, hooks = self.model.install_kv_cache_hooks()
+        draft_kv_cache, draft_hooks = self.draft_model.install_kv_cache_hooks()
+        try:
+            finished = False
+            while not finished:
+                n_sampled = tokens.shape[-1] - task.sample_begin
+                n_draft = min(
+                    self.num_draft_tokens,
+                    task.sample_len - n_sampled - 1,
+                    n_ctx - tokens.shape[-1],
+                )
+                proposal = self._propose(
+                    tokens,
+                    draft_features,
+                    draft_kv_cache,
+                    logit_filters,
+                    n_draft,
+                    tokenizer.eot,
+                )
+                counters["proposed"] += proposal.shape[-1]
+
+                # one pass of the main model over the last committed token and the proposal
+                offset = cache_length(kv_cache)
+                logits = decoder_logits(
+                    self.model,
+                    torch.cat([tokens, proposal], dim=-1)[:, offset:],
+                    audio_features,
+                    kv_cache,
+                )
+                counters["target_passes"] += 1
+                if offset == 0 and tokenizer.no_speech is not None:
+                    probs_at_sot = logits[:, task.sot_index].float().softmax(dim=-1)
+                    no_speech_prob = probs_at_sot[0, tokenizer.no_speech].item()
+
+                # the predictions for the next token and for the token after each proposed one
+                logits = logits[:, tokens.shape[-1] - 1 - offset :]
+                for j in range(logits.shape[1]):
+                    step_logits = logits[:, j].clone()
+                    for logit_filter in logit_filters:
+                        logit_filter.apply(step_logits, tokens)
+
+                    next_token = step_logits.argmax(dim=-1)
+                    logprobs = F.log_softmax(step_logits.float(), dim=-1)
+                    sum_logprob += logprobs[0, next_token].item()
+                    tokens = torch.cat([tokens, next_token[:, None]], dim=-1)
+
+                    matches = (
+                        j < proposal.shape[-1] and next_token.item() == proposal[0, j].item()
+                    )
+                    counters["accepted"] += matches
+                    if (
+                        next_token.item() == tokenizer.eot
+                        or tokens.shape[-1] - task.sample_begin >= task.sample_len
+                        or tokens.shape[-1] > n_ctx
+                    ):
+                        finished = True
+                        break
+                    if not matches:
+                        break
+
+                # the last committed token is fed in the next pass
+                self._truncate(self.model, kv_cache, tokens.shape[-1] - 1)
+                self._truncate(
+                    self.draft_model,
+                    draft_kv_cache,
+                    min(cache_length(draft_kv_cache), tokens.shape[-1] - 1),
+                )
+        finally:
+            for hook in hooks + draft_hooks:
+                hook.remove()
+
+        counters["tokens"] = tokens.shape[-1] - task.sample_begin
+        sampled = tokens[0, task.sample_begin :].tolist()
+        if sampled and sampled[-1] == tokenizer.eot:
+            sampled = sampled[:-1]
+        text = tokenizer.decode(sampled).strip()
+
+        result = WindowResult(
+            audio_features=audio_features[0],
+            language=options.language,
+            tokens=sampled,
+            text=text,
+            avg_logprob=sum_logprob / (len(sampled) + 1),
+            no_speech_prob=no_speech_prob,
+            temperature=0.0,
+            compression_ratio=compression_ratio(text),
+            repetition_aborted=guard is not None
+            and bool(guard.is_looping(torch.tensor([sampled]))[0]),
+        )
+        return result, counters
@@ -1,26 +1,103 @@
+import json
+import os
+import time
 import uuid
 import warnings
+from dataclasses import replace
 from typing import Optional, Tuple, Union, TYPE_CHECKING
 
 import warnings
-from typing import Optional, Tuple, Union, TYPE_CHECKING
+from typing import List, Optional, Tuple, Union, TYPE_CHECKING
 
 import numpy as np
 import torch
 import tqdm
 from whisper.audio import (
     SAMPLE_RATE,
+    load_audio,
     N_FRAMES,
     HOP_LENGTH,
     pad_or_trim,
-    log_mel_spectrogram,
 )
 from whisper.decoding import DecodingOptions, DecodingResult
 from whisper.tokenizer import LANGUAGES, get_tokenizer
 from whisper.utils import exact_div, format_timestamp
 
+from audio_stream import open_mel_source
+from cancellation import CancellationToken, TranscriptionCancelled
+from vad import detect_speech, pack_speech
+from window_decoding import WindowResult, decode_windows
+
 if TYPE_CHECKING:
     from whisper.model import Whisper
+    from inference_broker import InferenceBroker
+    from speculative import SpeculativeDecoder
+    from cascade import ModelCascade
+    from audio_cache import AudioCache
+
+
+def stop_requested(process_queue, job_id=None) -> bool:
+    """Check for a stop message in the queue without removing other messages"""
+    if process_queue is None:
+        return False
+    try:
+        for _ in range(process_queue.qsize()):
+            try:
+                # Get message without removing it
+                data = process_queue.get_nowait()
+                # Put it back
+                process_queue.put(data)
+                # Check if it's a stop signal
+                if data.get("channel") == "control" and data.get("data") == "stop":
+                    print(f"Received stop signal for job {job_id}")
+                    return True
+            except Exception:
+                pass
+        return False
+    except Exception:
+        return False
+
+
+# stats computed from the counters, which are not summed up when merging the stats of jobs
+DERIVED_STATS = ("speculative_acceptance_rate", "speculative_tokens_per_pass")
+
+
+def summarize_stats(stats: dict) -> dict:
+    """Add the rates derived from the counters of a job, e.g. after merging several jobs"""
+    if stats.get("speculative_proposed"):
+        stats["speculative_acceptance_rate"] = (
+            stats["speculative_accepted"] / stats["speculative_proposed"]
+        )
+    if stats.get("speculative_target_passes"):
+        # the speedup of the main model's decoder passes over plain greedy decoding
+        stats["speculative_tokens_per_pass"] = (
+            stats["speculative_tokens"] / stats["speculative_target_passes"]
+        )
+    return stats
+
+
+def load_checkpoint(path: Optional[str], fingerprint: dict) -> Optional[dict]:
+    """The state saved by an interrupted run of the same job, if there is one"""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if state.get("fingerprint") != fingerprint:
+        print(f"Ignoring checkpoint {path}, it was written with other settings")
+        return None
+    return state
+
+
+def save_checkpoint(path: str, state: dict):
+    # written next to the checkpoint and renamed, so that a crash never leaves half a file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
 
 
 def transcribe(
@@ -32,7 +109,19 @@ def transcribe(
     compression_ratio_threshold: Optional[float] = 2.4,
     logprob_threshold: Optional[float] = -1.0,
     no_speech_threshold: Optional[float] = 0.6,
+    no_speech_fast_threshold: Optional[float] = None,
     condition_on_previous_text: bool = True,
+    repetition_guard: bool = False,
+    batch_size: int = 1,
+    streaming: bool = False,
+    vad_filter: bool = False,
+    broker: Optional["InferenceBroker"] = None,
+    speculative: Optional["SpeculativeDecoder"] = None,
+    cascade: Optional["ModelCascade"] = None,
+    checkpoint: Optional[str] = None,
+    checkpoint_windows: int = 10,
+    audio_cache: Optional["AudioCache"] = None,
+    cancel_token: Optional[CancellationToken] = None,
     process_queue=None,
     end_callback=None,
     job_id: uuid = None,
@@ -67,45 +156,87 @@ def transcribe(
         If the no_speech probability is higher than this value AND the average log probability
         over sampled tokens is below `logprob_threshold`, consider the segment as silent
 
+    no_speech_fast_threshold: float
+        If the no_speech probability of the first decoder step is higher than this value, the
+        window is skipped right away, without decoding it and without any temperature fallback.
+        This is lossy: unlike the `no_speech_threshold` check, it cannot keep windows whose
+        decoded text has a high average log probability, since none is decoded yet
+
     condition_on_previous_text: bool
         if True, the previous output of the model is provided as a prompt for the next window;
         disabling may make the text inconsistent across windows, but the model becomes less prone to
         getting stuck in a failure loop, such as repetition looping or timestamps going out of sync.
 
+    repetition_guard: bool
+        If True, a decode that starts repeating the same phrase over and over is stopped as soon
+        as the loop is detected and treated as failed, instead of running up to the token limit
+
+    batch_size: int
+        Number of 30-second windows decoded together in one encoder/decoder pass. Only used when
+        `condition_on_previous_text` is False, since the windows are then independent of each other.
+        In batched mode the windows are cut at fixed 30-second boundaries and every window is only
+        conditioned on the initial prompt.
+
+    streaming: bool
+        If True and `audio` is a path, the file is decoded in chunks and the mel frames are
+        computed per window, so memory does not grow with the length of the recording.
+
+    vad_filter: bool
+        If True, long silences are cut out of the waveform before decoding and the remaining
+        utterances are packed into 30-second windows. Segment timestamps are mapped back to the
+        original recording. This needs the whole waveform in memory, so `streaming` is ignored.
+
+    broker: InferenceBroker
+        If given, windows are decoded through the broker so that they share forward passes with
+        the windows of other running jobs; otherwise `model.decode` is called directly.
+
+    speculative: SpeculativeDecoder
+        If given, the temperature 0 attempt of every window is decoded greedily with a draft model
+        proposing tokens for `model` to verify. Beam search and batched windows are decoded as
+        usual. The number of proposed and accepted tokens is counted in the stats.
+
+    cascade: ModelCascade
+        If given, every window is decoded with the cascade's fast model first, and only decoded
+        by `model` if the fast model's result is not confident enough; windows the fast model
+        finds silent are skipped. Every segment records the name of the model that produced it
+        in "model".
+
+    checkpoint: str
+        If given, the progress of the job is saved to this file every `checkpoint_windows`
+        windows. A run that finds the file of an interrupted run with the same settings
+        continues at the window it stopped at, and its result covers the whole recording. The file
+        is removed when the job finished or was stopped.
+
+    audio_cache: AudioCache
+        If given and `audio` is a path, the PCM and mel frames of the file are taken from the
+        cache if it has them. The windows are read from the memory-mapped frames, clamped like
+        those of the source `streaming` selects, so the result is the same. Otherwise the file is read as usual while the cache decodes it in
+        the background for the next job.
+
+    cancel_token: CancellationToken
+        Stops the job when cancelled. It is checked before every window, every temperature
+        fallback and every decoder step, so the job stops within one step of the decoder or one
+        pass of the encoder; the seconds it took are counted as "stop_latency_seconds" in the
+        stats. Without a token, stop messages on `process_queue` are looked for between windows.
+
     decode_options: dict
         Keyword arguments to construct `DecodingOptions` instances
 
     Returns
     -------
-    A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
-    the spoken language ("language"), which is detected when `decode_options["language"]` is None.
+    A dictionary containing the resulting text ("text") and segment-level details ("segments"), the
+    spoken language ("language"), which is detected when `decode_options["language"]` is None, and
+    counters about the decoding work done for the job ("stats").
     """
 
     print(
         f"Start transcribe process: {model.device} cuda: {torch.cuda.torch.cuda.is_available()}"
     )
 
-    # Check for stop signal function
     def should_stop():
-        if process_queue is None:
-            return False
-        try:
-            # Check if there's a stop message in the queue without removing other messages
-            for _ in range(process_queue.qsize()):
-                try:
-                    # Get message without removing it
-                    data = process_queue.get_nowait()
-                    # Put it back
-                    process_queue.put(data)
-                    # Check if it's a stop signal
-                    if data.get("channel") == "control" and data.get("data") == "stop":
-                        print(f"Received stop signal for job {job_id}")
-                        return True
-                except Exception:
-                    pass
-            return False
-        except Exception:
-            return False
+        if cancel_token is not None:
+            return cancel_token.is_cancelled()
+        return stop_requested(process_queue, job_id)
 
     dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
     if model.device == torch.device("cpu"):
@@ -117,8 +248,137 @@ def transcribe(
 
     if dtype == torch.float32:
         decode_options["fp16"] = False
+    decode_options.setdefault("fp16", True)
 
-    mel = log_mel_spectrogram(audio)
+    def model_decode(features: torch.Tensor, options: DecodingOptions, cancellable: bool = True):
+        token = cancel_token if cancellable else None
+        if broker is not None:
+            return broker.decode(
+                features, options, repetition_guard=repetition_guard, cancel_token=token
+            )
+        return decode_windows(
+            model, features, options, repetition_guard=repetition_guard, cancel_token=token
+        )
+
+    stats = dict(
+        windows=0,
+        decode_attempts=0,
+        decode_seconds=0.0,
+        repetition_aborts=0,
+        no_speech_skipped=0,
+        no_speech_probe_seconds=0.0,
+        no_speech_seconds_saved=0.0,
+    )
+    if cascade is not None:
+        stats.update(cascade_accepted=0, cascade_rejected=0, cascade_seconds=0.0)
+    if speculative is not None:
+        stats.update(
+            speculative_tokens=0,
+            speculative_proposed=0,
+            speculative_accepted=0,
+            speculative_target_passes=0,
+        )
+
+    def decode(features: torch.Tensor, options: DecodingOptions):
+        started = time.perf_counter()
+        # language detection is a single decoder step, done before the first window
+        result = model_decode(features, options, cancellable=options.task != "lang_id")
+        if options.task != "lang_id":
+            stats["decode_attempts"] += 1 if features.ndim == 2 else features.shape[0]
+            stats["decode_seconds"] += time.perf_counter() - started
+            stats["repetition_aborts"] += sum(
+                r.repetition_aborted for r in ([result] if features.ndim == 2 else result)
+            )
+        return result
+
+    def decode_speculative(
+        features: torch.Tensor, segment: torch.Tensor, options: DecodingOptions
+    ) -> WindowResult:
+        def run():
+            return speculative.decode(
+                features, segment, options, repetition_guard, cancel_token=cancel_token
+            )
+
+        started = time.perf_counter()
+        # the decoder's kv-cache hooks must not overlap with the broker's batches
+        result, counters = broker.run_exclusive(run) if broker is not None else run()
+        stats["decode_attempts"] += 1
+        stats["decode_seconds"] += time.perf_counter() - started
+        stats["repetition_aborts"] += result.repetition_aborted
+        for key, value in counters.items():
+            stats[f"speculative_{key}"] += value
+        return result
+
+    def decode_cascade(segments: torch.Tensor) -> List[WindowResult]:
+        started = time.perf_counter()
+        results = cascade.decode(
+            segments,
+            options_for_temperature(0.0),
+            repetition_guard=repetition_guard,
+            cancel_token=cancel_token,
+        )
+        stats["cascade_seconds"] += time.perf_counter() - started
+        accepted = sum(cascade_keeps(result) for result in results)
+        stats["cascade_accepted"] += accepted
+        stats["cascade_rejected"] += len(results) - accepted
+        return results
+
+    def cascade_keeps(result: WindowResult) -> bool:
+        # a window the fast model finds silent is skipped instead of decoded by the main model
+        return cascade.accepts(result) or is_silent(result)
+
+    @torch.no_grad()
+    def encode(segments: torch.Tensor, cancellable: bool = True) -> torch.Tensor:
+        if cancellable and cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        if broker is not None:
+            return broker.encode(segments, cancel_token=cancel_token if cancellable else None)
+        return model.embed_audio(segments)
+
+    # encoder features computed before the decoding loop reaches their window, by window seek
+    encoded_windows = {}
+
+    timeline = None
+    cached_audio = None
+    if audio_cache is not None and isinstance(audio, str):
+        cached_audio = audio_cache.peek(audio)
+        if cached_audio is None:
+            # building the entry first would delay the first segment by the decode of the file
+            audio_cache.fill(audio)
+        elif vad_filter:
+            audio = cached_audio.waveform()
+
+    if vad_filter:
+        if isinstance(audio, str):
+            audio = load_audio(audio)
+        elif isinstance(audio, torch.Tensor):
+            audio = audio.cpu().numpy()
+
+        original_duration = len(audio) / SAMPLE_RATE
+        audio, timeline = pack_speech(audio, detect_speech(audio))
+        print(
+            f"VAD kept {len(audio) / SAMPLE_RATE:.1f}s of {original_duration:.1f}s for job {job_id}"
+        )
+
+    if cached_audio is not None and timeline is None:
+        mel_source = cached_audio.mel_source(streaming=streaming)
+    else:
+        mel_source = open_mel_source(audio, streaming=streaming)
+
+    use_batches = batch_size > 1 and not condition_on_previous_text
+    # a checkpoint is only resumed by a run that cuts and prompts the windows the same way
+    fingerprint = dict(
+        dims=repr(model.dims),
+        task=decode_options.get("task", "transcribe"),
+        language=decode_options.get("language"),
+        initial_prompt=decode_options.get("initial_prompt"),
+        use_batches=use_batches,
+        vad_filter=vad_filter,
+    )
+    resumed = load_checkpoint(checkpoint, fingerprint)
+    if resumed is not None:
+        # the detected language of the interrupted run
+        decode_options["language"] = resumed["language"]
 
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
@@ -128,8 +388,15 @@ def transcribe(
                 print(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
-            segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
-            _, probs = model.detect_language(segment)
+            segment = (
+                pad_or_trim(mel_source.window(0), N_FRAMES).to(model.device).to(dtype)
+            )
+            # keep the features, the first window is decoded against them as well
+            encoded_windows[0] = encode(segment.unsqueeze(0), cancellable=False)[0]
+            probs = decode(
+                encoded_windows[0],
+                DecodingOptions(task="lang_id", fp16=decode_options["fp16"]),
+            ).language_probs
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -140,42 +407,100 @@ def transcribe(
     task = decode_options.get("task", "transcribe")
     tokenizer = get_tokenizer(model.is_multilingual, language=language, task=task)
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
-        temperatures = (
-            [temperature] if isinstance(temperature, (int, float)) else temperature
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
+
+    def options_for_temperature(t: float) -> DecodingOptions:
+        kwargs = {**decode_options}
+        if t > 0:
+            # disable beam_size and patience when t > 0
+            kwargs.pop("beam_size", None)
+            kwargs.pop("patience", None)
+        else:
+            # disable best_of when t == 0
+            kwargs.pop("best_of", None)
+
+        return DecodingOptions(**kwargs, temperature=t)
+
+    def needs_fallback(decode_result: WindowResult) -> bool:
+        if decode_result.repetition_aborted:
+            return True  # stopped while looping
+        if (
+            compression_ratio_threshold is not None
+            and decode_result.compression_ratio > compression_ratio_threshold
+        ):
+            return True  # too repetitive
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            return True  # average log probability is too low
+        return False
+
+    def probe_no_speech(features: torch.Tensor) -> List[bool]:
+        """Tell for a batch of windows whether the first decoder step is confident of silence"""
+        if no_speech_fast_threshold is None:
+            return [False] * features.shape[0]
+
+        options = replace(
+            options_for_temperature(0.0), sample_len=1, beam_size=None, patience=None
         )
+        started = time.perf_counter()
+        probe_results = model_decode(features, options)
+        stats["no_speech_probe_seconds"] += time.perf_counter() - started
+
+        silent = [r.no_speech_prob > no_speech_fast_threshold for r in probe_results]
+        stats["no_speech_skipped"] += sum(silent)
+        return silent
+
+    def decode_with_fallback(
+        features: torch.Tensor, segment: Optional[torch.Tensor] = None
+    ) -> DecodingResult:
+        """Decode one window; all temperatures reuse the same encoder features"""
         decode_result = None
 
         for t in temperatures:
-            kwargs = {**decode_options}
-            if t > 0:
-                # disable beam_size and patience when t > 0
-                kwargs.pop("beam_size", None)
-                kwargs.pop("patience", None)
-            else:
-                # disable best_of when t == 0
-                kwargs.pop("best_of", None)
-
-            options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
-
-            needs_fallback = False
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            options = options_for_temperature(t)
             if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
+                speculative is not None
+                and segment is not None
+                and t == 0
+                and options.beam_size is None
             ):
-                needs_fallback = True  # too repetitive
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  # average log probability is too low
+                decode_result = decode_speculative(features, segment, options)
+            else:
+                decode_result = decode(features, options)
 
-            if not needs_fallback:
+            if not needs_fallback(decode_result):
                 break
 
         return decode_result
 
+    def decode_batch_with_fallback(features: torch.Tensor) -> List[DecodingResult]:
+        # decode all windows at once and only re-run the failed ones at the next temperature
+        decode_results: List[Optional[DecodingResult]] = [None] * features.shape[0]
+        pending = list(range(features.shape[0]))
+
+        for t in temperatures:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            batch_results = decode(features[pending], options_for_temperature(t))
+
+            failed = []
+            for index, decode_result in zip(pending, batch_results):
+                decode_results[index] = decode_result
+                if needs_fallback(decode_result):
+                    failed.append(index)
+
+            pending = failed
+            if not pending:
+                break
+
+        return decode_results
+
     seek = 0
     input_stride = exact_div(
         N_FRAMES, model.dims.n_audio_ctx
@@ -193,7 +518,12 @@ def transcribe(
         all_tokens.extend(initial_prompt)
 
     def add_segment(
-        *, start: float, end: float, text_tokens: torch.Tensor, result: DecodingResult
+        *,
+        start: float,
+        end: float,
+        text_tokens: torch.Tensor,
+        result: DecodingResult,
+        window_seek: int,
     ):
         text = tokenizer.decode(
             [token for token in text_tokens if token < tokenizer.eot]
@@ -201,10 +531,14 @@ def transcribe(
         if len(text.strip()) == 0:  # skip empty text output
             return
 
+        if timeline is not None:
+            start = timeline.to_original(start)
+            end = timeline.to_original(end, is_end=True)
+
         all_segments.append(
             {
                 "id": len(all_segments),
-                "seek": seek,
+                "seek": window_seek,
                 "start": start,
                 "end": end,
                 "text": text,
@@ -215,6 +549,10 @@ def transcribe(
                 "no_speech_prob": result.no_speech_prob,
             }
         )
+        if cascade is not None:
+            all_segments[-1]["model"] = (
+                getattr(result, "model", None) or cascade.main_model_name
+            )
         if verbose:
             process_queue.put(
                 dict(
@@ -225,112 +563,315 @@ def transcribe(
             )
             print(f"[{format_timestamp(start)} --> {format_timestamp(end)}] {text}")
 
-    # show the progress bar when verbose is False (otherwise the transcribed text will be printed)
-    num_frames = mel.shape[-1]
-    previous_seek_value = seek
-
-    with tqdm.tqdm(
-        total=num_frames, unit="frames", disable=verbose is not False
-    ) as pbar:
-        while seek < num_frames:
-            # Check if we should stop processing
-            if should_stop():
-                print(f"Stopping transcription for job {job_id}")
-                break
-
-            timestamp_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
-            segment = pad_or_trim(mel[:, seek:], N_FRAMES).to(model.device).to(dtype)
-            segment_duration = segment.shape[-1] * HOP_LENGTH / SAMPLE_RATE
-
-            decode_options["prompt"] = all_tokens[prompt_reset_since:]
-            result: DecodingResult = decode_with_fallback(segment)
-            tokens = torch.tensor(result.tokens)
-
-            if no_speech_threshold is not None:
-                # no voice activity check
-                should_skip = result.no_speech_prob > no_speech_threshold
-                if (
-                    logprob_threshold is not None
-                    and result.avg_logprob > logprob_threshold
-                ):
-                    # don't skip if the logprob is high enough, despite the no_speech_prob
-                    should_skip = False
-
-                if should_skip:
-                    seek += segment.shape[
-                        -1
-                    ]  # fast-forward to the next segment boundary
-                    continue
+    def is_silent(result: DecodingResult) -> bool:
+        if no_speech_threshold is None:
+            return False
 
-            timestamp_tokens: torch.Tensor = tokens.ge(tokenizer.timestamp_begin)
-            consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[
-                0
-            ].add_(1)
-            if (
-                len(consecutive) > 0
-            ):  # if the output contains two consecutive timestamp tokens
-                last_slice = 0
-                for current_slice in consecutive:
-                    sliced_tokens = tokens[last_slice:current_slice]
-                    start_timestamp_position = (
-                        sliced_tokens[0].item() - tokenizer.timestamp_begin
-                    )
-                    end_timestamp_position = (
-                        sliced_tokens[-1].item() - tokenizer.timestamp_begin
-                    )
-                    add_segment(
-                        start=timestamp_offset
-                        + start_timestamp_position * time_precision,
-                        end=timestamp_offset + end_timestamp_position * time_precision,
-                        text_tokens=sliced_tokens[1:-1],
-                        result=result,
-                    )
-                    last_slice = current_slice
-                last_timestamp_position = (
-                    tokens[last_slice - 1].item() - tokenizer.timestamp_begin
+        # no voice activity check
+        should_skip = result.no_speech_prob > no_speech_threshold
+        if logprob_threshold is not None and result.avg_logprob > logprob_threshold:
+            # don't skip if the logprob is high enough, despite the no_speech_prob
+            should_skip = False
+
+        return should_skip
+
+    def add_window_segments(
+        result: DecodingResult,
+        window_seek: int,
+        segment_size: int,
+        fixed_window: bool = False,
+    ) -> int:
+        """
+        Split the decoded tokens of one window into segments and return the number of mel frames
+        consumed. With `fixed_window` the whole window is always consumed, so the unfinished text
+        after the last pair of consecutive timestamps is kept as a segment of its own instead of
+        being decoded again in the next window.
+        """
+        timestamp_offset = float(window_seek * HOP_LENGTH / SAMPLE_RATE)
+        segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
+        tokens = torch.tensor(result.tokens)
+
+        timestamp_tokens: torch.Tensor = tokens.ge(tokenizer.timestamp_begin)
+        consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0].add_(
+            1
+        )
+        if len(consecutive) > 0:  # if the output contains two consecutive timestamp tokens
+            last_slice = 0
+            for current_slice in consecutive:
+                sliced_tokens = tokens[last_slice:current_slice]
+                start_timestamp_position = (
+                    sliced_tokens[0].item() - tokenizer.timestamp_begin
+                )
+                end_timestamp_position = (
+                    sliced_tokens[-1].item() - tokenizer.timestamp_begin
                 )
-                seek += last_timestamp_position * input_stride
-                all_tokens.extend(tokens[: last_slice + 1].tolist())
-            else:
-                duration = segment_duration
-                timestamps = tokens[timestamp_tokens.nonzero().flatten()]
-                if (
-                    len(timestamps) > 0
-                    and timestamps[-1].item() != tokenizer.timestamp_begin
-                ):
-                    # no consecutive timestamps but it has a timestamp; use the last one.
-                    # single timestamp at the end means no speech after the last timestamp.
-                    last_timestamp_position = (
-                        timestamps[-1].item() - tokenizer.timestamp_begin
-                    )
-                    duration = last_timestamp_position * time_precision
-
                 add_segment(
-                    start=timestamp_offset,
-                    end=timestamp_offset + duration,
-                    text_tokens=tokens,
+                    start=timestamp_offset + start_timestamp_position * time_precision,
+                    end=timestamp_offset + end_timestamp_position * time_precision,
+                    text_tokens=sliced_tokens[1:-1],
                     result=result,
+                    window_seek=window_seek,
                 )
+                last_slice = current_slice
 
-                seek += segment.shape[-1]
+            if fixed_window:
+                remaining_tokens = tokens[last_slice:]
+                start_timestamp_position = (
+                    remaining_tokens[0].item() - tokenizer.timestamp_begin
+                )
+                add_segment(
+                    start=timestamp_offset + start_timestamp_position * time_precision,
+                    end=timestamp_offset + segment_duration,
+                    text_tokens=remaining_tokens[1:],
+                    result=result,
+                    window_seek=window_seek,
+                )
                 all_tokens.extend(tokens.tolist())
+                return segment_size
 
-            if not condition_on_previous_text or result.temperature > 0.5:
-                # do not feed the prompt tokens if a high temperature was used
-                prompt_reset_since = len(all_tokens)
+            last_timestamp_position = (
+                tokens[last_slice - 1].item() - tokenizer.timestamp_begin
+            )
+            all_tokens.extend(tokens[: last_slice + 1].tolist())
+            return last_timestamp_position * input_stride
+
+        duration = segment_duration
+        timestamps = tokens[timestamp_tokens.nonzero().flatten()]
+        if len(timestamps) > 0 and timestamps[-1].item() != tokenizer.timestamp_begin:
+            # no consecutive timestamps but it has a timestamp; use the last one.
+            # single timestamp at the end means no speech after the last timestamp.
+            last_timestamp_position = timestamps[-1].item() - tokenizer.timestamp_begin
+            duration = last_timestamp_position * time_precision
+
+        add_segment(
+            start=timestamp_offset,
+            end=timestamp_offset + duration,
+            text_tokens=tokens,
+            result=result,
+            window_seek=window_seek,
+        )
+        all_tokens.extend(tokens.tolist())
+        return segment_size
+
+    if resumed is not None:
+        seek = resumed["seek"]
+        all_tokens[:] = resumed["all_tokens"]
+        all_segments[:] = resumed["all_segments"]
+        prompt_reset_since = resumed["prompt_reset_since"]
+        stats.update(resumed["stats"])
+        stats["resumes"] = stats.get("resumes", 0) + 1
+        # features computed for the first window belong to the start of the recording
+        encoded_windows.clear()
+        print(
+            f"Resuming job {job_id} at {seek * HOP_LENGTH / SAMPLE_RATE:.1f}s "
+            f"with {len(all_segments)} segments"
+        )
+        if verbose:
+            for segment in all_segments:
+                process_queue.put(
+                    dict(
+                        channel="message",
+                        data=dict(
+                            start=segment["start"],
+                            end=segment["end"],
+                            text=segment["text"],
+                            copy=True,
+                        ),
+                        job_id=job_id,
+                    )
+                )
+
+    checkpointed_windows = stats["windows"]
 
-            # update progress bar
+    def save_progress():
+        nonlocal checkpointed_windows
+        if not checkpoint or stats["windows"] - checkpointed_windows < checkpoint_windows:
+            return
+        save_checkpoint(
+            checkpoint,
+            dict(
+                fingerprint=fingerprint,
+                seek=seek,
+                language=language,
+                all_tokens=all_tokens,
+                all_segments=all_segments,
+                prompt_reset_since=prompt_reset_since,
+                stats=stats,
+            ),
+        )
+        checkpointed_windows = stats["windows"]
+
+    if batch_size > 1 and condition_on_previous_text:
+        warnings.warn(
+            "Batched decoding requires condition_on_previous_text=False; decoding sequentially"
+        )
+
+    # show the progress bar when verbose is False (otherwise the transcribed text will be printed)
+    num_frames = mel_source.num_frames
+    previous_seek_value = seek
+    stopped = False
+
+    with tqdm.tqdm(
+        total=num_frames, unit="frames", disable=verbose is not False
+    ) as pbar:
+
+        def update_progress():
+            nonlocal previous_seek_value
             pbar.update(min(num_frames, seek) - previous_seek_value)
             process_queue.put(
                 dict(channel="timer", data=dict(timer=seek), job_id=job_id)
             )
             previous_seek_value = seek
+            save_progress()
+
+        try:
+            while seek < mel_source.num_frames:
+                # Check if we should stop processing
+                if should_stop():
+                    stopped = True
+                    break
+
+                if use_batches:
+                    window_seeks = list(
+                        range(
+                            seek,
+                            min(mel_source.num_frames, seek + batch_size * N_FRAMES),
+                            N_FRAMES,
+                        )
+                    )
+                    windows = [mel_source.window(s) for s in window_seeks]
+                    # a streamed file may turn out shorter than its estimated length
+                    windows = [window for window in windows if window.shape[-1] > 0]
+                    if not windows:
+                        break
+                    window_seeks = window_seeks[: len(windows)]
+
+                    segments = (
+                        torch.stack([pad_or_trim(window, N_FRAMES) for window in windows])
+                        .to(model.device)
+                        .to(dtype)
+                    )
+
+                    cached_features = [encoded_windows.pop(s, None) for s in window_seeks]
+                    stats["windows"] += len(window_seeks)
+
+                    # the windows are decoded independently, so they all share the initial prompt
+                    decode_options["prompt"] = initial_prompt
+
+                    results: List[Optional[DecodingResult]] = [None] * len(window_seeks)
+                    main_windows = list(range(len(window_seeks)))
+                    if cascade is not None:
+                        main_windows = []
+                        for i, result in enumerate(decode_cascade(segments)):
+                            if cascade_keeps(result):
+                                results[i] = result
+                            else:
+                                main_windows.append(i)
+
+                    if main_windows:
+                        features = [cached_features[i] for i in main_windows]
+                        missing = [j for j, f in enumerate(features) if f is None]
+                        if missing:
+                            missing_segments = segments[[main_windows[j] for j in missing]]
+                            for j, f in zip(missing, encode(missing_segments)):
+                                features[j] = f
+
+                        features = torch.stack(features)
+                        silent = probe_no_speech(features)
+                        active = [j for j in range(len(main_windows)) if not silent[j]]
+
+                        if active:
+                            for j, result in zip(
+                                active, decode_batch_with_fallback(features[active])
+                            ):
+                                results[main_windows[j]] = result
+
+                    for window_seek, result in zip(window_seeks, results):
+                        if result is not None and not is_silent(result):
+                            add_window_segments(
+                                result, window_seek, N_FRAMES, fixed_window=True
+                            )
+
+                    seek = window_seeks[-1] + N_FRAMES
+                    prompt_reset_since = len(all_tokens)
+                    update_progress()
+                    continue
+
+                window = mel_source.window(seek)
+                if window.shape[-1] == 0:
+                    break
+                segment = pad_or_trim(window, N_FRAMES).to(model.device).to(dtype)
+
+                features = encoded_windows.pop(seek, None)
+                stats["windows"] += 1
+                decode_options["prompt"] = all_tokens[prompt_reset_since:]
+
+                result: Optional[DecodingResult] = None
+                if cascade is not None:
+                    result = decode_cascade(segment.unsqueeze(0))[0]
+                    if not cascade_keeps(result):
+                        result = None
+
+                if result is None:
+                    if features is None:
+                        features = encode(segment.unsqueeze(0))[0]
+
+                    if probe_no_speech(features.unsqueeze(0))[0]:
+                        seek += segment.shape[-1]  # confidently silent; skip without decoding
+                        continue
+
+                    result = decode_with_fallback(features, segment)
+
+                if is_silent(result):
+                    seek += segment.shape[-1]  # fast-forward to the next segment boundary
+                    continue
+
+                seek += add_window_segments(result, seek, segment.shape[-1])
+
+                if not condition_on_previous_text or result.temperature > 0.5:
+                    # do not feed the prompt tokens if a high temperature was used
+                    prompt_reset_since = len(all_tokens)
+
+                update_progress()
+        except TranscriptionCancelled:
+            # the window that was being decoded is dropped
+            stopped = True
+        finally:
+            mel_source.close()
+
+    if stopped:
+        # the encoder features of windows that will not be decoded anymore
+        encoded_windows.clear()
+        latency = cancel_token.latency() if cancel_token is not None else None
+        if latency is not None:
+            stats["stop_latency_seconds"] = latency
+        print(
+            f"Stopping transcription for job {job_id}"
+            + (f" {latency * 1000:.0f}ms after the stop request" if latency is not None else "")
+        )
+
+    # finished or stopped; after an error the caller decides whether the job is tried again
+    if checkpoint and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    if stats["decode_attempts"]:
+        # a silent window would otherwise typically fail every temperature
+        fallback_seconds = (
+            len(temperatures) * stats["decode_seconds"] / stats["decode_attempts"]
+        )
+        stats["no_speech_seconds_saved"] = (
+            stats["no_speech_skipped"] * fallback_seconds
+            - stats["no_speech_probe_seconds"]
+        )
+    summarize_stats(stats)
+    print(f"Transcription stats for job {job_id}: {stats}")
 
-    process_queue.put(dict(channel="message", job_id=job_id, data="end"))
+    process_queue.put(dict(channel="message", job_id=job_id, data="end", stats=stats))
     end_data = dict(
         text=tokenizer.decode(all_tokens[len(initial_prompt) :]),
         segments=all_segments,
         language=language,
+        stats=stats,
     )
     if end_callback:
         end_callback(end_data)
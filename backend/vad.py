@@ -0,0 +1,140 @@
+from typing import Tuple
+
+import numpy as np
+from whisper.audio import N_SAMPLES, SAMPLE_RATE
+
+
+def detect_speech(
+    audio: np.ndarray,
+    *,
+    frame_duration: float = 0.03,
+    threshold_db: float = 10.0,
+    min_energy_db: float = -60.0,
+    min_speech_duration: float = 0.25,
+    min_silence_duration: float = 2.0,
+    speech_pad: float = 0.4,
+) -> np.ndarray:
+    """
+    Find the speech regions of a 16 kHz waveform using frame energies
+
+    Parameters
+    ----------
+    audio: np.ndarray
+        The waveform, as float32 samples in [-1, 1]
+
+    frame_duration: float
+        Length in seconds of the frames the energy is computed for
+
+    threshold_db: float
+        Frames louder than the noise floor (10th percentile of the frame energies) by this many
+        decibels count as speech
+
+    min_energy_db: float
+        Frames quieter than this (in dB relative to full scale) are never speech
+
+    min_speech_duration: float
+        Speech runs shorter than this are treated as noise
+
+    min_silence_duration: float
+        Only silences at least this long are removed; shorter pauses stay part of the speech region
+
+    speech_pad: float
+        Seconds of audio kept around every speech region
+
+    Returns
+    -------
+    An array of shape (n_regions, 2) with the start and end sample of every speech region.
+    """
+    frame_length = int(frame_duration * SAMPLE_RATE)
+    n_frames = len(audio) // frame_length
+    if n_frames == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    frames = audio[: n_frames * frame_length].reshape(n_frames, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames.astype(np.float64) ** 2, axis=1) + 1e-10)
+
+    # relative to the noise floor, but never above the quieter part of the loud frames, so a
+    # recording without any pause is not classified as silence altogether
+    noise_floor = np.percentile(energy_db, 10)
+    threshold = min(noise_floor + threshold_db, np.percentile(energy_db, 90) - 20.0)
+    is_speech = (energy_db > threshold) & (energy_db > min_energy_db)
+
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], is_speech.view(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    if len(starts) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # close the pauses that are too short to be skipped
+    long_gaps = (starts[1:] - ends[:-1]) * frame_duration >= min_silence_duration
+    starts = np.concatenate([starts[:1], starts[1:][long_gaps]])
+    ends = np.concatenate([ends[:-1][long_gaps], ends[-1:]])
+
+    long_enough = (ends - starts) * frame_duration >= min_speech_duration
+    starts, ends = starts[long_enough], ends[long_enough]
+    if len(starts) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    pad = int(speech_pad * SAMPLE_RATE)
+    starts = np.maximum(starts * frame_length - pad, 0)
+    ends = np.minimum(ends * frame_length + pad, len(audio))
+
+    # padding may make neighbouring regions overlap; merge them
+    ends = np.maximum.accumulate(ends)
+    separate = np.concatenate([[True], starts[1:] > ends[:-1]])
+    region_ids = np.cumsum(separate) - 1
+    merged_ends = np.zeros(region_ids[-1] + 1, dtype=np.int64)
+    np.maximum.at(merged_ends, region_ids, ends)
+
+    return np.stack([starts[separate], merged_ends], axis=1).astype(np.int64)
+
+
+class SpeechTimeline:
+    """Maps times in the packed audio back to the original recording"""
+
+    def __init__(self, packed_starts: np.ndarray, regions: np.ndarray):
+        self.packed_starts = np.asarray(packed_starts, dtype=np.float64) / SAMPLE_RATE
+        self.original_starts = regions[:, 0].astype(np.float64) / SAMPLE_RATE
+        self.lengths = (regions[:, 1] - regions[:, 0]).astype(np.float64) / SAMPLE_RATE
+
+    def to_original(self, t: float, is_end: bool = False) -> float:
+        if len(self.packed_starts) == 0:
+            return t
+
+        side = "left" if is_end else "right"
+        i = max(int(np.searchsorted(self.packed_starts, t, side=side)) - 1, 0)
+        offset = t - self.packed_starts[i]
+
+        if offset > self.lengths[i]:
+            # inside the silence that pads a window; snap to the nearest speech boundary
+            if is_end or i + 1 == len(self.packed_starts):
+                return float(self.original_starts[i] + self.lengths[i])
+            return float(self.original_starts[i + 1])
+
+        return float(self.original_starts[i] + max(offset, 0.0))
+
+
+def pack_speech(
+    audio: np.ndarray, regions: np.ndarray, window: int = N_SAMPLES
+) -> Tuple[np.ndarray, SpeechTimeline]:
+    """
+    Concatenate the speech regions into one waveform. A region that fits into a 30-second window
+    but would cross the boundary of the current one is moved to the start of the next window, so
+    short utterances are not cut in half by the fixed windows.
+    """
+    pieces = []
+    packed_starts = []
+    cursor = 0
+
+    for start, end in regions:
+        length = end - start
+        used = cursor % window
+        if length <= window and used and used + length > window:
+            pieces.append(np.zeros(window - used, dtype=audio.dtype))
+            cursor += window - used
+
+        packed_starts.append(cursor)
+        pieces.append(audio[start:end])
+        cursor += length
+
+    packed = np.concatenate(pieces) if pieces else np.zeros(0, dtype=audio.dtype)
+    return packed, SpeechTimeline(np.array(packed_starts), regions)
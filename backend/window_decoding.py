@@ -0,0 +1,162 @@
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Union, TYPE_CHECKING
+
+import numpy as np
+import torch
+from whisper.decoding import DecodingOptions, DecodingResult, DecodingTask, LogitFilter
+
+from cancellation import CancellationToken, TranscriptionCancelled
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+
+
+@dataclass(frozen=True)
+class WindowResult(DecodingResult):
+    # True if the decode was cut short because it got stuck repeating itself
+    repetition_aborted: bool = False
+    # name of the model that decoded the window, if it was not the main model
+    model: Optional[str] = None
+
+
+class RepetitionGuard(LogitFilter):
+    """
+    Ends a sequence with EOT as soon as its sampled tokens end in a loop, i.e. the same n-gram of
+    up to `max_ngram` tokens repeated back to back. Short n-grams must repeat more often, so that
+    together they span at least `min_span` tokens; otherwise they repeat `min_repeats` times.
+
+    Timestamp tokens (from `timestamp_begin` on) are left out of the comparison, since they keep
+    advancing while the text between them loops.
+    """
+
+    def __init__(
+        self,
+        eot: int,
+        sample_begin: int,
+        timestamp_begin: Optional[int] = None,
+        max_ngram: int = 10,
+        min_repeats: int = 4,
+        min_span: int = 16,
+    ):
+        self.eot = eot
+        self.sample_begin = sample_begin
+        self.timestamp_begin = timestamp_begin
+        self.repeats = {
+            n: max(min_repeats, math.ceil(min_span / n)) for n in range(1, max_ngram + 1)
+        }
+
+    def _ends_in_loop(self, tokens: torch.Tensor) -> bool:
+        for n, repeats in self.repeats.items():
+            span = n * repeats
+            if tokens.shape[-1] < span:
+                continue
+            tail = tokens[-span:].reshape(repeats, n)
+            if (tail == tail[-1:, :]).all():
+                return True
+        return False
+
+    def is_looping(self, tokens: torch.Tensor) -> torch.Tensor:
+        """For a batch of sampled token sequences, tell which ones end in a loop"""
+        looping = torch.zeros(tokens.shape[0], dtype=torch.bool, device=tokens.device)
+        for i, row in enumerate(tokens):
+            if self.timestamp_begin is not None:
+                row = row[row < self.timestamp_begin]
+            looping[i] = self._ends_in_loop(row)
+        return looping
+
+    def apply(self, logits: torch.Tensor, tokens: torch.Tensor):
+        looping = self.is_looping(tokens[:, self.sample_begin :])
+        if looping.any():
+            logits[looping] = -np.inf
+            logits[looping, self.eot] = 0
+
+
+class CancellationCheck(LogitFilter):
+    """
+    Checks the cancellation tokens of the windows before every decoder step. The sequences of
+    cancelled windows are ended with EOT, so that the other windows of the batch decode on; once
+    every window is cancelled, the decode is abandoned with `TranscriptionCancelled`.
+    """
+
+    def __init__(
+        self,
+        eot: int,
+        sample_begin: int,
+        window_tokens: Sequence[Optional[CancellationToken]],
+        n_group: int,
+    ):
+        self.eot = eot
+        self.sample_begin = sample_begin
+        self.window_tokens = window_tokens
+        self.n_group = n_group
+
+    def cancelled(self) -> List[bool]:
+        return [token is not None and token.is_cancelled() for token in self.window_tokens]
+
+    def all_cancelled(self) -> bool:
+        return all(self.cancelled())
+
+    def apply(self, logits: torch.Tensor, tokens: torch.Tensor):
+        cancelled = self.cancelled()
+        if not any(cancelled):
+            return
+        if all(cancelled):
+            raise TranscriptionCancelled()
+        if tokens.shape[-1] == self.sample_begin:
+            # an empty sequence breaks the length penalty of the ranking
+            return
+
+        # the sequences of a window are next to each other (beam search, best_of)
+        rows = torch.tensor(cancelled, device=logits.device).repeat_interleave(self.n_group)
+        logits[rows] = -np.inf
+        logits[rows, self.eot] = 0
+
+
+@torch.no_grad()
+def decode_windows(
+    model: "Whisper",
+    mel: torch.Tensor,
+    options: DecodingOptions,
+    repetition_guard: bool = False,
+    cancel_token: Union[None, CancellationToken, Sequence[Optional[CancellationToken]]] = None,
+) -> Union[WindowResult, List[WindowResult]]:
+    """
+    Same as `whisper.decode`, but optionally aborts looping sequences during sampling. Accepts
+    mel windows or encoder features, for a single window or a batch of them.
+
+    `cancel_token` is the token of the job, or one token per window of a batch shared by jobs;
+    decoding stops within a decoder step of the tokens being cancelled.
+    """
+    single = mel.ndim == 2
+    if single:
+        mel = mel.unsqueeze(0)
+
+    task = DecodingTask(model, options)
+    guard = None
+    if repetition_guard:
+        guard = RepetitionGuard(
+            task.tokenizer.eot, task.sample_begin, task.tokenizer.timestamp_begin
+        )
+        task.logit_filters.append(guard)
+    if cancel_token is not None:
+        if isinstance(cancel_token, CancellationToken):
+            cancel_token = [cancel_token] * mel.shape[0]
+        check = CancellationCheck(
+            task.tokenizer.eot, task.sample_begin, cancel_token, task.n_group
+        )
+        # before the encoder runs on the mel windows
+        if check.all_cancelled():
+            raise TranscriptionCancelled()
+        task.logit_filters.append(check)
+
+    results = [
+        WindowResult(
+            **vars(result),
+            repetition_aborted=guard is not None
+            and bool(guard.is_looping(torch.tensor([result.tokens]))[0]),
+        )
+        for result in task.run(mel)
+    ]
+
+    return results[0] if single else results
@@ -0,0 +1,429 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+import uuid
+from queue import Queue
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from whisper.audio import SAMPLE_RATE, load_audio
+
+from cancellation import CancellationToken, TranscriptionInterrupted
+from parallel_transcribe import worker_backend_options
+from transcribe import stop_requested
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(
+    n_workers: int, threads_per_worker: Optional[int] = None, cores: Sequence[int] = None
+) -> List[List[int]]:
+    """Contiguous slices of the cores, one per worker; slices wrap around if there are too few"""
+    cores = list(cores or available_cores())
+    threads = threads_per_worker or max(1, len(cores) // n_workers)
+    return [
+        [cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(n_workers)
+    ]
+
+
+class _WorkerProcessQueue:
+    """
+    The process queue of a job inside a worker process; its messages are sent to the server.
+    Stops come from the server over the worker's control queue and cancel the job's token.
+    """
+
+    def __init__(self, worker_id: int, job_id: str, events):
+        self.worker_id = worker_id
+        self.job_id = job_id
+        self.events = events
+
+    def put(self, data: dict):
+        self.events.put(("message", self.worker_id, self.job_id, data))
+
+    def qsize(self) -> int:
+        return 0
+
+
+# stops kept for jobs the worker has not started yet; older ones are dropped
+MAX_EARLY_STOPS = 100
+
+
+def _listen_for_stops(control, running: dict, early_stops: dict, lock: Lock):
+    """
+    Cancel the running job of the worker when the server sends a stop for it. A stop can
+    overtake its job, which is still on the task queue; it is kept in `early_stops` until the
+    worker takes the job (or forgotten after `MAX_EARLY_STOPS` newer ones, if the job already
+    finished).
+    """
+    while True:
+        data = control.get()
+        if data is None:
+            return
+        with lock:
+            if data.get("job_id") == running.get("job_id"):
+                running["cancel_token"].cancel()
+                continue
+            early_stops[data.get("job_id")] = True
+            while len(early_stops) > MAX_EARLY_STOPS:
+                del early_stops[next(iter(early_stops))]
+
+
+def _worker_main(
+    worker_id: int,
+    cores: List[int],
+    backend: str,
+    model_name: str,
+    model_dir: str,
+    precision: str,
+    backend_options: dict,
+    tasks,
+    control,
+    events,
+):
+    import torch
+
+    from backends import create_backend
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    try:
+        inference_backend = create_backend(
+            backend,
+            model_name,
+            model_dir,
+            precision,
+            **worker_backend_options(backend, backend_options, len(cores)),
+        )
+        inference_backend.load()
+    except Exception:
+        events.put(("failed", worker_id, None, traceback.format_exc()))
+        return
+    events.put(("ready", worker_id, None, None))
+
+    running, early_stops, lock = dict(), dict(), Lock()
+    Thread(
+        target=_listen_for_stops,
+        args=(control, running, early_stops, lock),
+        name="stop-listener",
+        daemon=True,
+    ).start()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        job_id, audio, options = task
+        cancel_token = CancellationToken()
+        with lock:
+            running.update(job_id=job_id, cancel_token=cancel_token)
+            if early_stops.pop(job_id, False):
+                # stopped before the worker got to it; transcribe() ends right away
+                cancel_token.cancel()
+        process_queue = _WorkerProcessQueue(worker_id, job_id, events)
+        try:
+            result = inference_backend.transcribe(
+                audio,
+                process_queue=process_queue,
+                job_id=job_id,
+                cancel_token=cancel_token,
+                **options,
+            )
+            events.put(("result", worker_id, job_id, result))
+        except Exception as e:
+            events.put(("error", worker_id, job_id, (str(e), traceback.format_exc())))
+        finally:
+            with lock:
+                running.clear()
+
+
+class TranscriptionWorkerPool:
+    """
+    Transcribes jobs in worker processes, each pinned to its own slice of the CPU cores and
+    running torch with one thread per core. A job goes to the next free worker; its segment,
+    timer and end messages are passed on to the job's process queue as they arrive, and a
+    cancelled `cancel_token` (or a stop message on the queue, without a token) is forwarded to
+    the worker, which cancels the job there.
+
+    `transcribe` has the contract of `transcribe.transcribe` and blocks until the job finished.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        model_dir: str,
+        n_workers: int,
+        threads_per_worker: Optional[int] = None,
+        precision: str = "float32",
+        backend: str = "pytorch",
+        backend_options: Optional[dict] = None,
+        start_timeout: float = 900.0,
+    ):
+        self.worker_args = (backend, model_name, model_dir, precision, backend_options or {})
+        self.cores = partition_cores(n_workers, threads_per_worker)
+        self.n_workers = n_workers
+        self.threads_per_worker = len(self.cores[0])
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self._workers: Dict[int, dict] = dict()
+        self._idle: "Queue[int]" = Queue()
+        self._pending: Dict[str, dict] = dict()
+        self._lock = Lock()
+        self._started = dict()
+        self._closed = False
+
+        for worker_id in range(n_workers):
+            self._start_worker(worker_id)
+        self._receiver = Thread(target=self._receive, name="worker-pool-receiver", daemon=True)
+        self._receiver.start()
+
+        deadline = time.monotonic() + start_timeout
+        while len(self._started) < n_workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+            for worker_id, worker in self._workers.items():
+                if worker_id not in self._started and not worker["process"].is_alive():
+                    self._started[worker_id] = f"exited with code {worker['process'].exitcode}"
+        failed = {worker_id: error for worker_id, error in self._started.items() if error}
+        if failed or len(self._started) < n_workers:
+            self.close()
+            raise RuntimeError(
+                f"Transcription workers did not start: {failed or 'timed out'}"
+            )
+        logger.info(
+            f"[WORKERS] Started {n_workers} workers with {self.threads_per_worker} threads each "
+            f"on cores {self.cores}"
+        )
+
+    def _start_worker(self, worker_id: int):
+        tasks = self.context.Queue()
+        control = self.context.Queue()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(worker_id, self.cores[worker_id], *self.worker_args, tasks, control, self.events),
+            name=f"transcription-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[worker_id] = dict(process=process, tasks=tasks, control=control)
+
+    def _receive(self):
+        while True:
+            kind, worker_id, job_id, data = self.events.get()
+            if kind == "closed":
+                return
+            if kind in ("ready", "failed"):
+                self._started[worker_id] = data
+                if kind == "ready":
+                    self._idle.put(worker_id)
+                else:
+                    logger.error(f"[WORKERS] Worker {worker_id} failed to start:\n{data}")
+                continue
+
+            with self._lock:
+                pending = self._pending.get(job_id)
+            if kind == "message":
+                if pending is not None:
+                    pending["process_queue"].put(data)
+                continue
+
+            if pending is not None:
+                pending["result" if kind == "result" else "error"] = data
+                pending["done"].set()
+            self._idle.put(worker_id)
+
+    def transcribe(
+        self,
+        audio,
+        *,
+        process_queue,
+        job_id=None,
+        end_callback=None,
+        verbose=None,
+        cancel_token: Optional[CancellationToken] = None,
+        **options,
+    ) -> dict:
+        if self._closed:
+            raise RuntimeError("The worker pool is closed")
+        job_id = job_id or uuid.uuid4().hex
+
+        # blocks until a worker is free
+        worker_id = self._idle.get()
+        if cancel_token is not None and cancel_token.is_cancelled():
+            # stopped while it waited for the worker, which is not bothered with it
+            self._idle.put(worker_id)
+            return self._stopped_result(job_id, process_queue, end_callback, cancel_token)
+        worker = self._workers[worker_id]
+        pending = dict(process_queue=process_queue, done=Event(), result=None, error=None)
+        with self._lock:
+            self._pending[job_id] = pending
+        worker["tasks"].put((job_id, audio, dict(options, verbose=verbose)))
+        logger.info(f"[WORKERS] Job {job_id} runs on worker {worker_id}")
+
+        def send_stop():
+            worker["control"].put(dict(channel="control", data="stop", job_id=job_id))
+
+        stop_sent = False
+        if cancel_token is not None:
+            # the job is cancelled in the worker right away
+            cancel_token.add_callback(send_stop)
+            stop_sent = True
+        try:
+            while not pending["done"].wait(0.5):
+                if not stop_sent and stop_requested(process_queue, job_id):
+                    send_stop()
+                    stop_sent = True
+                if not worker["process"].is_alive():
+                    exitcode = worker["process"].exitcode
+                    if self._closed:
+                        # terminated by close(), the job continues when the server is back
+                        raise TranscriptionInterrupted(
+                            f"Transcription worker {worker_id} was shut down"
+                        )
+                    logger.error(f"[WORKERS] Worker {worker_id} died, restarting it")
+                    self._start_worker(worker_id)
+                    raise RuntimeError(
+                        f"Transcription worker {worker_id} exited with code {exitcode}"
+                    )
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(send_stop)
+            with self._lock:
+                self._pending.pop(job_id, None)
+
+        if pending["error"] is not None:
+            error, error_traceback = pending["error"]
+            logger.error(f"[WORKERS] Job {job_id} failed on worker {worker_id}:\n{error_traceback}")
+            raise RuntimeError(error)
+
+        result = pending["result"]
+        if end_callback:
+            end_callback(result)
+        return result
+
+    @staticmethod
+    def _stopped_result(job_id, process_queue, end_callback, cancel_token) -> dict:
+        """The messages and result of `transcribe.transcribe` for a job stopped before it began"""
+        stats = dict(windows=0, stop_latency_seconds=cancel_token.latency())
+        process_queue.put(dict(channel="message", job_id=job_id, data="end", stats=stats))
+        result = dict(text="", segments=[], language=None, stats=stats)
+        if end_callback:
+            end_callback(result)
+        return result
+
+    def info(self) -> dict:
+        return dict(
+            workers=self.n_workers,
+            threads_per_worker=self.threads_per_worker,
+            cores=self.cores,
+            busy=self.n_workers - self._idle.qsize(),
+        )
+
+    def close(self):
+        self._closed = True
+        for worker in self._workers.values():
+            worker["tasks"].put(None)
+            worker["control"].put(None)
+        for worker in self._workers.values():
+            worker["process"].join(timeout=10)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+        self.events.put(("closed", None, None, None))
+
+
+def benchmark_audio(path: Optional[str] = None, seconds: float = 30.0) -> np.ndarray:
+    """The recording to tune on, or low-level noise if there is none"""
+    if path:
+        return load_audio(path)[: int(seconds * SAMPLE_RATE)]
+    audio = 0.01 * np.random.default_rng(0).standard_normal(int(seconds * SAMPLE_RATE))
+    return audio.astype(np.float32)
+
+
+def _transcribe_on_all_workers(pool: TranscriptionWorkerPool, audio: np.ndarray, options: dict):
+    threads = [
+        Thread(target=pool.transcribe, args=(audio,), kwargs=dict(process_queue=Queue(), **options))
+        for _ in range(pool.n_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def autotune(
+    model_name: str,
+    model_dir: str,
+    precision: str = "float32",
+    backend: str = "pytorch",
+    backend_options: Optional[dict] = None,
+    audio: Optional[np.ndarray] = None,
+    decode_options: Optional[dict] = None,
+    candidates: Optional[List[Tuple[int, int]]] = None,
+    cache_file: Optional[str] = None,
+) -> Tuple[int, int]:
+    """
+    The number of workers and threads per worker with the highest aggregate throughput (seconds
+    of audio transcribed per second) on this host. Every candidate split of the cores is started
+    as a pool, in which all workers transcribe `audio` at the same time after a warmup run.
+
+    The result is stored in `cache_file` per model, precision, backend and core count, so that
+    the measurement only runs once per host.
+    """
+    n_cores = len(available_cores())
+    key = f"{model_name}/{precision}/{backend}/{n_cores}"
+    cache = dict()
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if key in cache:
+            return tuple(cache[key]["best"])
+
+    audio = benchmark_audio() if audio is None else audio
+    decode_options = dict(decode_options or {}, verbose=None)
+    duration = len(audio) / SAMPLE_RATE
+    candidates = candidates or [
+        (n_workers, n_cores // n_workers)
+        for n_workers in (1, 2, 4, 8, 16, 32)
+        if n_workers <= n_cores
+    ]
+
+    measurements = []
+    for n_workers, threads in candidates:
+        pool = TranscriptionWorkerPool(
+            model_name, model_dir, n_workers, threads, precision, backend, backend_options
+        )
+        try:
+            _transcribe_on_all_workers(pool, audio, decode_options)
+            start = time.perf_counter()
+            _transcribe_on_all_workers(pool, audio, decode_options)
+            seconds = time.perf_counter() - start
+        finally:
+            pool.close()
+
+        throughput = n_workers * duration / seconds
+        measurements.append(
+            dict(workers=n_workers, threads=threads, seconds=seconds, throughput=throughput)
+        )
+        logger.info(
+            f"[WORKERS] {n_workers} workers x {threads} threads: "
+            f"{throughput:.2f}s of audio per second (RTF {1 / throughput:.3f})"
+        )
+
+    best = max(measurements, key=lambda measurement: measurement["throughput"])
+    best = (best["workers"], best["threads"])
+    if cache_file:
+        cache[key] = dict(best=best, measurements=measurements)
+        with open(cache_file, "w") as f:
+            json.dump(cache, f, indent=2)
+    return best